@@ -0,0 +1,140 @@
+"""
+aggregate.py — Summing per-property GA4 frames into run totals.
+
+Adding each property's frame to a running DataFrame with
+DataFrame.add() realigns and copies the whole total on every call and
+turns the counts into floats.  CountryAccumulator instead keeps one
+int64 array with a row per country and a column per metric, grown as
+new countries or columns appear, and adds each frame into it in place.
+It is safe to add to from several threads, and since integer sums do
+not depend on order the result is the same however the frames arrive.
+Frames of reports with several dimensions are keyed on the tuples of
+their MultiIndex in the same way.
+
+CityAccumulator does the same for the city report, whose tens of
+thousands of rows per property are keyed on the integer cityId alone,
+with each city's name and country kept once.
+"""
+
+import threading
+from typing import Any, Dict, Hashable, Iterable, List, Tuple, TypeVar, Union
+
+import numpy as np
+import pandas as pd
+
+INITIAL_ROWS = 256
+INITIAL_COLUMNS = 16
+
+K = TypeVar("K", bound=Hashable)
+
+
+class CountryAccumulator:
+    """Running int64 totals of frames indexed by country.
+
+    index_name is a list of names for frames with a MultiIndex.
+    """
+
+    def __init__(
+        self, index_name: Union[str, List[str]] = "ga:countryIsoCode"
+    ) -> None:
+        self.index_name = index_name
+        # Keyed on countries, the tuples of a MultiIndex or cityIds.
+        self._rows: Dict[Any, int] = {}
+        self._columns: Dict[str, int] = {}
+        self._data = np.zeros(
+            (INITIAL_ROWS, INITIAL_COLUMNS), dtype=np.int64
+        )
+        self._lock = threading.Lock()
+
+    def _positions(self, keys: Iterable[K], slots: Dict[K, int]) -> np.ndarray:
+        return np.array(
+            [slots.setdefault(key, len(slots)) for key in keys], dtype=np.intp
+        )
+
+    def _grow(self) -> None:
+        rows, cols = self._data.shape
+        need_rows, need_cols = len(self._rows), len(self._columns)
+        if need_rows <= rows and need_cols <= cols:
+            return
+        data = np.zeros(
+            (max(rows, need_rows * 2), max(cols, need_cols * 2)),
+            dtype=np.int64,
+        )
+        data[:rows, :cols] = self._data
+        self._data = data
+
+    def add(self, df: pd.DataFrame) -> None:
+        """Add a frame of integer counts indexed by country."""
+        if df.empty:
+            return
+        values = df.to_numpy(dtype=np.int64)
+        with self._lock:
+            rows = self._positions(df.index, self._rows)
+            cols = self._positions(df.columns, self._columns)
+            self._grow()
+            # add.at rather than += so a repeated country is summed.
+            np.add.at(self._data, np.ix_(rows, cols), values)
+
+    def result(self) -> pd.DataFrame:
+        """Return the totals sorted by country and column name."""
+        with self._lock:
+            index = sorted(self._rows)
+            columns = sorted(self._columns)
+            rows = np.array([self._rows[k] for k in index], dtype=np.intp)
+            cols = np.array([self._columns[k] for k in columns], dtype=np.intp)
+            data = self._data[np.ix_(rows, cols)]
+        return pd.DataFrame(data, index=self._index(index), columns=columns)
+
+    def _index(self, keys: List[Any]) -> pd.Index:
+        if isinstance(self.index_name, list):
+            return pd.MultiIndex.from_tuples(keys, names=self.index_name)
+        return pd.Index(keys, name=self.index_name)
+
+
+class CityAccumulator(CountryAccumulator):
+    """Running int64 totals of frames indexed by (cityId, city, country).
+
+    GA4's "(not set)" cityId is reported as 0, one row per country.
+    Inside, each country's unknown cities are keyed on a negative id of
+    their own so that they are not summed into one country's row.
+    """
+
+    def __init__(self, index_name: List[str]) -> None:
+        super().__init__(index_name)
+        self._labels: Dict[int, Tuple[str, str]] = {}
+        self._unknown: Dict[str, int] = {}
+
+    def add(self, df: pd.DataFrame) -> None:
+        if df.empty:
+            return
+        ids = pd.to_numeric(df.index.get_level_values(0), errors="coerce")
+        unknown = ids.isna()
+        ids = ids.fillna(0).astype(np.int64)
+        with self._lock:
+            if unknown.any():
+                ids = ids.to_numpy().copy()
+                ids[unknown] = [
+                    self._unknown.setdefault(country, -1 - len(self._unknown))
+                    for country in df.index.get_level_values(2)[unknown]
+                ]
+                ids = pd.Index(ids)
+            new = ~ids.isin(list(self._labels))
+            if new.any():
+                cities = df.index.get_level_values(1)[new]
+                countries = df.index.get_level_values(2)[new]
+                for city_id, city, country in zip(
+                    ids[new], cities, countries
+                ):
+                    self._labels.setdefault(city_id, (city, country))
+        super().add(df.set_axis(ids, axis=0))
+
+    def result(self) -> pd.DataFrame:
+        """Return the totals sorted by cityId, city and country."""
+        # The negative ids follow arrival order, so sort on the labels.
+        return super().result().sort_index()
+
+    def _index(self, keys: List[Any]) -> pd.Index:
+        return pd.MultiIndex.from_tuples(
+            [(max(key, 0), *self._labels[key]) for key in keys],
+            names=self.index_name,
+        )
@@ -3,40 +3,95 @@
 # https://developers.google.com/analytics/devguides/config/mgmt/v3/quickstart/service-py
 # https://stackoverflow.com/questions/59840150/google-analytics-data-to-pandas-dataframe
 
+from aggregate import CityAccumulator, CountryAccumulator
 from apiclient.discovery import build
 from box_links import upload_and_get_link as up_link
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Future,
+    ThreadPoolExecutor,
+    wait,
+)
+from daily_store import DailyStore, response_to_rows
+from datetime import datetime, timedelta
 from email.mime.application import MIMEApplication
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
-from geonamescache.mappers import country
-from google.analytics.admin import AnalyticsAdminServiceClient
-from google.analytics.data_v1beta import BetaAnalyticsDataClient
+from ga4_clients import GA4Clients
+from google.analytics.admin import ListAccountSummariesRequest
 from google.analytics.data_v1beta.types import (
+    BatchRunReportsRequest,
     DateRange,
     Dimension,
     Metric,
     MetricType,
     RunReportRequest,
 )
+from google.api_core.exceptions import GoogleAPICallError
+from history import DEFAULT_HISTORY_FILE, HistoryStore, account_label
+from matrix import PropertyMatrix
 from oauth2client import client
 from oauth2client import file
 from oauth2client import tools
 from pprint import pformat
+from property_cache import DEFAULT_TTL_HOURS, PropertyCache
+from quota import QuotaLog
+from retry import (
+    DEFAULT_ATTEMPTS,
+    DEFAULT_DEADLINE,
+    BudgetExceeded,
+    RetryPolicy,
+)
+from reports import (
+    CITY,
+    CITY_REPORT,
+    COUNTRY_REPORT,
+    DEFAULT_REPORTS,
+    Report,
+    load_reports,
+    plan,
+)
+from report_cache import (
+    DEFAULT_CACHE_DIR,
+    DEFAULT_SETTLE_DAYS,
+    ReportCache,
+)
+from scheduler import (
+    DEFAULT_MAX_IN_FLIGHT,
+    PROPERTY_TOKENS_PER_HOUR,
+    RequestScheduler,
+)
+from site_totals import (
+    DEFAULT_TOTALS_DIR,
+    SiteTotals,
+    parse_totals,
+    totals_path,
+)
 from subprocess import PIPE, Popen
-from typing import Dict, List, Optional
+from typing import Any, Dict, List, Optional, Set
 import argparse
+import atexit
+import calendar
+import city_ref
+import columnar
+import country_ref
 import dateparser
 import fiscalyear as fy
 import httplib2
 import logging
+import numpy as np
 import os.path
 import pandas as pd
 import plot_interactive_map as pim
 import plot_static_map as psm
+import realtime
 import re
 import smtplib
 import sys
-import yaml
+import threading
+import time
+import util
+import work_queue
 
 
 IS_V3_DEPRECATED = True
@@ -53,8 +108,11 @@ os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = os.path.join(
     os.environ["HOME"], ".analytics", GA4_CREDENTIAL_FILE
 )
 
+# Column names of GA4 dimensions and metrics in the frames and CSV,
+# kept from Universal Analytics.  Others keep their GA4 name.
 DIMENSIONS = {
     "countryId": "ga:countryIsoCode",
+    "dateRange": "dateRange",
 }
 
 METRICS = {
@@ -63,38 +121,104 @@ METRICS = {
     "screenPageViews": "ga:pageviews",
 }
 
+# Rows requested per runReport call.  The API returns at most 250,000
+# rows per call and only 10,000 when no limit is given.
+PAGE_SIZE = 100000
+
+# Largest page the Admin API allows for listAccountSummaries.
+ACCOUNT_SUMMARY_PAGE_SIZE = 200
+
+# Name of the requested period in the GA4 dateRange dimension.  The
+# comparison periods are named after their util.COMPARISONS key.
+CURRENT_RANGE = "current"
+
 logging.basicConfig(format="%(levelname)s: %(message)s")
 logger = logging.getLogger(__name__)
 
+def index_names(dimensions):
+    """Return the frame index name(s) for a list of GA4 dimensions."""
+    names = [DIMENSIONS.get(name, name) for name in dimensions]
+    return names[0] if len(names) == 1 else names
+
+
+def new_accumulator(report):
+    """Return an empty accumulator for report's frames."""
+    if report.name == CITY_REPORT:
+        return CityAccumulator(index_names(report.dimensions))
+    return CountryAccumulator(index_names(report.dimensions))
+
+
 def ga4_response_to_df(response):
-    dim_len = len(response.dimension_headers)
-    metric_len = len(response.metric_headers)
-    all_data = []
-    for row in response.rows:
-        row_data = {}
-        for i in range(0, dim_len):
-            row_data.update(
-                {
-                    DIMENSIONS[
-                        response.dimension_headers[i].name
-                    ]: row.dimension_values[i].value
-                }
-            )
-        for i in range(0, metric_len):
-            row_data.update(
-                {
-                    METRICS[response.metric_headers[i].name]: row.metric_values[
-                        i
-                    ].value
-                }
-            )
-        # logger.debug(pformat(row_data))
-        all_data.append(row_data)
-    df = pd.DataFrame(all_data)
-    df.loc[df["ga:countryIsoCode"] == "(not set)", "ga:countryIsoCode"] = "ZZ"
-    df = df.set_index("ga:countryIsoCode")
-    set_int(df)
-    return df
+    """Convert a runReport response to a frame indexed by its dimensions.
+
+    Works column by column on the underlying protobuf rows: header
+    names are resolved once, metrics go straight into int64 arrays and
+    the dimensions are factorized into codes.  The index is the
+    country, or a MultiIndex when the report has several dimensions
+    besides dateRange.  When the response has several date ranges the
+    ranges are spread into columns, e.g. ga:pageviews and
+    ga:pageviews_prev.
+    """
+    dim_names = [
+        DIMENSIONS.get(h.name, h.name) for h in response.dimension_headers
+    ]
+    metric_names = [
+        METRICS.get(h.name, h.name) for h in response.metric_headers
+    ]
+    rows = type(response).pb(response).rows
+    num_rows = len(rows)
+
+    dim_values = {
+        name: [row.dimension_values[i].value for row in rows]
+        for i, name in enumerate(dim_names)
+    }
+    metric_values = np.empty((num_rows, len(metric_names)), dtype=np.int64)
+    for i in range(len(metric_names)):
+        metric_values[:, i] = np.fromiter(
+            (row.metric_values[i].value for row in rows),
+            dtype=np.int64,
+            count=num_rows,
+        )
+
+    if "ga:countryIsoCode" in dim_values:
+        dim_values["ga:countryIsoCode"] = [
+            "ZZ" if value == "(not set)" else value
+            for value in dim_values["ga:countryIsoCode"]
+        ]
+
+    keys = [name for name in dim_names if name != "dateRange"]
+    if len(keys) == 1:
+        labels = np.array(dim_values[keys[0]], dtype=object)
+    else:
+        labels = np.empty(num_rows, dtype=object)
+        labels[:] = list(zip(*(dim_values[key] for key in keys)))
+
+    def make_index(values):
+        if len(keys) == 1:
+            return pd.Index(values, name=keys[0])
+        return pd.MultiIndex.from_tuples(list(values), names=keys)
+
+    if "dateRange" not in dim_values:
+        index = make_index(labels)
+        return pd.DataFrame(metric_values, index=index, columns=metric_names)
+
+    label_codes, label_values = pd.factorize(labels, sort=True)
+    range_codes, range_names = pd.factorize(
+        np.array(dim_values["dateRange"], dtype=object), sort=True
+    )
+    num_ranges = len(range_names)
+    table = np.zeros(
+        (len(label_values), len(metric_names) * num_ranges), dtype=np.int64
+    )
+    for i in range(len(metric_names)):
+        table[label_codes, i * num_ranges + range_codes] = metric_values[:, i]
+    columns = [
+        metric if name == CURRENT_RANGE else f"{metric}_{name}"
+        for metric in metric_names
+        for name in range_names
+    ]
+    index = make_index(label_values)
+    return pd.DataFrame(table, index=index, columns=columns)
 
 
 def print_run_report_response(response):
@@ -122,13 +246,13 @@ def print_run_report_response(response):
     # [END analyticsdata_print_run_report_response_rows]
 
 
-def get_properties(account_list: Optional[List[str]] = None) -> Dict[str, str]:
-    client = AnalyticsAdminServiceClient()
-    results = client.list_account_summaries()
+def discover_properties(clients: GA4Clients) -> Dict[str, str]:
+    """Return the property of every "account:site" visible to us."""
+    results = clients.admin.list_account_summaries(
+        ListAccountSummariesRequest(page_size=ACCOUNT_SUMMARY_PAGE_SIZE)
+    )
     properties = {}
     for account_summary in results:
-        if account_list and account_summary.display_name not in account_list:
-            continue
         for property_summary in account_summary.property_summaries:
             logger.debug(f"Property resource name: {property_summary.property}")
             logger.debug(f"Property display name: {property_summary.display_name}\n")
@@ -141,25 +265,270 @@ def get_properties(account_list: Optional[List[str]] = None) -> Dict[str, str]:
     return properties
 
 
-def get_results_v4(prop, start_date, end_date):
-    """Runs a report of active users grouped by country."""
-    client = BetaAnalyticsDataClient()
-    request = RunReportRequest(
-        property=prop,
-        dimensions=[
-            Dimension(name="countryId"),
-        ],
-        metrics=[
-            Metric(name="sessions"),
-            Metric(name="totalUsers"),
-            Metric(name="screenPageViews"),
-        ],
-        date_ranges=[DateRange(start_date=start_date, end_date=end_date)],
-    )
-    response = client.run_report(request)
-    # print_run_report_response(response)
-    # return ga4_response_to_df(response)
-    return response
+def get_properties(
+    clients: GA4Clients,
+    account_list: Optional[List[str]] = None,
+    cache: Optional[PropertyCache] = None,
+    refresh: bool = False,
+) -> Dict[str, str]:
+    properties = None
+    if cache is not None and not refresh:
+        properties = cache.load()
+    if properties is None:
+        properties = discover_properties(clients)
+        if cache is not None:
+            cache.save(properties)
+    if account_list:
+        properties = {
+            long_name: prop
+            for long_name, prop in properties.items()
+            if long_name.split(":", 1)[0] in account_list
+        }
+    return properties
+
+
+def page_request(request, page_size, offset):
+    """Return a copy of request for the page starting at offset."""
+    page = RunReportRequest(request)
+    page.limit = page_size
+    page.offset = offset
+    return page
+
+
+def iter_report_pages(
+    client,
+    request,
+    page_size=PAGE_SIZE,
+    executor=None,
+    window=1,
+    cache=None,
+    quota=None,
+    scheduler=None,
+    first=None,
+    retry=None,
+):
+    """Yield the pages of a runReport request as they arrive.
+
+    The first page is fetched on its own since its row_count tells us
+    how many more pages there are, unless it is passed in as first.
+    The rest are fetched on executor, if given, with no more than its
+    worker count in flight so that memory is bounded by page size
+    rather than the size of the report.
+    Pages after the first are yielded in completion order.  Pages are
+    read from and saved to cache, a ReportCache, when one is given.
+    Calls that reach the API are recorded in quota, a QuotaLog, paced
+    by scheduler, a RequestScheduler, and given deadlines and retries
+    by retry, a RetryPolicy.
+    """
+    if quota is not None:
+        client = quota.wrap(client)
+    if retry is not None:
+        client = retry.wrap(client, scheduler)
+    elif scheduler is not None:
+        client = scheduler.wrap(client)
+
+    def run_page(offset):
+        page = page_request(request, page_size, offset)
+        if cache is not None:
+            return cache.run_report(client, page)
+        return client.run_report(page)
+
+    if first is None:
+        first = run_page(0)
+    yield first
+
+    offsets = list(range(page_size, first.row_count, page_size))
+    if offsets:
+        logger.debug(
+            f"{request.property}: {first.row_count} rows, "
+            f"fetching {len(offsets)} more page(s)"
+        )
+
+    if executor is None:
+        for offset in offsets:
+            yield run_page(offset)
+        return
+
+    pending: Set[Future[Any]] = set()
+    while offsets or pending:
+        while offsets and len(pending) < window:
+            pending.add(executor.submit(run_page, offsets.pop(0)))
+        done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        for future in done:
+            yield future.result()
+
+
+def run_batch(client, prop, requests, cache=None):
+    """Return the responses to requests for one property.
+
+    Requests answered by cache, a ReportCache, are left out of the
+    call.  The rest are sent in one batchRunReports call, or a plain
+    runReport call if only one is left.
+    """
+    responses = [None] * len(requests)
+    if cache is not None:
+        responses = [cache.lookup(request) for request in requests]
+    missing = [i for i, response in enumerate(responses) if response is None]
+    if len(missing) == 1:
+        fetched = [client.run_report(requests[missing[0]])]
+    elif missing:
+        fetched = client.batch_run_reports(
+            BatchRunReportsRequest(
+                property=prop, requests=[requests[i] for i in missing]
+            )
+        ).reports
+    else:
+        fetched = []
+    for i, response in zip(missing, fetched):
+        responses[i] = response
+        if cache is not None:
+            cache.store(requests[i], response)
+    return responses
+
+
+def get_results_v4(
+    clients,
+    prop,
+    date_ranges,
+    page_size=PAGE_SIZE,
+    executor=None,
+    window=1,
+    cache=None,
+    quota=None,
+    scheduler=None,
+    reports=DEFAULT_REPORTS,
+    retry=None,
+):
+    """Runs the reports for a property, by default views by country.
+
+    date_ranges is a list of (name, start_date, end_date) tuples.  The
+    reports are planned into as few calls as possible, see
+    reports.plan(), and the first page of every query in a batch comes
+    back from the one call.  Yields (query, response) pairs for each
+    page; later pages are fetched as in iter_report_pages().
+    """
+    client = clients.data
+    if quota is not None:
+        client = quota.wrap(client)
+    if retry is not None:
+        client = retry.wrap(client, scheduler)
+    elif scheduler is not None:
+        client = scheduler.wrap(client)
+
+    for batch in plan(reports, date_ranges):
+        requests = [query.request(prop) for query in batch]
+        firsts = run_batch(
+            client,
+            prop,
+            [page_request(request, page_size, 0) for request in requests],
+            cache,
+        )
+        for query, request, first in zip(batch, requests, firsts):
+            # print_run_report_response(first)
+            for response in iter_report_pages(
+                clients.data,
+                request,
+                page_size,
+                executor,
+                window,
+                cache,
+                quota,
+                scheduler,
+                first,
+                retry,
+            ):
+                yield query, response
+
+
+def sync_daily(
+    clients,
+    store,
+    prop,
+    start_date,
+    end_date,
+    executor=None,
+    window=1,
+    quota=None,
+    scheduler=None,
+    retry=None,
+):
+    """Fetch the days between start_date and end_date missing from store."""
+    spans = store.missing_spans(prop, start_date, end_date)
+    for span_start, span_end in spans:
+        request = RunReportRequest(
+            property=prop,
+            dimensions=[
+                Dimension(name="date"),
+                Dimension(name="countryId"),
+            ],
+            metrics=[
+                Metric(name="sessions"),
+                Metric(name="totalUsers"),
+                Metric(name="screenPageViews"),
+            ],
+            date_ranges=[DateRange(start_date=span_start, end_date=span_end)],
+            return_property_quota=True,
+        )
+        rows = []
+        for response in iter_report_pages(
+            clients.data,
+            request,
+            executor=executor,
+            window=window,
+            quota=quota,
+            scheduler=scheduler,
+            retry=retry,
+        ):
+            rows.extend(response_to_rows(response))
+        logger.debug(
+            f"{prop}: fetched {len(rows)} rows for {span_start} to {span_end}"
+        )
+        store.write(prop, span_start, span_end, rows)
+
+
+def get_results_daily(
+    clients,
+    store,
+    prop,
+    date_ranges,
+    executor=None,
+    window=1,
+    quota=None,
+    scheduler=None,
+    retry=None,
+    users=False,
+):
+    """Answer date_ranges for prop from the daily store.
+
+    Returns a frame shaped like the ga4_response_to_df() output for
+    the same request, after syncing any days missing from store.  Users
+    are left out unless users is set, since summed from days they count
+    a visitor once per day; see daily_store.py.
+    """
+    frames = []
+    for name, start, end in date_ranges:
+        sync_daily(
+            clients,
+            store,
+            prop,
+            start,
+            end,
+            executor,
+            window,
+            quota,
+            scheduler,
+            retry,
+        )
+        df = store.aggregate(prop, start, end)
+        if not users:
+            df = df.drop(columns="users")
+        suffix = "" if name == CURRENT_RANGE else f"_{name}"
+        df.columns = pd.Index([f"ga:{col}{suffix}" for col in df.columns])
+        frames.append(df)
+    df = pd.concat(frames, axis=1).fillna(0)
+    df.index.name = "ga:countryIsoCode"
+    set_int(df)
+    return df
 
 
 def get_service(api_name, api_version, scope, client_secrets_path):
@@ -257,14 +626,6 @@ def get_results(service, profile_id, start_date, end_date):
             ).execute()
 
 
-def conv_iso_2_to_3(iso_2):
-    # return countries[iso_2]['iso3']
-    if iso_2 == "ZZ":
-        return "ZZZ"
-    else:
-        return country(from_key='iso', to_key='iso3')(iso_2)
-
-
 def set_int(df):
     cols = list(df.columns)
     df[cols] = df[cols].astype(int)
@@ -289,7 +650,231 @@ def format_date(date):
     return date.strftime('%Y-%m-%d')
 
 
-def get_analytics(account_list, skip_list, start_date, end_date, output_file):
+def month_end(date):
+    return date.replace(day=calendar.monthrange(date.year, date.month)[1])
+
+
+def shift_months(date, months):
+    month = date.month - 1 + months
+    year = date.year + month // 12
+    month = month % 12 + 1
+    day = min(date.day, calendar.monthrange(year, month)[1])
+    return date.replace(year=year, month=month, day=day)
+
+
+def get_date_ranges(start_date, end_date, compare=True):
+    """Return the (name, start, end) ranges to request for a period.
+
+    Besides the period itself this includes the period of the same
+    length immediately before it and the same period a year earlier.
+    Whole-month periods such as fiscal quarters are shifted by calendar
+    months, anything else by days.
+    """
+    date_ranges = [(CURRENT_RANGE, start_date, end_date)]
+    if not compare:
+        return date_ranges
+
+    start = datetime.strptime(start_date, "%Y-%m-%d").date()
+    end = datetime.strptime(end_date, "%Y-%m-%d").date()
+    whole_months = start.day == 1 and end == month_end(end)
+
+    if whole_months:
+        months = (end.year - start.year) * 12 + end.month - start.month + 1
+        prev_start = shift_months(start, -months)
+        prev_end = month_end(shift_months(end, -months))
+    else:
+        days = timedelta(days=(end - start).days + 1)
+        prev_start = start - days
+        prev_end = end - days
+
+    year_start = shift_months(start, -12)
+    year_end = shift_months(end, -12)
+    if whole_months:
+        year_end = month_end(year_end)
+
+    date_ranges.append(
+        ("prev", format_date(prev_start), format_date(prev_end))
+    )
+    date_ranges.append(
+        ("yoy", format_date(year_start), format_date(year_end))
+    )
+    return date_ranges
+
+
+def add_change_columns(total, date_ranges):
+    """Add the change from each comparison period for every metric.
+
+    The current metrics come first as before, followed by each
+    comparison period's values and then its changes.
+    """
+    metrics = sorted(re.sub(r"^ga:", "", col) for col in METRICS.values())
+    names = [name for name, _, _ in date_ranges if name != CURRENT_RANGE]
+    total = total.reindex(
+        columns=metrics + [f"{m}_{name}" for name in names for m in metrics],
+        fill_value=0,
+    )
+    columns = {metric: total[metric] for metric in metrics}
+    for name in names:
+        for metric in metrics:
+            columns[f"{metric}_{name}"] = total[f"{metric}_{name}"]
+        for metric in metrics:
+            columns[f"{metric}_chg_{name}"] = (
+                total[metric] - total[f"{metric}_{name}"]
+            )
+    return pd.DataFrame(columns, index=total.index)
+
+
+def report_columns(df, query, report):
+    """Return the columns of a query's frame that belong to report."""
+    metrics = {METRICS.get(name, name) for name in report.metrics}
+    suffixes = [f"_{name}" for name, _, _ in query.date_ranges]
+    columns = []
+    for col in df.columns:
+        metric = col
+        for suffix in suffixes:
+            if col.endswith(suffix):
+                metric = col[:-len(suffix)]
+                break
+        if metric in metrics:
+            columns.append(col)
+    return columns
+
+
+def fetch_property(
+    clients,
+    prop,
+    date_ranges,
+    reports,
+    daily_store=None,
+    page_executor=None,
+    window=1,
+    cache=None,
+    quota=None,
+    scheduler=None,
+    retry=None,
+    daily_users=False,
+):
+    """Fetch one property's reports.
+
+    Returns a dict of each report's frame for the property, its site
+    totals or None if no report asked for them, and the number of
+    pages fetched.  With daily_store the country report is summed from
+    it rather than fetched, apart from its users unless daily_users is
+    set, so reports should hold a country report of totalUsers alone,
+    or none; see get_analytics().
+    """
+    prop_totals = {}
+    prop_site_totals = None
+    pages = 0
+    if daily_store is not None:
+        begin = time.perf_counter()
+        prop_totals[COUNTRY_REPORT] = CountryAccumulator()
+        prop_totals[COUNTRY_REPORT].add(get_results_daily(
+            clients,
+            daily_store,
+            prop,
+            date_ranges,
+            page_executor,
+            window,
+            quota,
+            scheduler,
+            retry,
+            daily_users,
+        ))
+        logger.info(
+            f"Synced {prop} in {time.perf_counter() - begin:.2f}s"
+        )
+    for query, results in get_results_v4(
+        clients,
+        prop,
+        date_ranges,
+        executor=page_executor,
+        window=window,
+        cache=cache,
+        quota=quota,
+        scheduler=scheduler,
+        reports=reports,
+        retry=retry,
+    ):
+        pages += 1
+        logger.debug(pformat(results))
+        if query.totals:
+            # Every page repeats the totals.
+            if prop_site_totals is None:
+                prop_site_totals = {}
+            prop_site_totals.update(
+                parse_totals(results, query.date_ranges)
+            )
+        if len(results.rows) > 0:
+            df = ga4_response_to_df(results)
+            logger.debug(df)
+            for report in query.reports:
+                if report.name not in prop_totals:
+                    prop_totals[report.name] = new_accumulator(report)
+                prop_totals[report.name].add(
+                    df[report_columns(df, query, report)]
+                )
+    frames = {
+        name: prop_total.result() for name, prop_total in prop_totals.items()
+    }
+    return frames, prop_site_totals, pages
+
+
+def get_analytics(
+    account_list,
+    skip_list,
+    start_date,
+    end_date,
+    output_file,
+    jobs=1,
+    clients=None,
+    compare=True,
+    cache=None,
+    daily_store=None,
+    property_cache=None,
+    refresh_properties=False,
+    scheduler=None,
+    reports=None,
+    properties=None,
+    retry=None,
+    budget=None,
+    parquet=False,
+    history=None,
+    totals_dir=None,
+    queue=None,
+    daily_users=False,
+):
+    """Write the country CSV and any extra reports for a date range.
+
+    Properties that can't be fetched, or aren't fetched within budget
+    seconds, are left out of the totals rather than ending the run.
+    Returns a dict of the missing properties' names and why.  With
+    parquet, each CSV also gets a Parquet copy; see columnar.py.  The
+    country totals are also added to history, a HistoryStore, if given.
+    Each property's country totals are saved next to the CSV as a
+    .matrix.npz file; see matrix.py.  Given totals_dir, the properties'
+    site totals are saved there for analytics-reporter.rb; see
+    site_totals.py.  Given queue, a WorkQueue, the properties are
+    fetched by workers and only merged here; see work_queue.py.
+
+    With daily_store, sessions and pageviews are summed from it and
+    users are still asked of GA4: one call per property covers all of
+    the ranges, and cache, if given, answers it again once they have
+    settled.  daily_users sums users from daily_store too, with no
+    calls for days already synced, at the cost of counting a visitor
+    once per day; that is logged and recorded in the Parquet copies'
+    metadata.
+    """
+    if clients is None:
+        clients = GA4Clients()
+    if scheduler is None:
+        scheduler = RequestScheduler()
+    if retry is None:
+        retry = RetryPolicy()
+    retry = retry.with_budget(budget)
+    if reports is None:
+        reports = DEFAULT_REPORTS
+
     scope = ["https://www.googleapis.com/auth/analytics.readonly"]
 
     if not IS_V3_DEPRECATED:
@@ -299,12 +884,41 @@ def get_analytics(account_list, skip_list, start_date, end_date, output_file):
         profile_ids = get_profile_ids(service, account_list)
         logger.info("profile ids:\n" + pformat(profile_ids))
 
-    properties = get_properties(account_list)
+    if properties is None:
+        properties = get_properties(
+            clients, account_list, property_cache, refresh_properties
+        )
     logger.info("properties:\n" + pformat(properties))
 
     skip_dict = {name: 1 for name in skip_list}
 
-    total = pd.DataFrame()
+    quota = QuotaLog()
+
+    date_ranges = get_date_ranges(start_date, end_date, compare)
+    logger.debug("date ranges:\n" + pformat(date_ranges))
+
+    totals = {report.name: new_accumulator(report) for report in reports}
+    total = totals[COUNTRY_REPORT]
+    matrix = PropertyMatrix()
+    site_totals = SiteTotals()
+
+    # The daily store answers the country report, except for its users
+    # unless daily_users: a visitor is counted once for each day, so
+    # those are fetched for each range as before.
+    fetch_reports = reports
+    if daily_store is not None:
+        fetch_reports = []
+        for report in reports:
+            if report.name != COUNTRY_REPORT:
+                fetch_reports.append(report)
+            elif "totalUsers" in report.metrics and not daily_users:
+                fetch_reports.append(Report(
+                    report.name,
+                    report.dimensions,
+                    ["totalUsers"],
+                    report.dimension_filter,
+                    report.date_ranges,
+                ))
 
     if not IS_V3_DEPRECATED:
         for long_name, profile_id in profile_ids.items():
@@ -314,29 +928,354 @@ def get_analytics(account_list, skip_list, start_date, end_date, output_file):
             if results.get("totalResults", 0) > 0:
                 df = create_dataframe(results)
                 logger.debug(df)
-                total = total.add(df, fill_value=0)
-
-    for long_name, prop in properties.items():
-        if long_name in skip_dict:
-            continue
+                total.add(df)
+
+    fetch_list = [
+        (long_name, prop)
+        for long_name, prop in properties.items()
+        if long_name not in skip_dict
+    ]
+
+    # A property is added to the totals only once all of it is in, so
+    # that each one is either counted in full or listed as missing.
+    missing = {}
+    fetched = set()
+    commit_lock = threading.Lock()
+    out_of_time = threading.Event()
+
+    def commit(long_name, prop, frames, prop_site_totals):
+        with commit_lock:
+            if out_of_time.is_set():
+                return False
+            for name, result in frames.items():
+                totals[name].add(result)
+                if name == COUNTRY_REPORT:
+                    matrix.add(long_name, prop, result)
+            if prop_site_totals is not None:
+                site_totals.add(long_name, prop, prop_site_totals)
+            fetched.add(long_name)
+        return True
+
+    # Set below once it's known whether pages get a pool of their own.
+    page_executor: Optional[ThreadPoolExecutor] = None
+
+    def fetch(item):
+        long_name, prop = item
         account_name, site_name = long_name.split(":")
         logger.debug(account_name)
         logger.debug(site_name)
-        results = get_results_v4(prop, start_date, end_date)
-        logger.debug(pformat(results))
-        if results.row_count > 0:
-            df = ga4_response_to_df(results)
-            logger.debug(df)
-            total = total.add(df, fill_value=0)
+        begin = time.perf_counter()
+        try:
+            frames, prop_site_totals, pages = fetch_property(
+                clients,
+                prop,
+                date_ranges,
+                fetch_reports,
+                daily_store,
+                page_executor,
+                jobs,
+                cache,
+                quota,
+                scheduler,
+                retry,
+                daily_users,
+            )
+        except (GoogleAPICallError, BudgetExceeded) as e:
+            logger.error(f"Couldn't fetch {long_name}: {e}")
+            with commit_lock:
+                missing[long_name] = str(e)
+            return
+        if not commit(long_name, prop, frames, prop_site_totals):
+            return
+        if fetch_reports:
+            elapsed = time.perf_counter() - begin
+            logger.info(
+                f"Fetched {long_name} in {elapsed:.2f}s ({pages} page(s))"
+            )
+
+    # Properties are added to the totals as soon as they are fetched;
+    # integer sums don't depend on the order they finish in.  Pages go
+    # on their own pool so property threads never wait on their own pool.
+    begin = time.perf_counter()
+    if queue is not None:
+        run_id = queue.submit(
+            {
+                "date_ranges": date_ranges,
+                "reports": [report.to_config() for report in fetch_reports],
+            },
+            fetch_list,
+        )
+        for job in queue.wait(run_id, retry.remaining()):
+            if job.state == work_queue.FAILED:
+                logger.error(f"Couldn't fetch {job.long_name}: {job.error}")
+                with commit_lock:
+                    missing[job.long_name] = job.error
+                continue
+            result = queue.read_result(job)
+            quota.extend(result["quota"])
+            commit(
+                job.long_name,
+                job.prop,
+                work_queue.decode_frames(result["frames"]),
+                result["site_totals"],
+            )
+        queue.close(run_id)
+    elif jobs > 1:
+        executor = ThreadPoolExecutor(max_workers=jobs)
+        page_executor = ThreadPoolExecutor(max_workers=jobs)
+        futures = [executor.submit(fetch, item) for item in fetch_list]
+        done, _ = wait(futures, timeout=retry.remaining())
+        with commit_lock:
+            out_of_time.set()
+        # Calls still running end by the budget's deadline on their own.
+        executor.shutdown(wait=False, cancel_futures=True)
+        page_executor.shutdown(wait=False, cancel_futures=True)
+        for future in done:
+            future.result()
+    else:
+        page_executor = None
+        for item in fetch_list:
+            remaining = retry.remaining()
+            if remaining is not None and remaining <= 0:
+                break
+            fetch(item)
+    with commit_lock:
+        out_of_time.set()
+        for long_name, _ in fetch_list:
+            if long_name not in fetched and long_name not in missing:
+                missing[long_name] = "run time budget exceeded"
+    logger.info(
+        f"Fetched {len(fetched)} of {len(fetch_list)} properties in "
+        f"{time.perf_counter() - begin:.2f}s with {jobs} job(s)"
+    )
+    if retry.retries or retry.hedged:
+        logger.info(
+            f"Retried {retry.retries} GA4 call(s), hedged {retry.hedged}"
+        )
+    if missing:
+        logger.warning(
+            f"{len(missing)} properties missing from {output_file}:\n"
+            + pformat(missing)
+        )
+
+    logger.info(f"Waited {scheduler.waited:.2f}s in total for GA4 quota")
+
+    if cache is not None:
+        logger.info(
+            f"Report cache: {cache.hits} hit(s), {cache.misses} miss(es)"
+        )
+
+    quota.write(
+        change_ext(output_file, "quota.json"),
+        {prop: long_name for long_name, prop in fetch_list},
+    )
+
+    metadata = {
+        "start_date": start_date,
+        "end_date": end_date,
+        "date_ranges": date_ranges,
+        "properties": sorted(fetched),
+        "missing": missing,
+        "fetched_at": datetime.now().astimezone().isoformat(),
+    }
+    if daily_store is not None and daily_users:
+        logger.warning(
+            "Users summed from daily data count a visitor once per day"
+        )
+        metadata["users_summed_daily"] = True
 
-    total.index = pd.Index([conv_iso_2_to_3(i) for i in total.index])
-    total.index.name = "iso3"
+    for report in reports:
+        if report.name == COUNTRY_REPORT:
+            continue
+        report_total = totals[report.name].result()
+        report_total.columns = pd.Index(
+            [re.sub(r"^ga:", "", col) for col in report_total.columns]
+        )
+        report_total.index.names = [
+            re.sub(r"^ga:", "", name) for name in report_total.index.names
+        ]
+        if report.name == CITY_REPORT:
+            found = city_ref.locate(
+                report_total.index.get_level_values("city"),
+                report_total.index.get_level_values("countryIsoCode"),
+            )
+            report_total["latitude"] = found["latitude"].to_numpy()
+            report_total["longitude"] = found["longitude"].to_numpy()
+        report_file = change_ext(output_file, f"{report.name}.csv")
+        report_total.to_csv(report_file)
+        if parquet:
+            columnar.write(
+                report_total,
+                columnar.parquet_path(report_file),
+                {"report": report.name, **metadata},
+            )
+        logger.info(f"Wrote {report.name} report to {report_file}")
+
+    total = total.result()
+
+    total.index = country_ref.iso2_to_iso3(total.index).rename("iso3")
     total.columns = pd.Index(
         [re.sub(r"^ga:", "", col) for col in total.columns]
     )
-    set_int(total)
+    total = add_change_columns(total, date_ranges)
 
     total.to_csv(output_file)
+    matrix.save(change_ext(output_file, "matrix.npz"))
+    if parquet:
+        columnar.write(
+            total,
+            columnar.parquet_path(output_file),
+            {"report": COUNTRY_REPORT, **metadata},
+        )
+    if totals_dir is not None and len(site_totals) > 0:
+        totals_file = totals_path(
+            totals_dir, account_label(account_list), start_date, end_date
+        )
+        country_report = next(
+            report for report in reports if report.name == COUNTRY_REPORT
+        )
+        site_totals.write(
+            totals_file,
+            start_date,
+            end_date,
+            date_ranges,
+            country_report.metrics,
+            metadata["fetched_at"],
+            missing,
+        )
+        logger.info(
+            f"Wrote site totals of {len(site_totals)} properties "
+            f"to {totals_file}"
+        )
+    if history is not None:
+        history.write(
+            account_label(account_list),
+            start_date,
+            end_date,
+            total,
+            metadata["fetched_at"],
+            missing,
+        )
+
+    return missing
+
+
+def run_worker(
+    queue,
+    clients,
+    jobs=1,
+    cache=None,
+    scheduler=None,
+    retry=None,
+    idle=None,
+):
+    """Fetch the properties queued in queue, a WorkQueue, by coordinators.
+
+    jobs properties are fetched at once, each leased, fetched as in
+    get_analytics() and saved back to queue for the coordinator to
+    merge.  Runs until interrupted, or until idle seconds pass without
+    a job.  Returns the number of properties fetched.
+    """
+    if scheduler is None:
+        scheduler = RequestScheduler()
+    if retry is None:
+        retry = RetryPolicy()
+    page_executor = ThreadPoolExecutor(max_workers=jobs) if jobs > 1 else None
+
+    def fetch(job, params):
+        begin = time.perf_counter()
+        date_ranges = [
+            tuple(date_range) for date_range in params["date_ranges"]
+        ]
+        reports = [Report.from_config(entry) for entry in params["reports"]]
+        # The calls go back with the result for the coordinator's
+        # quota summary.
+        quota = QuotaLog()
+        frames, prop_site_totals, pages = fetch_property(
+            clients,
+            job.prop,
+            date_ranges,
+            reports,
+            page_executor=page_executor,
+            window=jobs,
+            cache=cache,
+            quota=quota,
+            scheduler=scheduler,
+            retry=retry,
+        )
+        logger.info(
+            f"Fetched {job.long_name} in {time.perf_counter() - begin:.2f}s "
+            f"({pages} page(s))"
+        )
+        return {
+            "frames": work_queue.encode_frames(frames),
+            "site_totals": prop_site_totals,
+            "quota": quota.calls,
+        }
+
+    worker = work_queue.default_worker_id()
+    logger.info(f"Worker {worker} fetching from {queue.path}")
+    stop = threading.Event()
+    executor = ThreadPoolExecutor(max_workers=jobs)
+    futures = [
+        executor.submit(
+            work_queue.work,
+            queue,
+            fetch,
+            (GoogleAPICallError, BudgetExceeded),
+            f"{worker}/{i}",
+            idle,
+            stop=stop,
+        )
+        for i in range(jobs)
+    ]
+    try:
+        wait(futures)
+    except KeyboardInterrupt:
+        # Properties being fetched are finished first.
+        stop.set()
+    executor.shutdown()
+    if page_executor is not None:
+        page_executor.shutdown()
+    done = sum(future.result() for future in futures)
+    logger.info(f"Worker {worker} fetched {done} properties")
+    return done
+
+
+def start_local_workers(args):
+    """Start --local-workers processes fetching from the --queue file.
+
+    They are stopped when this process exits.
+    """
+    command = [
+        sys.executable,
+        os.path.realpath(__file__),
+        "--worker",
+        args.queue,
+        "--jobs",
+        str(args.jobs),
+    ]
+    if args.credentials:
+        command += ["--credentials", args.credentials]
+    if args.no_cache:
+        command.append("--no-cache")
+    if args.refresh:
+        command.append("--refresh")
+    if args.hedge:
+        command.append("--hedge")
+    if args.debug:
+        command.append("--debug")
+    workers = [Popen(command) for _ in range(args.local_workers)]
+
+    def stop():
+        for worker in workers:
+            worker.terminate()
+        for worker in workers:
+            worker.wait()
+
+    atexit.register(stop)
+    logger.info(f"Started {len(workers)} local worker(s) on {args.queue}")
+    return workers
 
 
 def change_ext(filename, new_ext):
@@ -345,7 +1284,14 @@ def change_ext(filename, new_ext):
 
 
 def sendmail(
-    mailfrom, mailto, start_date, end_date, url, attachments, use_sendmail=True
+    mailfrom,
+    mailto,
+    start_date,
+    end_date,
+    url,
+    attachments,
+    use_sendmail=True,
+    missing=None,
 ):
     subject = (
         "Google Analytics Choropleth Maps for "
@@ -383,6 +1329,12 @@ def sendmail(
         part["Content-Disposition"] = f"attachment; filename={basename}"
         parts.append(part)
 
+    if missing:
+        body += "Properties missing from these maps:\n"
+        for long_name, reason in sorted(missing.items()):
+            body += f"{long_name}: {reason}\n"
+        body += "\n"
+
     msg.attach(MIMEText(body, "plain", "utf-8"))
     for part in parts:
         msg.attach(part)
@@ -409,17 +1361,193 @@ def validate_qtr(qtr):
     return fiscal_qtr
 
 
+def validate_qtr_range(qtr_range):
+    """Return the quarters of "Q1/2022:Q4/2025", or of a single quarter."""
+    first, _, last = qtr_range.partition(":")
+    first_qtr = validate_qtr(first)
+    last_qtr = validate_qtr(last) if last else first_qtr
+    if last_qtr < first_qtr:
+        raise argparse.ArgumentTypeError(
+            f"Invalid range '{qtr_range}', {last} is before {first}"
+        )
+    quarters = [first_qtr]
+    while quarters[-1] < last_qtr:
+        quarters.append(quarters[-1].next_fiscal_quarter)
+    return quarters
+
+
+def default_output_file(config, account_list, start_date, end_date):
+    return os.path.join(
+        config["output_dir"],
+        f"sessions_{account_label(account_list)}_{start_date}_{end_date}.csv",
+    )
+
+
+def open_stores(args, config):
+    """Return the caches, stores and scheduler for get_analytics()."""
+    cache = None
+    if not args.no_cache:
+        cache = ReportCache(
+            config.get("cache_dir", DEFAULT_CACHE_DIR),
+            config.get("cache_settle_days", DEFAULT_SETTLE_DAYS),
+            refresh=args.refresh,
+        )
+    property_cache = None
+    if not args.no_cache:
+        property_cache = PropertyCache(
+            config.get("cache_dir", DEFAULT_CACHE_DIR),
+            config.get("property_ttl_hours", DEFAULT_TTL_HOURS),
+        )
+    daily_store = None
+    if args.daily:
+        daily_store = DailyStore(
+            config.get("cache_dir", DEFAULT_CACHE_DIR),
+            config.get("cache_settle_days", DEFAULT_SETTLE_DAYS),
+        )
+    scheduler = RequestScheduler(
+        config.get("ga4_max_in_flight", DEFAULT_MAX_IN_FLIGHT),
+        config.get("ga4_tokens_per_hour", PROPERTY_TOKENS_PER_HOUR),
+        config.get("ga4_project_tokens_per_hour"),
+    )
+    retry = RetryPolicy(
+        config.get("ga4_deadline_seconds", DEFAULT_DEADLINE),
+        config.get("ga4_attempts", DEFAULT_ATTEMPTS),
+        hedge=args.hedge,
+    )
+    history = HistoryStore(config.get("history_file", DEFAULT_HISTORY_FILE))
+    totals_dir = config.get("totals_dir", DEFAULT_TOTALS_DIR)
+    queue = None
+    if getattr(args, "queue", None):
+        queue = work_queue.WorkQueue(args.queue)
+    return {
+        "cache": cache,
+        "daily_store": daily_store,
+        "property_cache": property_cache,
+        "scheduler": scheduler,
+        "retry": retry,
+        "history": history,
+        "totals_dir": totals_dir,
+        "queue": queue,
+        "daily_users": getattr(args, "daily_users", False),
+    }
+
+
+def render_maps(output_file):
+    """Plot the maps for a CSV unless they exist; return their files.
+
+    The city report's maps are plotted as well when there is one.
+    """
+    html_file = change_ext(output_file, "html")
+    if not os.path.isfile(html_file):
+        pim.plot_interactive("pageviews", output_file, html_file)
+
+    img_file = change_ext(output_file, "jpg")
+    if not os.path.isfile(img_file):
+        psm.plot_static("pageviews", output_file, img_file)
+
+    file_list = [html_file, img_file]
+
+    city_file = change_ext(output_file, f"{CITY_REPORT}.csv")
+    if os.path.isfile(city_file):
+        html_file = change_ext(city_file, "html")
+        if not os.path.isfile(html_file):
+            pim.plot_interactive_cities("pageviews", city_file, html_file)
+        img_file = change_ext(city_file, "jpg")
+        if not os.path.isfile(img_file):
+            psm.plot_static_cities("pageviews", city_file, img_file)
+        file_list += [html_file, img_file]
+
+    return file_list
+
+
+def run_reports(args, config):
+    """Return the configured reports, with the city report for --city."""
+    reports = load_reports(config.get("reports"))
+    if args.city:
+        reports.append(CITY)
+    return reports
+
+
+def backfill(args, config, quarters):
+    """Write the CSV and maps of every quarter in quarters.
+
+    Properties are discovered once for the whole range.  Quarters are
+    fetched one after another, and each quarter's maps are rendered on
+    a thread of their own while the next quarter is fetched.  Nothing
+    is uploaded or mailed.
+    """
+    output_dir = config["output_dir"]
+    if not (os.path.isdir(output_dir) and os.access(output_dir, os.W_OK)):
+        sys.exit(f"{output_dir} is not a writable directory.")
+    stores = open_stores(args, config)
+    clients = GA4Clients()
+    reports = run_reports(args, config)
+    properties = None
+
+    begin = time.perf_counter()
+    # One render thread, since pyplot isn't safe to use from several.
+    with ThreadPoolExecutor(max_workers=1) as render_executor:
+        renders = []
+        for fiscal_qtr in quarters:
+            start_date = format_date(fiscal_qtr.start)
+            end_date = format_date(fiscal_qtr.end)
+            output_file = default_output_file(
+                config, args.account_list, start_date, end_date
+            )
+            if os.path.isfile(output_file):
+                logger.info(f"Output file {output_file} already exists.")
+            else:
+                if properties is None:
+                    properties = get_properties(
+                        clients,
+                        args.account_list,
+                        stores["property_cache"],
+                        args.refresh_properties,
+                    )
+                logger.info(f"Fetching {fiscal_qtr}")
+                get_analytics(
+                    args.account_list,
+                    config["skip_list"],
+                    start_date,
+                    end_date,
+                    output_file,
+                    jobs=args.jobs,
+                    clients=clients,
+                    compare=not args.no_compare,
+                    reports=reports,
+                    properties=properties,
+                    budget=args.budget,
+                    parquet=args.parquet,
+                    **stores,
+                )
+            renders.append(render_executor.submit(render_maps, output_file))
+        for render in renders:
+            render.result()
+    logger.info(
+        f"Backfilled {len(quarters)} quarters in "
+        f"{time.perf_counter() - begin:.2f}s"
+    )
+
+
+def positive_int(value):
+    try:
+        num = int(value)
+    except ValueError:
+        num = 0
+    if num < 1:
+        raise argparse.ArgumentTypeError(
+            f"Invalid value '{value}', must be a positive integer"
+        )
+    return num
+
+
 def main():
     pd.set_option('display.max_columns', None)
     pd.set_option('display.max_rows', None)
     pd.set_option('display.max_colwidth', None)
     # pd.set_option('display.float_format', '{:,.0f}'.format)
 
-    script_dir = os.path.dirname(os.path.realpath(__file__))
-    config_file = os.path.join(script_dir, "config.yaml")
-    with open(config_file) as f:
-        config = yaml.safe_load(f)
-    config = {k.lstrip(":"): v for k, v in config.items()}
+    config = util.load_config()
 
     fy.setup_fiscal_calendar(start_month=9)
     now = fy.FiscalDateTime.now()
@@ -435,8 +1563,9 @@ def main():
         nargs="?",
         help="Output CSV file")
     parser.add_argument("-f", "--fiscal-qtr",
-        type=validate_qtr,
-        help="Fiscal Quarter, e.g. Q1/2025; Overrides start/end date")
+        type=validate_qtr_range,
+        help="Fiscal Quarter, e.g. Q1/2025, or range of quarters to "
+        "backfill, e.g. Q1/2022:Q4/2025; Overrides start/end date")
     parser.add_argument("-s", "--start-date",
         default=start_date,
         help="Start date")
@@ -446,18 +1575,156 @@ def main():
     parser.add_argument("-a", "--account-list",
         type=lambda arg: arg.split(','),
         help="Comma separated list of ga accounts")
+    parser.add_argument("-j", "--jobs",
+        type=positive_int,
+        default=1,
+        help="Number of properties to fetch concurrently")
+    parser.add_argument("--no-compare",
+        action="store_true",
+        help="Skip the previous period and year over year columns")
+    parser.add_argument("--daily",
+        action="store_true",
+        help="Sync missing days into the daily store and sum the date "
+        "range's sessions and pageviews from it.  Users still cost a call "
+        "per property for each range not in the report cache")
+    parser.add_argument("--daily-users",
+        action="store_true",
+        help="With --daily, sum users from the daily store too, with no "
+        "calls for synced days, counting a visitor once per day visited")
+    parser.add_argument("--refresh-properties",
+        action="store_true",
+        help="Rediscover GA4 properties even if the cached list is fresh")
+    parser.add_argument("--no-cache",
+        action="store_true",
+        help="Don't read or write the GA4 response cache")
+    parser.add_argument("--refresh",
+        action="store_true",
+        help="Refetch cached GA4 responses and update the cache")
+    parser.add_argument("--budget",
+        type=positive_int,
+        help="Seconds allowed for fetching; properties not fetched in "
+        "time are reported as missing")
+    parser.add_argument("--hedge",
+        action="store_true",
+        help="Resend GA4 calls slower than the 95th percentile and use "
+        "whichever answer comes first")
+    parser.add_argument("--parquet",
+        action="store_true",
+        help="Also write each CSV as Parquet with the run's metadata")
+    parser.add_argument("--city",
+        action="store_true",
+        help="Also fetch views by city and map them binned on a grid")
+    parser.add_argument("--realtime",
+        action="store_true",
+        help="Keep a map of active users by country up to date instead "
+        "of reporting; OUTPUT_FILE is the HTML map")
+    parser.add_argument("--interval",
+        type=positive_int,
+        default=realtime.DEFAULT_INTERVAL,
+        help="Seconds between realtime polls")
+    parser.add_argument("--polls",
+        type=positive_int,
+        help="Stop after this many realtime polls")
+    parser.add_argument("--queue",
+        metavar="QUEUE_FILE",
+        help="Have the properties fetched by workers through this "
+        "shared SQLite work queue and merge their results")
+    parser.add_argument("--local-workers",
+        type=positive_int,
+        help="Start this many workers on this machine for --queue")
+    parser.add_argument("--worker",
+        metavar="QUEUE_FILE",
+        help="Fetch properties queued in this work queue until "
+        "interrupted instead of reporting")
+    parser.add_argument("--idle",
+        type=positive_int,
+        help="Stop a --worker after this many seconds without work")
+    parser.add_argument("--credentials",
+        help="GA4 service account key file to use instead of "
+        f"~/.analytics/{GA4_CREDENTIAL_FILE}")
     args = parser.parse_args()
 
+    if args.parquet and not columnar.available():
+        parser.error("--parquet needs pyarrow")
+    if args.local_workers and not args.queue:
+        parser.error("--local-workers needs --queue")
+    if args.queue and args.daily:
+        parser.error("--daily can't be used with --queue")
+    if args.daily_users and not args.daily:
+        parser.error("--daily-users needs --daily")
+
     level = logging.DEBUG if args.debug else logging.INFO
     logger.setLevel(level)
     logging.getLogger("box_links").setLevel(level)
+    logging.getLogger("ga4_clients").setLevel(level)
+    logging.getLogger("report_cache").setLevel(level)
+    logging.getLogger("daily_store").setLevel(level)
+    logging.getLogger("property_cache").setLevel(level)
+    logging.getLogger("quota").setLevel(level)
+    logging.getLogger("scheduler").setLevel(level)
+    logging.getLogger("retry").setLevel(level)
+    logging.getLogger("realtime").setLevel(level)
+    logging.getLogger("work_queue").setLevel(level)
 
     logger.debug(f"config: {pformat(config)}")
     logger.debug(f"command line args: {pformat(args)}")
 
+    if args.credentials:
+        os.environ["GOOGLE_APPLICATION_CREDENTIALS"] = args.credentials
+
+    if args.worker:
+        stores = open_stores(args, config)
+        run_worker(
+            work_queue.WorkQueue(args.worker),
+            GA4Clients(),
+            args.jobs,
+            stores["cache"],
+            stores["scheduler"],
+            stores["retry"],
+            args.idle,
+        )
+        return
+
+    if args.local_workers:
+        start_local_workers(args)
+
+    if args.realtime:
+        html_file = args.output_file or os.path.join(
+            config["output_dir"], "realtime.html"
+        )
+        stores = open_stores(args, config)
+        clients = GA4Clients()
+        properties = get_properties(
+            clients,
+            args.account_list,
+            stores["property_cache"],
+            args.refresh_properties,
+        )
+        properties = {
+            long_name: prop
+            for long_name, prop in properties.items()
+            if long_name not in config["skip_list"]
+        }
+        realtime.run(
+            clients,
+            properties,
+            html_file,
+            args.interval,
+            args.jobs,
+            stores["retry"],
+            args.polls,
+        )
+        return
+
+    if args.fiscal_qtr and len(args.fiscal_qtr) > 1:
+        if args.output_file:
+            parser.error("OUTPUT_FILE can't be given with a range of quarters")
+        backfill(args, config, args.fiscal_qtr)
+        return
+
     if args.fiscal_qtr:
-        start_date = format_date(args.fiscal_qtr.start)
-        end_date = format_date(args.fiscal_qtr.end)
+        start_date = format_date(args.fiscal_qtr[0].start)
+        end_date = format_date(args.fiscal_qtr[0].end)
     else:
         if args.start_date != start_date:
             start_date = parse_reformat_date(args.start_date)
@@ -467,10 +1734,8 @@ def main():
     if args.output_file:
         output_file = args.output_file
     else:
-        account = "-".join(args.account_list) if args.account_list else "all"
-        output_file = os.path.join(
-            config["output_dir"],
-            f"sessions_{account}_{start_date}_{end_date}.csv",
+        output_file = default_output_file(
+            config, args.account_list, start_date, end_date
         )
 
     output_dir = os.path.dirname(output_file)
@@ -480,29 +1745,30 @@ def main():
     logger.debug(f"output_file: {output_file}")
     logger.debug(f"output_dir: {output_dir}")
 
+    missing = None
     if os.path.isfile(output_file):
         print(f"Output file {output_file} already exists.")
     else:
         if not (os.path.isdir(output_dir) and os.access(output_dir, os.W_OK)):
             sys.exit(f"{output_dir} is not a writable directory.")
-        get_analytics(
+        missing = get_analytics(
             args.account_list,
             config["skip_list"],
             start_date,
             end_date,
             output_file,
+            jobs=args.jobs,
+            compare=not args.no_compare,
+            refresh_properties=args.refresh_properties,
+            reports=run_reports(args, config),
+            budget=args.budget,
+            parquet=args.parquet,
+            **open_stores(args, config),
         )
 
-    html_file = change_ext(output_file, "html")
-    if not os.path.isfile(html_file):
-        pim.plot_interactive("pageviews", output_file, html_file)
-
-    img_file = change_ext(output_file, "jpg")
-    if not os.path.isfile(img_file):
-        psm.plot_static("pageviews", output_file, img_file)
+    file_list = render_maps(output_file)
 
     attach = None
-    file_list = [html_file, img_file]
 
     if "box_dir" in config:
         try:
@@ -524,6 +1790,7 @@ def main():
         end_date,
         config["reports_url"],
         attach,
+        missing=missing,
     )
 
 
@@ -19,6 +19,10 @@ IS_V3_DEPRECATED = true
 
 BASEURL = "https://analytics.google.com/analytics/web/"
 
+TOTALS_DIR = File.join(Dir.home, '.analytics', 'totals')
+
+TOTALS_METRICS = %w(sessions totalUsers screenPageViews)
+
 ENV['GOOGLE_APPLICATION_CREDENTIALS'] = File.join(
   Dir.home, '.analytics', 'analytics-ga4.json')
 
@@ -80,7 +84,7 @@ def get_results(property, start_date, end_date)
     date_ranges: [
       { start_date: start_date, end_date: end_date }
     ],
-    metrics: %w(sessions totalUsers screenPageViews).map { |m| { name: m } },
+    metrics: TOTALS_METRICS.map { |m| { name: m } },
     keep_empty_rows: true,
   )
 
@@ -90,6 +94,42 @@ def get_results(property, start_date, end_date)
 end
 
 
+# Returns the site totals analytics-by-location-v4.py saved for the
+# quarter, as { "account:site" => { current: [...], prev: [...] } },
+# or {} if there are none.  See site_totals.py for the file format.
+# The directory is :totals_dir: in config.yaml, or totals_dir: as the
+# Python scripts also accept it.
+def load_site_totals(config)
+  totals_file = File.join(
+    config[:totals_dir] || config['totals_dir'] || TOTALS_DIR,
+    "site_totals_all_#{fmt_date(config[:start])}_" +
+    "#{fmt_date(config[:end])}.json")
+  return {} unless File.exist?(totals_file)
+
+  data = JSON.parse(File.read(totals_file))
+  range_names = {}
+  data['date_ranges'].each do |name, start_date, end_date|
+    range_names[[start_date, end_date]] = name
+  end
+  current = range_names[[fmt_date(config[:start]), fmt_date(config[:end])]]
+  prev = range_names[[fmt_date(config[:prev_start]),
+                      fmt_date(config[:prev_end])]]
+  cols = TOTALS_METRICS.map { |m| data['metrics'].index(m) }
+  if current.nil? || prev.nil? || cols.include?(nil)
+    puts "Site totals in #{totals_file} don't cover the quarter, ignoring"
+    return {}
+  end
+
+  puts "Using site totals in #{totals_file}"
+  data['properties'].transform_values do |entry|
+    {
+      current: cols.map { |i| entry['totals'][current][i] },
+      prev: cols.map { |i| entry['totals'][prev][i] },
+    }
+  end
+end
+
+
 
 ##
 # Ensure valid credentials, either by restoring from the saved credentials
@@ -177,6 +217,8 @@ def get_analytics(service, profiles, properties, config)
 
   skip_list = config[:skip_list].to_h { |name| [name, 1] }
 
+  site_totals = load_site_totals(config)
+
   names.each do |name|
     if skip_list.key?(name)
       puts "Skipping #{name} ..."
@@ -226,7 +268,6 @@ def get_analytics(service, profiles, properties, config)
     if properties.key?(name)
       property = properties[name]
       prefix, prop_num = property.split("/")
-      puts "Querying GA4 property: #{name} #{property}"
 
       query =  "_u.date00=#{fmt_date_qry(config[:start])}" +
                "&_u.date01=#{fmt_date_qry(config[:end])}"
@@ -236,25 +277,33 @@ def get_analytics(service, profiles, properties, config)
                "#/p#{prop_num}/reports/reportinghub?params=" +
                CGI.escape(query)
 
-      prev_result_row =
-        sum_array(
-          prev_result_row,
-          get_results(
-            property,
-            fmt_date(config[:prev_start]),
-            fmt_date(config[:prev_end])
+      if site_totals.key?(name)
+        puts "Using saved totals of GA4 property: #{name} #{property}"
+        prev_result_row = sum_array(prev_result_row, site_totals[name][:prev])
+        result_row = sum_array(result_row, site_totals[name][:current])
+      else
+        puts "Querying GA4 property: #{name} #{property}"
+
+        prev_result_row =
+          sum_array(
+            prev_result_row,
+            get_results(
+              property,
+              fmt_date(config[:prev_start]),
+              fmt_date(config[:prev_end])
+            )
           )
-        )
-
-      result_row =
-        sum_array(
-          result_row,
-          get_results(
-            property,
-            fmt_date(config[:start]),
-            fmt_date(config[:end])
+
+        result_row =
+          sum_array(
+            result_row,
+            get_results(
+              property,
+              fmt_date(config[:start]),
+              fmt_date(config[:end])
+            )
           )
-        )
+      end
     end
 
     csv_row = []
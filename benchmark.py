@@ -0,0 +1,645 @@
+#!/usr/bin/env python3
+#
+# Offline micro-benchmarks for the GA4 location report.
+
+from aggregate import CountryAccumulator
+from fake_ga4 import FakeAdminClient, FakeDataClient
+from ga4_clients import GA4Clients
+from retry import RetryPolicy
+from google.analytics.data_v1beta.types import (
+    DimensionHeader,
+    DimensionValue,
+    MetricHeader,
+    MetricValue,
+    Row,
+    RunReportResponse,
+)
+import argparse
+import country_ref
+import geometry_cache
+import importlib
+import logging
+import multiprocessing
+import numpy as np
+import os
+import pandas as pd
+import plot_interactive_map as pim
+import plot_static_map as psm
+import random
+import realtime
+import resource
+import shapely
+import sys
+import tempfile
+import time
+import tracemalloc
+import work_queue
+
+script_dir = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, script_dir)
+report = importlib.import_module("analytics-by-location-v4")
+
+
+def legacy_ga4_response_to_df(response):
+    """ga4_response_to_df() as it was before the columnar rewrite."""
+    dim_len = len(response.dimension_headers)
+    metric_len = len(response.metric_headers)
+    all_data = []
+    for row in response.rows:
+        row_data = {}
+        for i in range(0, dim_len):
+            row_data.update(
+                {
+                    report.DIMENSIONS[
+                        response.dimension_headers[i].name
+                    ]: row.dimension_values[i].value
+                }
+            )
+        for i in range(0, metric_len):
+            row_data.update(
+                {
+                    report.METRICS[
+                        response.metric_headers[i].name
+                    ]: row.metric_values[i].value
+                }
+            )
+        all_data.append(row_data)
+    df = pd.DataFrame(all_data)
+    df.loc[df["ga:countryIsoCode"] == "(not set)", "ga:countryIsoCode"] = "ZZ"
+    if "dateRange" not in df.columns:
+        df = df.set_index("ga:countryIsoCode")
+        report.set_int(df)
+        return df
+    df = df.set_index(["ga:countryIsoCode", "dateRange"])
+    report.set_int(df)
+    df = df.unstack("dateRange", fill_value=0)
+    df.columns = pd.Index(
+        [
+            metric if name == report.CURRENT_RANGE else f"{metric}_{name}"
+            for metric, name in df.columns
+        ]
+    )
+    return df
+
+
+def make_response(num_rows, date_ranges, seed=0):
+    """Build a synthetic countryId (x dateRange) runReport response.
+
+    Country codes are made up so that any number of rows is unique.
+    """
+    rnd = random.Random(seed)
+    names = [name for name, _, _ in date_ranges]
+    per_range = max(1, num_rows // len(names))
+    rows = []
+    for name in names:
+        for i in range(per_range):
+            dims = ["(not set)" if i == 0 else f"C{i:06d}"]
+            if len(names) > 1:
+                dims.append(name)
+            rows.append(
+                Row(
+                    dimension_values=[DimensionValue(value=v) for v in dims],
+                    metric_values=[
+                        MetricValue(value=str(rnd.randint(0, 100000)))
+                        for _ in report.METRICS
+                    ],
+                )
+            )
+    dim_headers = [DimensionHeader(name="countryId")]
+    if len(names) > 1:
+        dim_headers.append(DimensionHeader(name="dateRange"))
+    return RunReportResponse(
+        dimension_headers=dim_headers,
+        metric_headers=[MetricHeader(name=name) for name in report.METRICS],
+        rows=rows,
+        row_count=len(rows),
+    )
+
+
+def time_call(func, *args, repeat=3):
+    """Return the best wall time of repeat calls and the last result."""
+    best = None
+    for _ in range(repeat):
+        begin = time.perf_counter()
+        result = func(*args)
+        elapsed = time.perf_counter() - begin
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def bench_convert(args):
+    date_ranges = report.get_date_ranges(
+        "2025-01-01", "2025-03-31", not args.single_range
+    )
+    print(f"{'rows':>10} {'legacy rows/s':>15} {'columnar rows/s':>17} "
+          f"{'speedup':>8}")
+    for num_rows in args.rows:
+        response = make_response(num_rows, date_ranges)
+        count = len(response.rows)
+        old_time, old_df = time_call(legacy_ga4_response_to_df, response)
+        new_time, new_df = time_call(report.ga4_response_to_df, response)
+        pd.testing.assert_frame_equal(old_df, new_df)
+        print(f"{count:>10} {count / old_time:>15,.0f} "
+              f"{count / new_time:>17,.0f} {old_time / new_time:>7.1f}x")
+
+
+def make_property_frames(num_props, num_countries=250, seed=0):
+    """Build per-property frames like the fetch produces.
+
+    Each property sees a random subset of countries, skewed so a few
+    properties see most of them and most see only a handful.
+    """
+    rnd = np.random.default_rng(seed)
+    countries = np.array([f"C{i:03d}" for i in range(num_countries)])
+    date_ranges = report.get_date_ranges("2025-01-01", "2025-03-31")
+    columns = [
+        metric if name == report.CURRENT_RANGE else f"{metric}_{name}"
+        for metric in report.METRICS.values()
+        for name, _, _ in date_ranges
+    ]
+    frames = []
+    for _ in range(num_props):
+        size = min(num_countries, 1 + int(rnd.pareto(1.0) * 10))
+        index = rnd.choice(countries, size=size, replace=False)
+        values = rnd.integers(0, 100000, size=(size, len(columns)))
+        frames.append(
+            pd.DataFrame(
+                values,
+                index=pd.Index(index, name="ga:countryIsoCode"),
+                columns=columns,
+            )
+        )
+    return frames
+
+
+def legacy_sum(frames):
+    total = pd.DataFrame()
+    for df in frames:
+        total = total.add(df, fill_value=0)
+    report.set_int(total)
+    return total
+
+
+def accumulator_sum(frames):
+    total = CountryAccumulator()
+    for df in frames:
+        total.add(df)
+    return total.result()
+
+
+def bench_aggregate(args):
+    print(f"{'properties':>10} {'DataFrame.add s':>16} {'accumulator s':>14} "
+          f"{'speedup':>8}")
+    for num_props in args.properties:
+        frames = make_property_frames(num_props)
+        old_time, old_df = time_call(legacy_sum, frames, repeat=1)
+        new_time, new_df = time_call(accumulator_sum, frames, repeat=1)
+        pd.testing.assert_frame_equal(old_df, new_df, check_names=False)
+        print(f"{num_props:>10} {old_time:>16.3f} {new_time:>14.3f} "
+              f"{old_time / new_time:>7.1f}x")
+
+
+def run_scale(num_props, args):
+    """Run get_analytics() against the fakes.
+
+    Meant to run in a fresh process, so that the peak resident memory
+    is this run's.  Returns the wall time, API calls, rows fetched,
+    missing properties and peak resident memory before and after the
+    run in KiB.
+    """
+    report.logger.setLevel(logging.WARNING)
+    logging.getLogger("quota").setLevel(logging.WARNING)
+    base_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    admin = FakeAdminClient(num_properties=num_props)
+    data = FakeDataClient(
+        latency=args.latency,
+        error_rate=args.error_rate,
+        slow_rate=args.slow_rate,
+    )
+    clients = GA4Clients(data_client=data, admin_client=admin)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        output_file = os.path.join(
+            tmp_dir, "sessions_all_2025-01-01_2025-03-31.csv"
+        )
+        begin = time.perf_counter()
+        missing = report.get_analytics(
+            None,
+            [],
+            "2025-01-01",
+            "2025-03-31",
+            output_file,
+            jobs=args.jobs,
+            clients=clients,
+            compare=not args.no_compare,
+            retry=RetryPolicy(args.deadline, hedge=args.hedge),
+            budget=args.budget,
+        )
+        elapsed = time.perf_counter() - begin
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    calls = admin.calls + data.calls
+    return elapsed, calls, data.rows, len(missing), base_rss, peak_rss
+
+
+def bench_scale(args):
+    print(f"{'properties':>10} {'wall s':>8} {'API calls':>10} "
+          f"{'rows':>10} {'missing':>8} {'peak RSS MiB':>13} "
+          f"{'growth MiB':>11}")
+    context = multiprocessing.get_context("spawn")
+    for num_props in args.properties:
+        with context.Pool(1) as pool:
+            elapsed, calls, rows, missing, base_rss, peak_rss = pool.apply(
+                run_scale, (num_props, args)
+            )
+        print(f"{num_props:>10} {elapsed:>8.2f} {calls:>10} {rows:>10} "
+              f"{missing:>8} {peak_rss / 1024:>13.1f} "
+              f"{(peak_rss - base_rss) / 1024:>11.1f}")
+
+
+def make_city_report(num_points, seed=0):
+    """Return a city report frame of num_points points around real
+    cities, with Pareto distributed pageviews.
+    """
+    from geonamescache import GeonamesCache
+
+    rnd = np.random.default_rng(seed)
+    cities = pd.DataFrame(GeonamesCache().get_cities().values())
+    picks = cities.iloc[rnd.integers(0, len(cities), size=num_points)]
+    return pd.DataFrame({
+        "cityId": np.arange(num_points),
+        "city": picks["name"].to_numpy(),
+        "pageviews": (rnd.pareto(1.0, size=num_points) * 10).astype(int) + 1,
+        "latitude": picks["latitude"].to_numpy()
+        + rnd.normal(0, 0.2, size=num_points),
+        "longitude": picks["longitude"].to_numpy()
+        + rnd.normal(0, 0.2, size=num_points),
+    })
+
+
+def bench_city_maps(args):
+    print(f"{'points':>10} {'static s':>9} {'interactive s':>14}")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        for num_points in args.points:
+            csv_file = os.path.join(
+                tmp_dir, "sessions_all_2025-01-01_2025-03-31.city.csv"
+            )
+            make_city_report(num_points).to_csv(csv_file, index=False)
+            begin = time.perf_counter()
+            psm.plot_static_cities(
+                "pageviews", csv_file, os.path.join(tmp_dir, "city.jpg")
+            )
+            static_time = time.perf_counter() - begin
+            begin = time.perf_counter()
+            pim.plot_interactive_cities(
+                "pageviews", csv_file, os.path.join(tmp_dir, "city.html")
+            )
+            interactive_time = time.perf_counter() - begin
+            print(f"{num_points:>10} {static_time:>9.2f} "
+                  f"{interactive_time:>14.2f}")
+
+
+def bench_realtime(args):
+    print(f"{'properties':>10} {'polls':>6} {'p50 s':>7} {'p95 s':>7} "
+          f"{'max s':>7}")
+    for num_props in args.properties:
+        admin = FakeAdminClient(num_properties=num_props)
+        data = FakeDataClient(latency=args.latency)
+        clients = GA4Clients(data_client=data, admin_client=admin)
+        properties = report.discover_properties(clients)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            html_file = args.output or os.path.join(tmp_dir, "realtime.html")
+            latency = realtime.run(
+                clients,
+                properties,
+                html_file,
+                interval=args.interval,
+                jobs=args.jobs,
+                polls=args.polls,
+            )
+        print(f"{num_props:>10} {args.polls:>6} "
+              f"{latency.percentile(0.5):>7.3f} "
+              f"{latency.percentile(0.95):>7.3f} "
+              f"{max(latency.latencies):>7.3f}")
+
+
+def run_geometry_level(csv_file, img_file, width, dpi, full_detail):
+    """Plot csv_file with plot_static() at one size.
+
+    Meant to run in a fresh process, like run_scale().  Returns the
+    shapefile and tolerance used, the vertices drawn, the seconds to
+    load the map units and to plot, the peak resident memory in KiB
+    and the peak memory traced while loading and plotting again in
+    bytes.  The imports alone take most of the resident memory, hence
+    the traced peak.
+    """
+    figsize = (width, width * 10 / 16)
+    pixel = None if full_detail else geometry_cache.pixel_size(figsize, dpi)
+    source, tolerance = geometry_cache.choose_level(pixel)
+    load_time, ne_data = time_call(
+        geometry_cache.read_map_units, [], geometry_cache.SHAPEFILE,
+        geometry_cache.PROJECTION, geometry_cache.DEFAULT_CACHE_DIR, pixel,
+        repeat=1,
+    )
+    vertices = int(shapely.get_num_coordinates(ne_data.geometry.values).sum())
+    del ne_data
+    begin = time.perf_counter()
+    psm.plot_static(
+        "pageviews", csv_file, img_file, width=width, dpi=dpi,
+        full_detail=full_detail,
+    )
+    plot_time = time.perf_counter() - begin
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    tracemalloc.start()
+    psm.plot_static(
+        "pageviews", csv_file, img_file, width=width, dpi=dpi,
+        full_detail=full_detail,
+    )
+    _, traced = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return (os.path.basename(source), tolerance, vertices, load_time,
+            plot_time, peak_rss, traced)
+
+
+def bench_geometry(args):
+    """Time reading the map units with and without the cache, then
+    plot_static() at each size with its geometry level and in full.
+    """
+    columns = ["iso3", "NAME", "label_x", "label_y", "area"]
+    shapefile = geometry_cache.SHAPEFILE
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        begin = time.perf_counter()
+        geometry_cache.read_map_units(columns, shapefile, cache_dir=tmp_dir)
+        cold = time.perf_counter() - begin
+        warm, _ = time_call(
+            geometry_cache.read_map_units, columns, shapefile,
+            geometry_cache.PROJECTION, tmp_dir,
+        )
+    print(f"{'shapefile s':>12} {'cached s':>9} {'speedup':>8}")
+    print(f"{cold:>12.3f} {warm:>9.3f} {cold / warm:>7.1f}x")
+    print()
+
+    print(f"{'size':>10} {'detail':>7} {'source':>32} {'tolerance':>10} "
+          f"{'vertices':>9} {'load s':>7} {'plot s':>7} "
+          f"{'peak RSS MiB':>13} {'traced MiB':>11}")
+    rnd = np.random.default_rng(0)
+    ref = country_ref.load()
+    context = multiprocessing.get_context("spawn")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        csv_file = os.path.join(
+            tmp_dir, "sessions_all_2025-01-01_2025-03-31.csv"
+        )
+        pd.DataFrame(
+            {"pageviews": rnd.integers(1, 100000, size=len(ref))},
+            index=pd.Index(ref["iso3"], name="iso3"),
+        ).to_csv(csv_file)
+        for width, dpi in args.sizes:
+            for full_detail in (False, True):
+                # Build this level's cache first so that only loading
+                # it is timed.
+                pixel = None
+                if not full_detail:
+                    pixel = geometry_cache.pixel_size((width, width), dpi)
+                geometry_cache.read_map_units([], pixel=pixel)
+                img_file = os.path.join(tmp_dir, f"{width}x{dpi}.jpg")
+                with context.Pool(1) as pool:
+                    result = pool.apply(
+                        run_geometry_level,
+                        (csv_file, img_file, width, dpi, full_detail),
+                    )
+                (source, tolerance, vertices, load_time, plot_time,
+                 peak_rss, traced) = result
+                print(f"{f'{width:g}in@{dpi}':>10} "
+                      f"{'full' if full_detail else 'level':>7} "
+                      f"{source:>32} {tolerance:>10.0f} {vertices:>9} "
+                      f"{load_time:>7.3f} {plot_time:>7.2f} "
+                      f"{peak_rss / 1024:>13.1f} "
+                      f"{traced / 2 ** 20:>11.1f}")
+
+
+def run_fake_worker(queue_file, args):
+    """Work the queue with fake clients until it has been idle for
+    args.idle seconds; return the number of properties fetched.
+    """
+    report.logger.setLevel(logging.WARNING)
+    data = FakeDataClient(latency=args.latency, error_rate=args.error_rate)
+    clients = GA4Clients(data_client=data, admin_client=FakeAdminClient())
+    return report.run_worker(
+        work_queue.WorkQueue(queue_file),
+        clients,
+        jobs=args.jobs,
+        retry=RetryPolicy(args.deadline),
+        idle=args.idle,
+    )
+
+
+def bench_distributed(args):
+    """Run get_analytics() as a coordinator with local worker processes
+    and check the CSV against a run without the queue.
+    """
+    report.logger.setLevel(logging.WARNING)
+    logging.getLogger("quota").setLevel(logging.WARNING)
+    logging.getLogger("work_queue").setLevel(logging.WARNING)
+    print(f"{'workers':>8} {'wall s':>8} {'fetched':>8} {'missing':>8} "
+          f"{'same CSV':>9}")
+    context = multiprocessing.get_context("spawn")
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        csv_name = "sessions_all_2025-01-01_2025-03-31.csv"
+        clients = GA4Clients(
+            data_client=FakeDataClient(latency=args.latency),
+            admin_client=FakeAdminClient(num_properties=args.properties),
+        )
+        expected_file = os.path.join(tmp_dir, csv_name)
+        report.get_analytics(
+            None,
+            [],
+            "2025-01-01",
+            "2025-03-31",
+            expected_file,
+            jobs=args.jobs,
+            clients=clients,
+        )
+        expected = pd.read_csv(expected_file, index_col=0)
+        for num_workers in args.workers:
+            run_dir = os.path.join(tmp_dir, str(num_workers))
+            os.makedirs(run_dir)
+            queue_file = os.path.join(run_dir, "queue.sqlite")
+            queue = work_queue.WorkQueue(queue_file)
+            output_file = os.path.join(run_dir, csv_name)
+            with context.Pool(num_workers) as pool:
+                workers = [
+                    pool.apply_async(run_fake_worker, (queue_file, args))
+                    for _ in range(num_workers)
+                ]
+                begin = time.perf_counter()
+                missing = report.get_analytics(
+                    None,
+                    [],
+                    "2025-01-01",
+                    "2025-03-31",
+                    output_file,
+                    clients=clients,
+                    queue=queue,
+                    budget=args.budget,
+                )
+                elapsed = time.perf_counter() - begin
+                fetched = sum(worker.get() for worker in workers)
+            same = expected.equals(pd.read_csv(output_file, index_col=0))
+            print(f"{num_workers:>8} {elapsed:>8.2f} {fetched:>8} "
+                  f"{len(missing):>8} {str(same):>9}")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description="Offline benchmarks for the GA4 location report.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    convert = subparsers.add_parser("convert",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        help="Compare ga4_response_to_df() against the row-wise version")
+    convert.add_argument("--rows",
+        type=lambda arg: [int(n) for n in arg.split(",")],
+        default=[250, 10000, 100000],
+        help="Comma separated response sizes in rows")
+    convert.add_argument("--single-range",
+        action="store_true",
+        help="Benchmark responses without the comparison date ranges")
+    convert.set_defaults(func=bench_convert)
+
+    aggregate = subparsers.add_parser("aggregate",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        help="Compare CountryAccumulator against repeated DataFrame.add")
+    aggregate.add_argument("--properties",
+        type=lambda arg: [int(n) for n in arg.split(",")],
+        default=[100, 1000, 10000],
+        help="Comma separated property counts")
+    aggregate.set_defaults(func=bench_aggregate)
+
+    scale = subparsers.add_parser("scale",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        help="Run get_analytics() end to end against the fake GA4 clients")
+    scale.add_argument("--properties",
+        type=lambda arg: [int(n) for n in arg.split(",")],
+        default=[10, 100, 1000],
+        help="Comma separated property counts")
+    scale.add_argument("-j", "--jobs",
+        type=int,
+        default=8,
+        help="Number of properties to fetch concurrently")
+    scale.add_argument("--latency",
+        type=float,
+        default=0.05,
+        help="Mean seconds per fake API call")
+    scale.add_argument("--error-rate",
+        type=float,
+        default=0.0,
+        help="Chance that a fake API call fails")
+    scale.add_argument("--slow-rate",
+        type=float,
+        default=0.0,
+        help="Chance that a fake API call is twenty times slower")
+    scale.add_argument("--deadline",
+        type=float,
+        default=60.0,
+        help="Seconds allowed for each API call")
+    scale.add_argument("--hedge",
+        action="store_true",
+        help="Resend calls slower than the 95th percentile")
+    scale.add_argument("--budget",
+        type=float,
+        help="Seconds allowed for the whole fetch")
+    scale.add_argument("--no-compare",
+        action="store_true",
+        help="Fetch without the comparison date ranges")
+    scale.set_defaults(func=bench_scale)
+
+    city_maps = subparsers.add_parser("city-maps",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        help="Time the binned city maps")
+    city_maps.add_argument("--points",
+        type=lambda arg: [int(n) for n in arg.split(",")],
+        default=[10000, 100000, 500000],
+        help="Comma separated numbers of cities")
+    city_maps.set_defaults(func=bench_city_maps)
+
+    live = subparsers.add_parser("realtime",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        help="Time realtime polls from the fake GA4 clients to the map")
+    live.add_argument("--properties",
+        type=lambda arg: [int(n) for n in arg.split(",")],
+        default=[10, 100],
+        help="Comma separated property counts")
+    live.add_argument("-j", "--jobs",
+        type=int,
+        default=8,
+        help="Number of properties to poll concurrently")
+    live.add_argument("--latency",
+        type=float,
+        default=0.05,
+        help="Mean seconds per fake API call")
+    live.add_argument("--polls",
+        type=int,
+        default=5,
+        help="Polls per property count")
+    live.add_argument("--interval",
+        type=float,
+        default=1.0,
+        help="Seconds between polls")
+    live.add_argument("-o", "--output",
+        help="Keep the map in this HTML file")
+    live.set_defaults(func=bench_realtime)
+
+    distributed = subparsers.add_parser("distributed",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        help="Fetch through the work queue with local worker processes")
+    distributed.add_argument("--properties",
+        type=int,
+        default=100,
+        help="Number of properties")
+    distributed.add_argument("--workers",
+        type=lambda arg: [int(n) for n in arg.split(",")],
+        default=[1, 2, 4],
+        help="Comma separated numbers of worker processes")
+    distributed.add_argument("-j", "--jobs",
+        type=int,
+        default=4,
+        help="Number of properties each worker fetches concurrently")
+    distributed.add_argument("--latency",
+        type=float,
+        default=0.05,
+        help="Mean seconds per fake API call")
+    distributed.add_argument("--error-rate",
+        type=float,
+        default=0.0,
+        help="Chance that a fake API call fails")
+    distributed.add_argument("--deadline",
+        type=float,
+        default=60.0,
+        help="Seconds allowed for each API call")
+    distributed.add_argument("--budget",
+        type=float,
+        help="Seconds allowed for the whole fetch")
+    distributed.add_argument("--idle",
+        type=float,
+        default=2.0,
+        help="Seconds a worker waits for work before stopping")
+    distributed.set_defaults(func=bench_distributed)
+
+    geometry = subparsers.add_parser("geometry",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        help="Time the projected map units and the static map at each "
+        "geometry level")
+    geometry.add_argument("--sizes",
+        type=lambda arg: [
+            (float(size.split("x")[0]), int(size.split("x")[1]))
+            for size in arg.split(",")
+        ],
+        default=[(4.0, 72), (8.0, 100), (16.0, 150), (16.0, 600)],
+        help="Comma separated image sizes as WIDTHxDPI, width in inches")
+    geometry.set_defaults(func=bench_geometry)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
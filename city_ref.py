@@ -0,0 +1,73 @@
+"""
+city_ref.py — City coordinates for the city-level report.
+
+GA4 reports a city's name, its country and a numeric cityId, but no
+coordinates.  The GeoNames cities in geonamescache, about 34,000 with
+a population of 15,000 or more, are turned once into a table keyed on
+(alpha-2 country, casefolded name), from the city's own name and its
+alternate names, so a report of tens of thousands of cities is located
+with one join rather than a search per city.  Where names collide the
+city's own name beats an alternate name, then the bigger city wins.
+
+Cities that aren't found, such as "(not set)" and smaller towns, keep
+NaN coordinates and are left off the maps.
+"""
+
+import functools
+import logging
+
+import numpy as np
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+COLUMNS = ["geonameid", "latitude", "longitude", "population"]
+
+
+@functools.lru_cache(maxsize=None)
+def load() -> pd.DataFrame:
+    """Return the city table indexed by (country, casefolded name)."""
+    from geonamescache import GeonamesCache
+
+    rows = []
+    for city in GeonamesCache().get_cities().values():
+        # Alternate names rank below the city's own name.
+        names = [(city["name"], 0)] + [
+            (name, 1) for name in city["alternatenames"]
+        ]
+        for name, rank in names:
+            rows.append((
+                city["countrycode"],
+                name.casefold(),
+                rank,
+                city["geonameid"],
+                city["latitude"],
+                city["longitude"],
+                city["population"],
+            ))
+    df = pd.DataFrame(
+        rows, columns=["country", "name", "rank"] + COLUMNS
+    )
+    df = df.sort_values(
+        ["rank", "population"], ascending=[True, False], kind="stable"
+    )
+    df = df.drop_duplicates(["country", "name"]).drop(columns="rank")
+    return df.set_index(["country", "name"]).sort_index()
+
+
+def locate(cities: pd.Series, countries: pd.Series) -> pd.DataFrame:
+    """Return the coordinates of cities in the given alpha-2 countries.
+
+    The result has a row for every city, in order, with the columns
+    of COLUMNS; cities not found are NaN.
+    """
+    table = load()
+    keys = pd.MultiIndex.from_arrays(
+        [np.asarray(countries), pd.Series(cities).str.casefold().to_numpy()]
+    )
+    found = table.reindex(keys)
+    found.index = pd.Series(cities).index
+    missing = found["latitude"].isna().sum()
+    if missing:
+        logger.info(f"No coordinates for {missing} of {len(found)} cities")
+    return found
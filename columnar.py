@@ -0,0 +1,97 @@
+"""
+columnar.py — Typed Parquet copies of the location report CSVs.
+
+The CSV stays for the people it is mailed to, but reading it back
+means parsing text and guessing column types again.  With --parquet
+each CSV also gets a Parquet file next to it, e.g. sessions_all_
+2025-01-01_2025-03-31.parquet, holding the same frame with its index
+and integer types.  Information about the run that produced it, such as
+the date ranges, the properties included and missing, and when it was
+fetched, is stored as JSON in the schema metadata.
+
+The maps read results with read_results(), which uses the Parquet
+file when it is at least as new as the CSV and only reads the columns
+asked for.  pyarrow is optional; without it everything falls back to
+the CSV.  read_results() can also be pointed at the history store,
+which has every period written so far.
+"""
+
+import json
+import os
+from typing import Any, Dict, List, Optional, cast
+
+import pandas as pd
+
+from history import HistoryStore
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+METADATA_KEY = b"analytics_reporter"
+
+
+def available() -> bool:
+    """Return True if pyarrow is installed."""
+    return pq is not None
+
+
+def parquet_path(csv_file: str) -> str:
+    return os.path.splitext(csv_file)[0] + ".parquet"
+
+
+def write(df: pd.DataFrame, path: str, metadata: Dict[str, Any]) -> None:
+    """Write df and the run's metadata to a Parquet file."""
+    table = pa.Table.from_pandas(df, preserve_index=True)
+    schema_metadata = dict(table.schema.metadata or {})
+    schema_metadata[METADATA_KEY] = json.dumps(metadata).encode("utf-8")
+    table = table.replace_schema_metadata(schema_metadata)
+    tmp_path = f"{path}.tmp"
+    pq.write_table(table, tmp_path)
+    os.replace(tmp_path, path)
+
+
+def read_metadata(path: str) -> Dict[str, Any]:
+    """Return the run metadata stored in a Parquet file."""
+    metadata = pq.read_schema(path).metadata or {}
+    if METADATA_KEY not in metadata:
+        return {}
+    return cast(Dict[str, Any], json.loads(metadata[METADATA_KEY]))
+
+
+def read_results(
+    csv_file: str,
+    columns: Optional[List[str]] = None,
+    history: Optional[str] = None,
+) -> pd.DataFrame:
+    """Return the frame behind csv_file, indexed like when written.
+
+    Reads the Parquet copy when there is an up to date one, otherwise
+    the CSV.  Given history, the path of a history store, the period
+    named by csv_file is read from the store instead and the file need
+    not exist.  columns limits the columns read besides the index.
+    """
+    if history is not None:
+        df = HistoryStore(history).read_csv_period(csv_file)
+        return df if columns is None else df[columns]
+    path = parquet_path(csv_file)
+    if (
+        available()
+        and os.path.isfile(path)
+        and (
+            not os.path.isfile(csv_file)
+            or os.path.getmtime(path) >= os.path.getmtime(csv_file)
+        )
+    ):
+        return pq.read_table(
+            path, columns=columns, use_pandas_metadata=True
+        ).to_pandas()
+    if columns is None:
+        return pd.read_csv(csv_file, index_col=0)
+    index_col = pd.read_csv(csv_file, nrows=0).columns[0]
+    return pd.read_csv(
+        csv_file, usecols=[index_col] + columns, index_col=index_col
+    )
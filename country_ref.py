@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+"""
+country_ref.py — Country reference table shared by the report and maps.
+
+The GA4 fetch reports ISO 3166 alpha-2 codes, the CSV and the plotly
+map use alpha-3 codes and names, and the Natural Earth shapefile keys
+its shapes on ISO_A3, which is "-99" for a few map units.  Rather than
+each module loading geonamescache or pycountry and converting one code
+at a time, the mappings are built once into countries.csv next to this
+file and looked up a whole index at a time.
+
+Columns of countries.csv:
+
+    iso2    ISO alpha-2 code as reported by GA4, "ZZ" for "(not set)",
+            empty for Natural Earth only rows
+    iso3    ISO alpha-3 code, "ZZZ" for "(not set)"
+    name    Display name
+    ne_a3   Natural Earth ADM0_A3 code for the country
+
+Rebuild it after upgrading geonamescache or pycountry with
+
+    ./country_ref.py --build
+"""
+
+import argparse
+import functools
+import logging
+import os
+from typing import Dict, Iterable
+
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+REF_FILE = os.path.join(
+    os.path.dirname(os.path.realpath(__file__)), "countries.csv"
+)
+
+NOT_SET = ("ZZ", "ZZZ", "(not set)")
+
+# Countries whose Natural Earth ADM0_A3 isn't their alpha-3 code.
+NE_A3 = {
+    "XKX": "KOS",
+}
+
+# Natural Earth map units with ISO_A3 "-99" and no country of their
+# own in GA4, which reports them under the alpha-3 code given here.
+NE_EXTRA = {
+    "SOL": "SOM",
+    "CYN": "CYP",
+}
+
+
+def build() -> pd.DataFrame:
+    """Build the table from geonamescache and pycountry."""
+    from geonamescache import GeonamesCache
+    import pycountry
+
+    names = {c.alpha_3: c.name for c in pycountry.countries}
+    rows = []
+    for iso2, info in sorted(GeonamesCache().get_countries().items()):
+        iso3 = info["iso3"]
+        name = names.get(iso3, info["name"])
+        rows.append((iso2, iso3, name, NE_A3.get(iso3, iso3)))
+        names[iso3] = name
+    rows.append(NOT_SET + ("",))
+    for ne_a3, iso3 in NE_EXTRA.items():
+        rows.append(("", iso3, names[iso3], ne_a3))
+    return pd.DataFrame(rows, columns=["iso2", "iso3", "name", "ne_a3"])
+
+
+@functools.lru_cache(maxsize=None)
+def load(path: str = REF_FILE) -> pd.DataFrame:
+    """Return the reference table, read once per process."""
+    # keep_default_na=False so Namibia's "NA" stays a country code.
+    return pd.read_csv(path, dtype=str, keep_default_na=False)
+
+
+@functools.lru_cache(maxsize=None)
+def _iso2_to_iso3() -> Dict[str, str]:
+    ref = load()
+    ref = ref[ref["iso2"] != ""]
+    return dict(zip(ref["iso2"], ref["iso3"]))
+
+
+@functools.lru_cache(maxsize=None)
+def _ne_to_iso3() -> Dict[str, str]:
+    ref = load()
+    ref = ref[ref["ne_a3"] != ""]
+    return dict(zip(ref["ne_a3"], ref["iso3"]))
+
+
+def iso2_to_iso3(codes: Iterable[str]) -> pd.Index:
+    """Map alpha-2 codes to alpha-3; unknown codes are kept as is."""
+    index = pd.Index(codes)
+    iso3 = index.map(_iso2_to_iso3())
+    unknown = iso3.isna()
+    if unknown.any():
+        logger.warning(f"Unknown country codes: {list(index[unknown])}")
+        iso3 = iso3.where(~unknown, index)
+    return iso3
+
+
+def names() -> pd.Series:
+    """Return country names indexed by alpha-3 code."""
+    ref = load()
+    ref = ref[ref["iso2"] != ""]
+    index = pd.Index(ref["iso3"], name="iso3")
+    return pd.Series(ref["name"].to_numpy(), index=index, name="name")
+
+
+def ne_iso3(ne_data: pd.DataFrame) -> pd.Series:
+    """Return the alpha-3 code to join each Natural Earth shape on.
+
+    Uses ISO_A3 where set, otherwise the shape's ADM0_A3 looked up in
+    the reference table.
+    """
+    iso3 = ne_data["ISO_A3"]
+    missing = iso3 == "-99"
+    if "ADM0_A3" in ne_data.columns:
+        fallback = ne_data["ADM0_A3"].map(_ne_to_iso3())
+        fallback = fallback.fillna(ne_data["ADM0_A3"])
+        iso3 = iso3.where(~missing, fallback)
+    return iso3
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description="Build or show the country reference table.")
+    parser.add_argument("--build", action="store_true",
+        help="Rebuild the table from geonamescache and pycountry")
+    parser.add_argument("--output", default=REF_FILE,
+        help="Table to write with --build")
+    args = parser.parse_args()
+
+    if args.build:
+        ref = build()
+        ref.to_csv(args.output, index=False)
+        print(f"Wrote {len(ref)} countries to {args.output}")
+    else:
+        print(load().to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
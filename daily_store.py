@@ -0,0 +1,197 @@
+"""
+daily_store.py — Per-day GA4 location data kept in SQLite.
+
+Instead of asking GA4 for one aggregated range per property, the daily
+store holds each property's sessions, users and pageviews by date and
+country.  A sync only fetches the days a property is missing, and any
+date range is then answered by summing the stored days locally.
+
+Days within the settle window are refetched on every sync since GA4 may
+still be processing them; older days are fetched once.
+
+Note that GA4 counts totalUsers per day, so the users for a range
+summed from days would count a returning visitor once per day visited
+and be higher than a single GA4 query over the same range.  The users
+column is stored, but --daily runs still ask GA4 for each range's
+users, one call per property for all of a run's ranges, answered by
+the report cache once the ranges have settled.  --daily-users sums
+them from the store as well, so synced days cost no calls at all, and
+marks the Parquet copies' metadata with users_summed_daily.
+"""
+
+import logging
+import os
+import sqlite3
+import threading
+from datetime import date, datetime, timedelta
+from typing import Any, Iterable, List, Tuple
+
+import pandas as pd
+
+from report_cache import DEFAULT_CACHE_DIR, DEFAULT_SETTLE_DAYS
+
+logger = logging.getLogger(__name__)
+
+# GA4 metric name to column name in the store.
+METRIC_COLUMNS = {
+    "sessions": "sessions",
+    "totalUsers": "users",
+    "screenPageViews": "pageviews",
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS day_country (
+    property    TEXT NOT NULL,
+    date        TEXT NOT NULL,
+    country     TEXT NOT NULL,
+    sessions    INTEGER NOT NULL,
+    users       INTEGER NOT NULL,
+    pageviews   INTEGER NOT NULL,
+    PRIMARY KEY (property, date, country)
+);
+CREATE TABLE IF NOT EXISTS day_synced (
+    property    TEXT NOT NULL,
+    date        TEXT NOT NULL,
+    PRIMARY KEY (property, date)
+);
+"""
+
+Row = Tuple[str, str, int, int, int]
+
+
+def parse_date(date_str: str) -> date:
+    return datetime.strptime(date_str, "%Y-%m-%d").date()
+
+
+def date_spans(days: List[date]) -> List[Tuple[str, str]]:
+    """Group sorted days into (start, end) runs of consecutive days."""
+    spans: List[Tuple[str, str]] = []
+    if not days:
+        return spans
+    start = prev = days[0]
+    for day in days[1:]:
+        if day != prev + timedelta(days=1):
+            spans.append((start.isoformat(), prev.isoformat()))
+            start = day
+        prev = day
+    spans.append((start.isoformat(), prev.isoformat()))
+    return spans
+
+
+def response_to_rows(response: Any) -> List[Row]:
+    """Convert a date by countryId runReport response to store rows."""
+    dims = [header.name for header in response.dimension_headers]
+    metrics = [header.name for header in response.metric_headers]
+    date_idx = dims.index("date")
+    country_idx = dims.index("countryId")
+    metric_idx = [metrics.index(name) for name in METRIC_COLUMNS]
+    rows = []
+    for row in response.rows:
+        day = row.dimension_values[date_idx].value
+        country = row.dimension_values[country_idx].value
+        if country == "(not set)":
+            country = "ZZ"
+        sessions, users, pageviews = (
+            int(row.metric_values[i].value) for i in metric_idx
+        )
+        day = f"{day[:4]}-{day[4:6]}-{day[6:]}"
+        rows.append((day, country, sessions, users, pageviews))
+    return rows
+
+
+class DailyStore:
+    """
+    SQLite store of GA4 location metrics by property, day and country.
+
+    Args:
+        cache_dir (str): Directory holding daily.sqlite.
+        settle_days (int): Days after which a date is treated as final.
+    """
+
+    def __init__(
+        self,
+        cache_dir: str = DEFAULT_CACHE_DIR,
+        settle_days: int = DEFAULT_SETTLE_DAYS,
+    ) -> None:
+        os.makedirs(cache_dir, exist_ok=True)
+        self.path = os.path.join(cache_dir, "daily.sqlite")
+        self.settle_days = settle_days
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        with self._conn:
+            self._conn.executescript(SCHEMA)
+
+    def missing_spans(
+        self, prop: str, start_date: str, end_date: str
+    ) -> List[Tuple[str, str]]:
+        """Return the runs of days in the range not yet synced for prop."""
+        with self._lock:
+            synced = {
+                row[0]
+                for row in self._conn.execute(
+                    "SELECT date FROM day_synced"
+                    " WHERE property = ? AND date BETWEEN ? AND ?",
+                    (prop, start_date, end_date),
+                )
+            }
+        start = parse_date(start_date)
+        end = min(parse_date(end_date), date.today())
+        days = []
+        day = start
+        while day <= end:
+            if day.isoformat() not in synced:
+                days.append(day)
+            day += timedelta(days=1)
+        return date_spans(days)
+
+    def write(
+        self, prop: str, start_date: str, end_date: str, rows: Iterable[Row]
+    ) -> None:
+        """Replace the stored days in the range with rows.
+
+        Settled days in the range are marked as synced, including days
+        without any rows.
+        """
+        cutoff = date.today() - timedelta(days=self.settle_days)
+        settled = []
+        day = parse_date(start_date)
+        while day <= parse_date(end_date) and day < cutoff:
+            settled.append((prop, day.isoformat()))
+            day += timedelta(days=1)
+        with self._lock, self._conn:
+            self._conn.execute(
+                "DELETE FROM day_country"
+                " WHERE property = ? AND date BETWEEN ? AND ?",
+                (prop, start_date, end_date),
+            )
+            self._conn.executemany(
+                "INSERT INTO day_country VALUES (?, ?, ?, ?, ?, ?)",
+                ((prop, *row) for row in rows),
+            )
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO day_synced VALUES (?, ?)", settled
+            )
+        logger.debug(
+            f"{prop}: stored {start_date} to {end_date}, "
+            f"{len(settled)} settled day(s)"
+        )
+
+    def aggregate(
+        self, prop: str, start_date: str, end_date: str
+    ) -> pd.DataFrame:
+        """Return the summed metrics by country for prop over the range."""
+        with self._lock:
+            df = pd.read_sql_query(
+                "SELECT country, SUM(sessions) AS sessions,"
+                " SUM(users) AS users, SUM(pageviews) AS pageviews"
+                " FROM day_country"
+                " WHERE property = ? AND date BETWEEN ? AND ?"
+                " GROUP BY country ORDER BY country",
+                self._conn,
+                params=(prop, start_date, end_date),
+                index_col="country",
+            )
+        return df
+
+    def close(self) -> None:
+        self._conn.close()
@@ -0,0 +1,404 @@
+"""
+fake_ga4.py — In-process stand-ins for the GA4 Admin and Data clients.
+
+FakeAdminClient and FakeDataClient answer the calls the location
+report makes with synthetic accounts, properties and rows, so the real
+fetch path can be run and timed without GA4 accounts or quota:
+
+    clients = GA4Clients(
+        data_client=FakeDataClient(latency=0.05),
+        admin_client=FakeAdminClient(num_properties=100),
+    )
+    get_analytics(None, [], start, end, output_file, clients=clients)
+
+Rows are generated from a seed, the property and the request, so the
+same request always gets the same answer however it is paged.  Each
+property sees a skewed share of the countries: a few see most of them
+and most see a handful.  Calls can be slowed down, given a slow tail,
+made to fail at a given rate, and charged against made up hourly and
+daily token quotas which are reported back when return_property_quota
+is set.  Totals are returned when asked for with metric_aggregations.
+Requests with cityId get GeoNames cities, with the city's name and
+country in the city and countryId dimensions, a few hundred for most
+properties and tens of thousands for some.
+
+runRealtimeReport answers with active users by country that drift
+from one call to the next: on each call a property's countries change
+with probability realtime_change_rate.
+"""
+
+import datetime
+import itertools
+import random
+import threading
+import time
+from collections import defaultdict
+from typing import Any, Dict, List, Optional, Sequence
+
+from google.analytics.admin import AccountSummary, PropertySummary
+from google.analytics.data_v1beta.types import (
+    BatchRunReportsResponse,
+    DimensionHeader,
+    DimensionValue,
+    MetricAggregation,
+    MetricHeader,
+    MetricValue,
+    PropertyQuota,
+    QuotaStatus,
+    Row,
+    RunRealtimeReportResponse,
+    RunReportResponse,
+)
+from google.api_core import exceptions
+
+import country_ref
+
+DEVICE_CATEGORIES = ["desktop", "mobile", "tablet"]
+
+# Dimensions of a city row, generated together so that they agree.
+CITY_DIMENSIONS = ("cityId", "city", "countryId")
+
+# Made up GA4 style quotas and token costs.
+TOKENS_PER_DAY = 200000
+TOKENS_PER_HOUR = 40000
+BASE_COST = 5
+ROWS_PER_TOKEN = 1000
+
+
+def _days(start: str, end: str) -> List[str]:
+    first = datetime.date.fromisoformat(start)
+    last = datetime.date.fromisoformat(end)
+    return [
+        (first + datetime.timedelta(days=n)).strftime("%Y%m%d")
+        for n in range((last - first).days + 1)
+    ]
+
+
+class FakeAdminClient:
+    """
+    Admin API stand-in with num_properties properties spread evenly
+    over num_accounts accounts.
+
+    Args:
+        num_properties (int): Properties to make up.
+        num_accounts (int): Accounts to spread them over.
+        latency (float): Seconds each page of summaries takes.
+    """
+
+    def __init__(
+        self,
+        num_properties: int = 10,
+        num_accounts: int = 5,
+        latency: float = 0.0,
+    ) -> None:
+        self.latency = latency
+        self.calls = 0
+        self.summaries = []
+        for account in range(min(num_accounts, num_properties)):
+            self.summaries.append(
+                AccountSummary(
+                    display_name=f"Account {account}",
+                    property_summaries=[
+                        PropertySummary(
+                            property=f"properties/{100000 + prop}",
+                            display_name=f"Site {prop} - GA4",
+                        )
+                        for prop in range(
+                            account, num_properties, num_accounts
+                        )
+                    ],
+                )
+            )
+
+    def list_account_summaries(self, request: Any = None) -> List[Any]:
+        page_size = getattr(request, "page_size", 0) or 50
+        pages = max(1, -(-len(self.summaries) // page_size))
+        for _ in range(pages):
+            self.calls += 1
+            time.sleep(self.latency)
+        return list(self.summaries)
+
+
+class FakeDataClient:
+    """
+    Data API stand-in for runReport and batchRunReports.
+
+    Args:
+        seed (int): Seed the generated rows are derived from.
+        latency (float): Mean seconds a call takes; the actual time
+            is drawn uniformly between half and one and a half times it.
+        error_rate (float): Chance that a call fails with
+            ServiceUnavailable before returning anything.
+        slow_rate (float): Chance that a call takes slow_factor times
+            as long as usual.
+        slow_factor (float): How much longer slow calls take.
+        tokens_per_hour (int): Hourly tokens per property, after which
+            calls fail with ResourceExhausted.
+        tokens_per_day (int): Daily tokens per property.
+        countries (list): Alpha-2 codes to report; defaults to the
+            country reference table.
+        realtime_change_rate (float): Chance that a country's active
+            users change between realtime calls.
+    """
+
+    def __init__(
+        self,
+        seed: int = 0,
+        latency: float = 0.0,
+        error_rate: float = 0.0,
+        slow_rate: float = 0.0,
+        slow_factor: float = 20.0,
+        tokens_per_hour: int = TOKENS_PER_HOUR,
+        tokens_per_day: int = TOKENS_PER_DAY,
+        countries: Optional[Sequence[str]] = None,
+        realtime_change_rate: float = 0.2,
+    ) -> None:
+        self.seed = seed
+        self.latency = latency
+        self.error_rate = error_rate
+        self.slow_rate = slow_rate
+        self.slow_factor = slow_factor
+        self.tokens_per_hour = tokens_per_hour
+        self.tokens_per_day = tokens_per_day
+        self.realtime_change_rate = realtime_change_rate
+        if countries is None:
+            ref = country_ref.load()
+            countries = [code for code in ref["iso2"] if code != ""]
+        self.countries = [
+            "(not set)" if code == "ZZ" else code for code in countries
+        ]
+        self.calls = 0
+        self.errors = 0
+        self.rows = 0
+        self._used: Dict[str, int] = defaultdict(int)
+        self._realtime: Dict[str, Dict[str, int]] = {}
+        self._lock = threading.Lock()
+        self._random = random.Random(seed)
+        self._cities: Optional[List[Dict[str, str]]] = None
+
+    def _city_list(self) -> List[Dict[str, str]]:
+        if self._cities is None:
+            from geonamescache import GeonamesCache
+
+            self._cities = [
+                {
+                    "cityId": str(city["geonameid"]),
+                    "city": city["name"],
+                    "countryId": city["countrycode"],
+                }
+                for city in GeonamesCache().get_cities().values()
+            ]
+            self._cities.append({
+                "cityId": "(not set)",
+                "city": "(not set)",
+                "countryId": "(not set)",
+            })
+        return self._cities
+
+    def _dimension_values(
+        self, name: str, rnd: random.Random, start: str, end: str
+    ) -> List[str]:
+        if name == "countryId":
+            # Pareto skew: most properties see only a few countries.
+            size = min(
+                len(self.countries), 1 + int(rnd.paretovariate(1.0) * 5)
+            )
+            return rnd.sample(self.countries, size)
+        if name == "deviceCategory":
+            return DEVICE_CATEGORIES
+        if name == "date":
+            return _days(start, end)
+        return [f"{name}{i}" for i in range(rnd.randint(1, 20))]
+
+    def _rows(self, request: Any) -> List[Any]:
+        dimensions = [d.name for d in request.dimensions]
+        metrics = [m.name for m in request.metrics]
+        named = len(request.date_ranges) > 1
+        rows = []
+        for date_range in request.date_ranges:
+            rnd = random.Random(
+                f"{self.seed}|{request.property}|{date_range.start_date}|"
+                f"{date_range.end_date}|{','.join(dimensions)}"
+            )
+            joint = []
+            if "cityId" in dimensions:
+                joint = [name for name in dimensions if name in CITY_DIMENSIONS]
+            plain = [name for name in dimensions if name not in joint]
+            choices: List[List[Any]] = [
+                self._dimension_values(
+                    name, rnd, date_range.start_date, date_range.end_date
+                )
+                for name in plain
+            ]
+            if joint:
+                cities = self._city_list()
+                size = min(len(cities), int(rnd.paretovariate(1.0) * 200))
+                choices.append([
+                    tuple(city[name] for name in joint)
+                    for city in rnd.sample(cities, size)
+                ])
+            for combo in itertools.product(*choices):
+                if joint:
+                    by_name = dict(zip(plain, combo))
+                    by_name.update(zip(joint, combo[-1]))
+                    combo = tuple(by_name[name] for name in dimensions)
+                values = list(combo)
+                if named:
+                    values.append(date_range.name)
+                rows.append(
+                    Row(
+                        dimension_values=[
+                            DimensionValue(value=v) for v in values
+                        ],
+                        metric_values=[
+                            MetricValue(value=str(rnd.randint(0, 5000)))
+                            for _ in metrics
+                        ],
+                    )
+                )
+        return rows
+
+    def _totals(self, request: Any, rows: List[Any]) -> List[Any]:
+        named = len(request.date_ranges) > 1
+        sums: Dict[Optional[str], List[int]] = {}
+        for row in rows:
+            name = row.dimension_values[-1].value if named else None
+            values = sums.setdefault(name, [0] * len(request.metrics))
+            for i, value in enumerate(row.metric_values):
+                values[i] += int(value.value)
+        totals = []
+        for name, values in sums.items():
+            dimension_values = [
+                DimensionValue(value="RESERVED_TOTAL")
+                for _ in request.dimensions
+            ]
+            if named:
+                dimension_values.append(DimensionValue(value=name))
+            totals.append(
+                Row(
+                    dimension_values=dimension_values,
+                    metric_values=[
+                        MetricValue(value=str(value)) for value in values
+                    ],
+                )
+            )
+        return totals
+
+    def _quota(self, prop: str, num_rows: int) -> PropertyQuota:
+        cost = BASE_COST + num_rows // ROWS_PER_TOKEN
+        with self._lock:
+            used = self._used[prop]
+            if used + cost > self.tokens_per_hour:
+                raise exceptions.ResourceExhausted(
+                    f"{prop}: exhausted property tokens per hour"
+                )
+            self._used[prop] = used + cost
+        return PropertyQuota(
+            tokens_per_hour=QuotaStatus(
+                consumed=cost, remaining=self.tokens_per_hour - used - cost
+            ),
+            tokens_per_day=QuotaStatus(
+                consumed=cost, remaining=self.tokens_per_day - used - cost
+            ),
+        )
+
+    def _run(self, request: Any) -> RunReportResponse:
+        rows = self._rows(request)
+        page = rows[request.offset:]
+        if request.limit:
+            page = page[:request.limit]
+        response = RunReportResponse(
+            dimension_headers=[
+                DimensionHeader(name=d.name) for d in request.dimensions
+            ],
+            metric_headers=[
+                MetricHeader(name=m.name) for m in request.metrics
+            ],
+            rows=page,
+            row_count=len(rows),
+        )
+        if len(request.date_ranges) > 1:
+            response.dimension_headers.append(
+                DimensionHeader(name="dateRange")
+            )
+        if MetricAggregation.TOTAL in request.metric_aggregations:
+            response.totals = self._totals(request, rows)
+        if request.return_property_quota:
+            response.property_quota = self._quota(request.property, len(page))
+        with self._lock:
+            self.rows += len(page)
+        return response
+
+    def _call(self, timeout: Optional[float]) -> None:
+        with self._lock:
+            self.calls += 1
+            delay = self.latency * (0.5 + self._random.random())
+            if self._random.random() < self.slow_rate:
+                delay *= self.slow_factor
+            failed = self._random.random() < self.error_rate
+            if failed:
+                self.errors += 1
+        if timeout is not None and delay > timeout:
+            time.sleep(timeout)
+            raise exceptions.DeadlineExceeded("fake GA4 deadline exceeded")
+        time.sleep(delay)
+        if failed:
+            raise exceptions.ServiceUnavailable("fake GA4 error")
+
+    def run_report(
+        self, request: Any, timeout: Optional[float] = None
+    ) -> RunReportResponse:
+        self._call(timeout)
+        return self._run(request)
+
+    def batch_run_reports(
+        self, request: Any, timeout: Optional[float] = None
+    ) -> BatchRunReportsResponse:
+        self._call(timeout)
+        return BatchRunReportsResponse(
+            reports=[self._run(report) for report in request.requests]
+        )
+
+    def run_realtime_report(
+        self, request: Any, timeout: Optional[float] = None
+    ) -> RunRealtimeReportResponse:
+        self._call(timeout)
+        with self._lock:
+            counts = self._realtime.get(request.property)
+            if counts is None:
+                rnd = random.Random(
+                    f"{self.seed}|{request.property}|realtime"
+                )
+                counts = {
+                    code: rnd.randint(0, 50)
+                    for code in self._dimension_values(
+                        "countryId", rnd, "", ""
+                    )
+                }
+                self._realtime[request.property] = counts
+            else:
+                for code in counts:
+                    if self._random.random() < self.realtime_change_rate:
+                        counts[code] = max(
+                            0, counts[code] + self._random.randint(-5, 5)
+                        )
+            rows = [
+                Row(
+                    dimension_values=[DimensionValue(value=code)],
+                    metric_values=[MetricValue(value=str(count))]
+                    * len(request.metrics),
+                )
+                for code, count in counts.items()
+                if count > 0
+            ]
+            self.rows += len(rows)
+        return RunRealtimeReportResponse(
+            dimension_headers=[
+                DimensionHeader(name=d.name) for d in request.dimensions
+            ],
+            metric_headers=[
+                MetricHeader(name=m.name) for m in request.metrics
+            ],
+            rows=rows,
+            row_count=len(rows),
+        )
@@ -0,0 +1,128 @@
+"""
+ga4_clients.py — Shared GA4 Data and Admin API clients for a run.
+
+Building a GA4 client loads credentials and opens a new gRPC channel, so
+every client built means another token fetch and TLS handshake.
+GA4Clients creates each client on first use and hands the same instance
+to every caller for the rest of the run.  gRPC clients are thread safe,
+so the pool can be shared by the concurrent fetch in get_analytics().
+"""
+
+import logging
+import threading
+import time
+from typing import Any, List, Optional, Tuple, cast
+
+from google.analytics.admin import AnalyticsAdminServiceClient
+from google.analytics.admin_v1alpha.services.analytics_admin_service.transports import (
+    AnalyticsAdminServiceGrpcTransport,
+)
+from google.analytics.data_v1beta import BetaAnalyticsDataClient
+from google.analytics.data_v1beta.services.beta_analytics_data.transports import (
+    BetaAnalyticsDataGrpcTransport,
+)
+
+logger = logging.getLogger(__name__)
+
+# Send an HTTP/2 ping after a minute of idleness so an open channel is
+# not torn down between requests during a long backfill.  Google front
+# ends reject pings more frequent than this.
+KEEPALIVE_TIME_MS = 60000
+
+KEEPALIVE_TIMEOUT_MS = 20000
+
+
+def channel_options(
+    keepalive_ms: int = KEEPALIVE_TIME_MS,
+) -> List[Tuple[str, int]]:
+    """Return gRPC channel options with the keep-alive policy applied."""
+    return [
+        ("grpc.keepalive_time_ms", keepalive_ms),
+        ("grpc.keepalive_timeout_ms", KEEPALIVE_TIMEOUT_MS),
+        ("grpc.keepalive_permit_without_calls", 1),
+        ("grpc.http2.max_pings_without_data", 0),
+        ("grpc.max_send_message_length", -1),
+        ("grpc.max_receive_message_length", -1),
+    ]
+
+
+class GA4Clients:
+    """
+    Lazily created GA4 clients shared across a run.
+
+    Args:
+        credentials: Optional google.auth credentials; defaults to the
+            application default credentials.
+        keepalive_ms (int): Keep-alive ping interval for the channels.
+        data_client: Prebuilt Data API client to use instead of
+            creating one.
+        admin_client: Prebuilt Admin API client to use instead of
+            creating one.
+    """
+
+    def __init__(
+        self,
+        credentials: Any = None,
+        keepalive_ms: int = KEEPALIVE_TIME_MS,
+        data_client: Any = None,
+        admin_client: Any = None,
+    ) -> None:
+        self.credentials = credentials
+        self.keepalive_ms = keepalive_ms
+        self._data = data_client
+        self._admin = admin_client
+        self._lock = threading.Lock()
+
+    @property
+    def data(self) -> BetaAnalyticsDataClient:
+        """Return the shared Data API client, creating it on first use."""
+        if self._data is None:
+            with self._lock:
+                if self._data is None:
+                    self._data = self._build(
+                        "Data",
+                        BetaAnalyticsDataClient,
+                        BetaAnalyticsDataGrpcTransport,
+                    )
+        return cast(BetaAnalyticsDataClient, self._data)
+
+    @property
+    def admin(self) -> AnalyticsAdminServiceClient:
+        """Return the shared Admin API client, creating it on first use."""
+        if self._admin is None:
+            with self._lock:
+                if self._admin is None:
+                    self._admin = self._build(
+                        "Admin",
+                        AnalyticsAdminServiceClient,
+                        AnalyticsAdminServiceGrpcTransport,
+                    )
+        return cast(AnalyticsAdminServiceClient, self._admin)
+
+    def _build(self, label: str, client_cls: Any, transport_cls: Any) -> Any:
+        begin = time.perf_counter()
+        channel = transport_cls.create_channel(
+            f"{transport_cls.DEFAULT_HOST}:443",
+            credentials=self.credentials,
+            options=channel_options(self.keepalive_ms),
+        )
+        client = client_cls(transport=transport_cls(channel=channel))
+        logger.debug(
+            f"Created GA4 {label} client in "
+            f"{(time.perf_counter() - begin) * 1000:.1f}ms"
+        )
+        return client
+
+    def close(self) -> None:
+        """Close any channels opened by the pool."""
+        for client in (self._data, self._admin):
+            if client is not None:
+                client.transport.close()
+        self._data = None
+        self._admin = None
+
+    def __enter__(self) -> "GA4Clients":
+        return self
+
+    def __exit__(self, *exc: Optional[Any]) -> None:
+        self.close()
@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+"""
+geometry_cache.py — Projected Natural Earth map units, prepared once.
+
+The static maps used to read the whole 10m map units shapefile on
+every call, project it to the Robinson projection and then work out
+each shape's label point and area.  read_map_units() does that once
+and saves the result as GeoParquet in the cache directory, by default
+~/.analytics/cache, under a name derived from the shapefile's path,
+size and mtime and the projection.  A new shapefile or projection
+gets a file of its own, and later calls read only the columns they
+ask for.
+
+The columns are the shapefile's ISO_A3, ADM0_A3, NAME and NAME_LONG,
+plus
+
+    iso3                the alpha-3 code to join results on, see
+                        country_ref.ne_iso3()
+    label_x, label_y    a point inside the shape to label it at
+    area                the projected area, for picking the shapes
+                        big enough to label
+
+Most of the 10m shapefile's vertices are closer together than a
+pixel of a 16 inch map at 150 dpi, and cost memory and drawing time
+for nothing.  Given the size of an output pixel, read_map_units()
+returns shapes only as detailed as that needs:
+
+    - from Natural Earth's 50m or 110m map units instead, when the
+      pixel is big enough for them and their shapefile is next to the
+      10m one, e.g. ~/Downloads/ne_50m_admin_0_map_units/
+      ne_50m_admin_0_map_units.shp; the finest scale there is is used
+      otherwise,
+    - simplified to the coarsest of LEVELS within half a pixel.
+      Neighbours' shared borders are simplified together, so no gaps
+      open between countries, with shapely 2.1 and GEOS 3.12 or later;
+      older versions simplify each shape on its own.
+
+Each scale and level is cached like the full shapes.  Label points
+and areas always come from the unsimplified shapes.
+
+GeoParquet needs pyarrow; without it the shapefile is read every time,
+as before.  To prepare the cache, with the levels for the default map
+size, ahead of a headless run:
+
+    ./geometry_cache.py
+"""
+
+import argparse
+import hashlib
+import json
+import logging
+import os
+from typing import List, Optional, Tuple
+
+import geopandas as gpd
+import shapely
+from pyproj import Transformer
+
+import columnar
+import country_ref
+
+logger = logging.getLogger(__name__)
+
+SHAPEFILE = os.path.join(
+    os.path.expanduser("~"),
+    "Downloads",
+    "ne_10m_admin_0_map_units",
+    "ne_10m_admin_0_map_units.shp",
+)
+
+PROJECTION = "+proj=robin"
+
+DEFAULT_CACHE_DIR = os.path.join(
+    os.path.expanduser("~"), ".analytics", "cache"
+)
+
+# Columns kept from the shapefile.
+NE_COLUMNS = ["ISO_A3", "ADM0_A3", "NAME", "NAME_LONG"]
+
+# Natural Earth scales, finest first, with the smallest pixel in
+# meters each is detailed enough for.  At the 0.28mm pixel of map
+# specifications 1:50m is 14 km a pixel.
+SCALES = [("10m", 0.0), ("50m", 15000.0), ("110m", 30000.0)]
+
+# Simplification tolerances in projected units, meters for Robinson.
+LEVELS = [1000.0, 2000.0, 4000.0, 8000.0, 16000.0, 32000.0]
+
+# Size of the static maps in inches and their dots per inch.
+DEFAULT_FIGSIZE = (16.0, 10.0)
+DEFAULT_DPI = 150
+
+
+def cache_path(
+    shapefile: str, crs: str, cache_dir: str, tolerance: float = 0.0
+) -> str:
+    """Return the cache file for shapefile as it is now, in crs,
+    simplified by tolerance.
+    """
+    stat = os.stat(shapefile)
+    key = hashlib.sha256(
+        json.dumps([
+            os.path.abspath(shapefile), stat.st_size, stat.st_mtime_ns, crs
+        ] + ([tolerance] if tolerance else [])).encode("utf-8")
+    ).hexdigest()[:16]
+    name = os.path.splitext(os.path.basename(shapefile))[0]
+    return os.path.join(cache_dir, f"{name}.{key}.parquet")
+
+
+def pixel_size(
+    figsize: Tuple[float, float] = DEFAULT_FIGSIZE,
+    dpi: float = DEFAULT_DPI,
+    crs: str = PROJECTION,
+) -> float:
+    """Return the projected width of a pixel of a world map figsize
+    inches across at dpi.
+
+    The world is taken to fill the figure's width, so the pixel comes
+    out a little small and the shapes a little detailed.
+    """
+    x, _ = Transformer.from_crs("EPSG:4326", crs, always_xy=True).transform(
+        [-180.0, 180.0], [0.0, 0.0]
+    )
+    return float((x[1] - x[0]) / (figsize[0] * dpi))
+
+
+def choose_level(
+    pixel: Optional[float], shapefile: str = SHAPEFILE
+) -> Tuple[str, float]:
+    """Return the shapefile and tolerance to draw pixel sized pixels
+    with; full detail if pixel is None.
+    """
+    if pixel is None:
+        return shapefile, 0.0
+    chosen = None
+    for scale, min_pixel in SCALES:
+        path = shapefile.replace("ne_10m_", f"ne_{scale}_")
+        if not os.path.isfile(path):
+            continue
+        if chosen is None or pixel >= min_pixel:
+            chosen = path
+    tolerance = max(
+        [level for level in LEVELS if level <= pixel / 2], default=0.0
+    )
+    return chosen or shapefile, tolerance
+
+
+def prepare(shapefile: str, crs: str) -> gpd.GeoDataFrame:
+    """Read and project the map units and add the derived columns."""
+    ne_data = gpd.read_file(shapefile)
+    ne_data = ne_data[NE_COLUMNS + ["geometry"]]
+    # ISO_A3 is "-99" for a few map units, so join on the reference
+    # table's code for them instead.
+    ne_data["iso3"] = country_ref.ne_iso3(ne_data)
+    ne_data = ne_data.to_crs(crs)
+    points = ne_data.geometry.representative_point()
+    ne_data["label_x"] = points.x
+    ne_data["label_y"] = points.y
+    ne_data["area"] = ne_data.geometry.area
+    return ne_data
+
+
+def simplify(ne_data: gpd.GeoDataFrame, tolerance: float) -> gpd.GeoDataFrame:
+    """Return a copy of ne_data with its shapes simplified by tolerance."""
+    geometry = ne_data.geometry.values
+    if (
+        hasattr(shapely, "coverage_simplify")
+        and shapely.geos_version >= (3, 12, 0)
+    ):
+        simplified = shapely.coverage_simplify(geometry, tolerance)
+    else:
+        simplified = shapely.simplify(
+            geometry, tolerance, preserve_topology=True
+        )
+    ne_data = ne_data.copy()
+    ne_data["geometry"] = gpd.GeoSeries(
+        simplified, index=ne_data.index, crs=ne_data.crs
+    )
+    return ne_data
+
+
+def _load(
+    shapefile: str,
+    crs: str,
+    cache_dir: str,
+    tolerance: float,
+    columns: Optional[List[str]],
+) -> gpd.GeoDataFrame:
+    if not columnar.available():
+        ne_data = prepare(shapefile, crs)
+        if tolerance:
+            ne_data = simplify(ne_data, tolerance)
+        return ne_data if columns is None else ne_data[columns]
+    path = cache_path(shapefile, crs, cache_dir, tolerance)
+    if os.path.isfile(path):
+        return gpd.read_parquet(path, columns=columns)
+    if tolerance:
+        ne_data = simplify(
+            _load(shapefile, crs, cache_dir, 0.0, None), tolerance
+        )
+    else:
+        ne_data = prepare(shapefile, crs)
+    os.makedirs(cache_dir, exist_ok=True)
+    tmp_path = f"{path}.tmp"
+    ne_data.to_parquet(tmp_path)
+    os.replace(tmp_path, path)
+    logger.info(
+        f"Saved projected {shapefile}"
+        + (f" simplified by {tolerance:g}" if tolerance else "")
+        + f" to {path}"
+    )
+    return ne_data if columns is None else ne_data[columns]
+
+
+def read_map_units(
+    columns: Optional[List[str]] = None,
+    shapefile: str = SHAPEFILE,
+    crs: str = PROJECTION,
+    cache_dir: str = DEFAULT_CACHE_DIR,
+    pixel: Optional[float] = None,
+) -> gpd.GeoDataFrame:
+    """Return the projected map units, from the cache when it has them.
+
+    columns limits the columns returned besides the geometry.  Given
+    pixel, the projected size of an output pixel, see pixel_size(),
+    the shapes are only as detailed as the output needs; otherwise
+    they are shapefile's in full.
+    """
+    if columns is not None:
+        columns = list(columns) + ["geometry"]
+    source, tolerance = choose_level(pixel, shapefile)
+    logger.debug(
+        f"Map units from {source} simplified by {tolerance:g} "
+        f"for {pixel or 0:.0f} a pixel"
+    )
+    return _load(source, crs, cache_dir, tolerance, columns)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description="Prepare the projected map units used by the static "
+        "maps.")
+    parser.add_argument("--shapefile", default=SHAPEFILE,
+        help="Natural Earth map units shapefile")
+    parser.add_argument("--crs", default=PROJECTION,
+        help="Projection to save them in")
+    parser.add_argument("--cache-dir", default=DEFAULT_CACHE_DIR,
+        help="Directory to save them in")
+    args = parser.parse_args()
+
+    if not columnar.available():
+        parser.error("Saving the map units needs pyarrow")
+    logging.basicConfig(format="%(levelname)s: %(message)s",
+                        level=logging.INFO)
+    for pixel in (None, pixel_size(crs=args.crs)):
+        ne_data = read_map_units(
+            shapefile=args.shapefile,
+            crs=args.crs,
+            cache_dir=args.cache_dir,
+            pixel=pixel,
+        )
+        source, tolerance = choose_level(pixel, args.shapefile)
+        print(f"{len(ne_data)} map units, "
+              f"{shapely.get_num_coordinates(ne_data.geometry.values).sum()}"
+              f" vertices, in "
+              f"{cache_path(source, args.crs, args.cache_dir, tolerance)}")
+
+
+if __name__ == "__main__":
+    main()
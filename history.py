@@ -0,0 +1,329 @@
+#!/usr/bin/env python3
+"""
+history.py — SQLite store of every location report written.
+
+Each run's country totals are added to history.sqlite, keyed by the
+period, the account label used in the CSV name ("all" or the accounts
+joined with "-") and the alpha-3 country code.  The current period's
+metrics and any comparison period columns are kept, so a period can be
+read back as the CSV it was written as, and trends across periods are
+a query rather than a glob over output_dir.
+
+Query it from the command line, e.g. the top 20 countries by pageviews
+growth over the last 8 periods:
+
+    ./history.py top --metric pageviews --periods 8 --limit 20
+
+or load the CSVs of earlier runs with
+
+    ./history.py import /path/to/output_dir/sessions_*.csv
+"""
+
+import argparse
+import json
+import logging
+import os
+import re
+import sqlite3
+import threading
+from datetime import date, timedelta
+from typing import Any, Dict, List, Optional, Tuple
+
+import pandas as pd
+
+import util
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_HISTORY_FILE = os.path.join(
+    os.path.expanduser("~"), ".analytics", "history.sqlite"
+)
+
+ALL_ACCOUNTS = "all"
+
+# Columns stored for each country, as in the location CSV less the
+# change columns, which are worked out on reading.
+COLUMNS = util.METRICS + [
+    f"{metric}_{name}" for name in util.COMPARISONS for metric in util.METRICS
+]
+
+SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS period (
+    account     TEXT NOT NULL,
+    start_date  TEXT NOT NULL,
+    end_date    TEXT NOT NULL,
+    fetched_at  TEXT NOT NULL,
+    missing     TEXT NOT NULL,
+    PRIMARY KEY (account, start_date, end_date)
+);
+CREATE TABLE IF NOT EXISTS location (
+    account     TEXT NOT NULL,
+    start_date  TEXT NOT NULL,
+    end_date    TEXT NOT NULL,
+    country     TEXT NOT NULL,
+    {", ".join(f"{col} INTEGER" for col in COLUMNS)},
+    PRIMARY KEY (account, start_date, end_date, country)
+);
+CREATE INDEX IF NOT EXISTS location_country
+    ON location (country, account, end_date);
+"""
+
+CSV_NAME = re.compile(
+    r"sessions_(.+)_(\d{4}-\d{2}-\d{2})_(\d{4}-\d{2}-\d{2})\.csv$"
+)
+
+
+def account_label(account_list: Optional[List[str]]) -> str:
+    """Return the account part of the CSV name for an account list."""
+    return "-".join(account_list) if account_list else ALL_ACCOUNTS
+
+
+def period_length(start_date: str, end_date: str) -> Tuple[str, int]:
+    """Return a period's length in whole months if it runs from the
+    first of a month to the end of one, as quarters do, and in days
+    otherwise.
+    """
+    start = date.fromisoformat(start_date)
+    end = date.fromisoformat(end_date)
+    if start.day == 1 and (end + timedelta(days=1)).day == 1:
+        months = (end.year - start.year) * 12 + end.month - start.month + 1
+        return "months", months
+    return "days", (end - start).days + 1
+
+
+def parse_csv_name(csv_file: str) -> Tuple[str, str, str]:
+    """Return the (account, start_date, end_date) in a CSV's name."""
+    match = CSV_NAME.search(os.path.basename(csv_file))
+    if not match:
+        raise ValueError(f"Can't get account and period from {csv_file}")
+    return match.group(1), match.group(2), match.group(3)
+
+
+class HistoryStore:
+    """
+    SQLite store of location totals by period, account and country.
+
+    Args:
+        path (str): The SQLite file.
+    """
+
+    def __init__(self, path: str = DEFAULT_HISTORY_FILE) -> None:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        with self._conn:
+            self._conn.executescript(SCHEMA)
+
+    def write(
+        self,
+        account: str,
+        start_date: str,
+        end_date: str,
+        df: pd.DataFrame,
+        fetched_at: str,
+        missing: Optional[Dict[str, str]] = None,
+    ) -> None:
+        """Replace a period's rows with df, a frame indexed by iso3."""
+        df = df.reindex(columns=[col for col in COLUMNS if col in df.columns])
+        rows = [
+            (account, start_date, end_date, country, *values)
+            for country, values in zip(
+                df.index, df.astype(object).itertuples(index=False)
+            )
+        ]
+        columns = ", ".join(["account", "start_date", "end_date", "country"]
+                            + list(df.columns))
+        marks = ", ".join("?" * (4 + len(df.columns)))
+        key = (account, start_date, end_date)
+        with self._lock, self._conn:
+            self._conn.execute(
+                "DELETE FROM location"
+                " WHERE account = ? AND start_date = ? AND end_date = ?",
+                key,
+            )
+            self._conn.executemany(
+                f"INSERT INTO location ({columns}) VALUES ({marks})", rows
+            )
+            self._conn.execute(
+                "INSERT OR REPLACE INTO period VALUES (?, ?, ?, ?, ?)",
+                (*key, fetched_at, json.dumps(missing or {})),
+            )
+        logger.debug(
+            f"Stored {len(rows)} countries for {account} "
+            f"{start_date} to {end_date} in {self.path}"
+        )
+
+    def import_csv(self, csv_file: str) -> None:
+        """Add a location CSV, taking its account and period from its name."""
+        account, start_date, end_date = parse_csv_name(csv_file)
+        df = pd.read_csv(csv_file, index_col="iso3")
+        fetched_at = pd.Timestamp(
+            os.path.getmtime(csv_file), unit="s", tz="UTC"
+        ).isoformat()
+        self.write(account, start_date, end_date, df, fetched_at)
+
+    def periods(self, account: Optional[str] = None) -> pd.DataFrame:
+        """Return the stored periods, newest first."""
+        query = (
+            "SELECT p.account, p.start_date, p.end_date, p.fetched_at,"
+            " COUNT(l.country) AS countries,"
+            " SUM(l.pageviews) AS pageviews, p.missing"
+            " FROM period p LEFT JOIN location l USING"
+            " (account, start_date, end_date)"
+        )
+        params: Tuple[Any, ...] = ()
+        if account is not None:
+            query += " WHERE p.account = ?"
+            params = (account,)
+        query += " GROUP BY p.account, p.start_date, p.end_date"
+        query += " ORDER BY p.end_date DESC, p.account"
+        with self._lock:
+            return pd.read_sql_query(query, self._conn, params=params)
+
+    def read_period(
+        self, start_date: str, end_date: str, account: str = ALL_ACCOUNTS
+    ) -> pd.DataFrame:
+        """Return a period as a frame shaped like its location CSV."""
+        with self._lock:
+            df = pd.read_sql_query(
+                f"SELECT country AS iso3, {', '.join(COLUMNS)}"
+                " FROM location"
+                " WHERE account = ? AND start_date = ? AND end_date = ?"
+                " ORDER BY country",
+                self._conn,
+                params=(account, start_date, end_date),
+                index_col="iso3",
+            )
+        if df.empty:
+            raise KeyError(
+                f"No {account} history for {start_date} to {end_date}"
+            )
+        return util.with_change_columns(df).astype("int64")
+
+    def read_csv_period(self, csv_file: str) -> pd.DataFrame:
+        """Return the period a location CSV's name refers to."""
+        account, start_date, end_date = parse_csv_name(csv_file)
+        return self.read_period(start_date, end_date, account)
+
+    def top_growth(
+        self,
+        metric: str = "pageviews",
+        periods: int = 8,
+        limit: int = 20,
+        account: str = ALL_ACCOUNTS,
+    ) -> pd.DataFrame:
+        """Return the countries whose metric grew most over the last
+        periods stored for account, from the first of them to the last.
+
+        Only periods as long as the latest one are compared, so a year
+        to date run isn't set against a quarter ending the same day.
+        The columns are named start_end after the two periods.
+        """
+        if metric not in util.METRICS:
+            raise ValueError(f"Unknown metric {metric}")
+        with self._lock:
+            stored = pd.read_sql_query(
+                "SELECT start_date, end_date FROM period WHERE account = ?"
+                " ORDER BY end_date DESC, start_date DESC",
+                self._conn,
+                params=(account,),
+            )
+            df = pd.read_sql_query(
+                f"SELECT country, start_date, end_date, {metric} AS value"
+                " FROM location WHERE account = ?",
+                self._conn,
+                params=(account,),
+            )
+        if stored.empty:
+            return df
+        lengths = [
+            period_length(start, end)
+            for start, end in zip(stored["start_date"], stored["end_date"])
+        ]
+        stored = stored[[length == lengths[0] for length in lengths]]
+        df = df.merge(stored.head(periods), on=["start_date", "end_date"])
+        # pivot() rather than pivot_table() so that a period stored
+        # twice raises instead of being summed.
+        table = df.pivot(
+            index="country", columns=["start_date", "end_date"], values="value"
+        ).fillna(0).astype("int64")
+        first, last = table.columns[0], table.columns[-1]
+        first_name, last_name = "_".join(first), "_".join(last)
+        result = pd.DataFrame({
+            first_name: table[first],
+            last_name: table[last],
+            "growth": table[last] - table[first],
+        })
+        result["growth_pct"] = (
+            100 * result["growth"]
+            / result[first_name].where(result[first_name] > 0)
+        ).round(1)
+        return result.sort_values("growth", ascending=False).head(limit)
+
+    def close(self) -> None:
+        self._conn.close()
+
+
+def main():
+    pd.set_option("display.max_rows", None)
+    pd.set_option("display.width", 0)
+
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description="Query the history of location reports.")
+    parser.add_argument("--db", default=DEFAULT_HISTORY_FILE,
+        help="History SQLite file")
+    parser.add_argument("-a", "--account",
+        help="Account label, as in the CSV names; top and show default "
+        f"to {ALL_ACCOUNTS!r} and periods to every account")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    subparsers.add_parser("periods",
+        help="List the stored periods")
+
+    top = subparsers.add_parser("top",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        help="Countries with the most growth over recent periods")
+    top.add_argument("--metric", "-m", default="pageviews",
+        choices=util.METRICS,
+        help="Metric to rank by")
+    top.add_argument("--periods", type=int, default=8,
+        help="Number of most recent periods to compare across")
+    top.add_argument("--limit", type=int, default=20,
+        help="Number of countries to show")
+
+    show = subparsers.add_parser("show",
+        help="Print a period as its CSV")
+    show.add_argument("start_date", help="Start date")
+    show.add_argument("end_date", help="End date")
+
+    imp = subparsers.add_parser("import",
+        help="Add location CSVs named sessions_<account>_<start>_<end>.csv")
+    imp.add_argument("csv_files", nargs="+", help="Location CSV files")
+
+    args = parser.parse_args()
+    store = HistoryStore(args.db)
+
+    if args.command == "periods":
+        print(store.periods(args.account).to_string(index=False))
+    elif args.command == "top":
+        print(store.top_growth(
+            args.metric, args.periods, args.limit,
+            args.account or ALL_ACCOUNTS,
+        ).to_string())
+    elif args.command == "show":
+        print(store.read_period(
+            args.start_date, args.end_date, args.account or ALL_ACCOUNTS
+        ).to_csv(), end="")
+    elif args.command == "import":
+        for csv_file in args.csv_files:
+            try:
+                store.import_csv(csv_file)
+                print(f"Imported {csv_file}")
+            except ValueError as e:
+                print(f"Skipped {csv_file}: {e}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,283 @@
+#!/usr/bin/env python3
+"""
+matrix.py — Per-property country totals kept next to the run total.
+
+get_analytics() sums every property into one total, after which a
+per-site or per-account map means fetching everything again.
+PropertyMatrix keeps each property's country rows as well, and the run
+saves them next to the CSV, e.g. sessions_all_2025-01-01_2025-03-31.
+matrix.npz.
+
+With hundreds of properties and about 250 countries most of the
+property × country cells are empty, so only the cells a property
+reported are stored, in compressed sparse row form:
+
+    properties, property_ids   the properties' long and GA4 names
+    countries, metrics         alpha-3 codes and column names
+    indptr                     property i has rows indptr[i] to
+                               indptr[i + 1]
+    country_index              each row's position in countries
+    values                     int64 array with a row per cell and a
+                               column per metric
+
+Selecting a property is then a slice of contiguous rows, and summing
+properties one np.add.at over country_index.  The file is a plain
+NumPy archive, so nothing beyond NumPy is needed to read it.
+
+Slice it from the command line, e.g. the totals of one account less a
+site, as a location CSV the map scripts can plot:
+
+    ./matrix.py sessions_all_2025-01-01_2025-03-31.matrix.npz \\
+        --account Libraries --skip "Libraries:Test Site" \\
+        -o sessions_Libraries_2025-01-01_2025-03-31.csv
+"""
+
+import argparse
+import logging
+import os
+import threading
+from typing import Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+import pandas as pd
+
+import country_ref
+import util
+
+logger = logging.getLogger(__name__)
+
+# A property's rows as added: long name, GA4 name, country and metric
+# slots, and the counts.
+Block = Tuple[str, str, np.ndarray, np.ndarray, np.ndarray]
+
+
+class PropertyMatrix:
+    """Country totals of each property, stored sparsely.
+
+    Properties are added from several threads with add() and written
+    with save(); load() reads a saved matrix back.
+    """
+
+    def __init__(self) -> None:
+        self.properties: List[str] = []
+        self.property_ids: List[str] = []
+        self.countries: List[str] = []
+        self.metrics: List[str] = []
+        self.indptr = np.zeros(1, dtype=np.int64)
+        self.country_index = np.zeros(0, dtype=np.int32)
+        self.values = np.zeros((0, 0), dtype=np.int64)
+        self._country_slots: Dict[str, int] = {}
+        self._metric_slots: Dict[str, int] = {}
+        self._blocks: List[Block] = []
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _positions(keys: Iterable[str], slots: Dict[str, int]) -> np.ndarray:
+        return np.array(
+            [slots.setdefault(key, len(slots)) for key in keys], dtype=np.intp
+        )
+
+    def add(self, long_name: str, prop: str, df: pd.DataFrame) -> None:
+        """Add a property's frame of counts indexed by alpha-2 country."""
+        values = df.to_numpy(dtype=np.int64)
+        keep = values.any(axis=1)
+        with self._lock:
+            rows = self._positions(df.index[keep], self._country_slots)
+            cols = self._positions(df.columns, self._metric_slots)
+            self._blocks.append((long_name, prop, rows, cols, values[keep]))
+
+    def _build(self) -> None:
+        """Turn the added blocks into the sparse arrays, by property."""
+        with self._lock:
+            blocks = sorted(self._blocks, key=lambda block: block[0])
+            countries = list(self._country_slots)
+            metrics = list(self._metric_slots)
+        # Stored sorted so that the same results always give the same file.
+        country_order = np.argsort(countries)
+        country_rank = np.empty(len(countries), dtype=np.int32)
+        country_rank[country_order] = np.arange(len(countries))
+        metric_order = np.argsort(metrics)
+        metric_rank = np.empty(len(metrics), dtype=np.intp)
+        metric_rank[metric_order] = np.arange(len(metrics))
+
+        num_rows = sum(len(rows) for _, _, rows, _, _ in blocks)
+        self.indptr = np.zeros(len(blocks) + 1, dtype=np.int64)
+        self.country_index = np.empty(num_rows, dtype=np.int32)
+        self.values = np.zeros((num_rows, len(metrics)), dtype=np.int64)
+        start = 0
+        for i, (_, _, rows, cols, values) in enumerate(blocks):
+            end = start + len(rows)
+            order = np.argsort(country_rank[rows])
+            self.country_index[start:end] = country_rank[rows][order]
+            self.values[start:end, metric_rank[cols]] = values[order]
+            self.indptr[i + 1] = end
+            start = end
+        self.properties = [long_name for long_name, _, _, _, _ in blocks]
+        self.property_ids = [prop for _, prop, _, _, _ in blocks]
+        iso2 = [countries[i] for i in country_order]
+        self.countries = list(country_ref.iso2_to_iso3(iso2))
+        self.metrics = [
+            metrics[i].replace("ga:", "", 1) for i in metric_order
+        ]
+
+    def save(self, path: str) -> None:
+        """Write the properties added so far to a .npz file."""
+        self._build()
+        tmp_path = f"{path}.tmp.npz"
+        np.savez_compressed(
+            tmp_path,
+            properties=np.array(self.properties, dtype=str),
+            property_ids=np.array(self.property_ids, dtype=str),
+            countries=np.array(self.countries, dtype=str),
+            metrics=np.array(self.metrics, dtype=str),
+            indptr=self.indptr,
+            country_index=self.country_index,
+            values=self.values,
+        )
+        os.replace(tmp_path, path)
+        logger.info(
+            f"Wrote {len(self.country_index)} cells of "
+            f"{len(self.properties)} properties to {path}"
+        )
+
+    @classmethod
+    def load(cls, path: str) -> "PropertyMatrix":
+        matrix = cls()
+        with np.load(path) as data:
+            matrix.properties = data["properties"].tolist()
+            matrix.property_ids = data["property_ids"].tolist()
+            matrix.countries = data["countries"].tolist()
+            matrix.metrics = data["metrics"].tolist()
+            matrix.indptr = data["indptr"]
+            matrix.country_index = data["country_index"]
+            matrix.values = data["values"]
+        return matrix
+
+    def select(
+        self,
+        sites: Optional[List[str]] = None,
+        accounts: Optional[List[str]] = None,
+        skip_list: Optional[List[str]] = None,
+    ) -> List[int]:
+        """Return the positions of the properties matching the arguments.
+
+        sites are matched against either the site name or the long
+        "account:site" name, accounts against the account name.  None
+        for both selects every property; skip_list drops long names.
+        """
+        skip = set(skip_list or [])
+        chosen = []
+        for i, long_name in enumerate(self.properties):
+            account, site = long_name.split(":", 1)
+            if long_name in skip:
+                continue
+            if sites is None and accounts is None:
+                chosen.append(i)
+            elif sites is not None and (site in sites or long_name in sites):
+                chosen.append(i)
+            elif accounts is not None and account in accounts:
+                chosen.append(i)
+        return chosen
+
+    def _rows(self, positions: List[int]) -> np.ndarray:
+        if not positions:
+            return np.zeros(0, dtype=np.intp)
+        return np.concatenate([
+            np.arange(self.indptr[i], self.indptr[i + 1]) for i in positions
+        ])
+
+    def total(self, positions: List[int]) -> pd.DataFrame:
+        """Return the summed countries of the properties at positions,
+        shaped like the location CSV.
+        """
+        rows = self._rows(positions)
+        countries = self.country_index[rows]
+        sums = np.zeros((len(self.countries), len(self.metrics)), np.int64)
+        np.add.at(sums, countries, self.values[rows])
+        seen = np.bincount(countries, minlength=len(self.countries)) > 0
+        df = pd.DataFrame(
+            sums[seen],
+            index=pd.Index(np.array(self.countries)[seen], name="iso3"),
+            columns=self.metrics,
+        )
+        return util.with_change_columns(df)
+
+    def by_property(self, metric: str, positions: List[int]) -> pd.DataFrame:
+        """Return a property × country frame of one metric."""
+        col = self.metrics.index(metric)
+        data = np.zeros((len(positions), len(self.countries)), np.int64)
+        for row, i in enumerate(positions):
+            start, end = self.indptr[i], self.indptr[i + 1]
+            data[row, self.country_index[start:end]] = self.values[
+                start:end, col
+            ]
+        return pd.DataFrame(
+            data,
+            index=pd.Index([self.properties[i] for i in positions],
+                           name="property"),
+            columns=pd.Index(self.countries, name="iso3"),
+        )
+
+
+def main():
+    pd.set_option("display.max_rows", None)
+    pd.set_option("display.width", 0)
+
+    parser = argparse.ArgumentParser(
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+        description="Slice the per-property results saved with a "
+        "location report.")
+    parser.add_argument("matrix_file",
+        help="Per-property .matrix.npz file saved with the CSV")
+    parser.add_argument("-s", "--site", action="append",
+        help="Site name or account:site to include; may be repeated")
+    parser.add_argument("-a", "--account", action="append",
+        help="Account to include; may be repeated")
+    parser.add_argument("-k", "--skip", action="append", default=[],
+        help="account:site to leave out; may be repeated")
+    parser.add_argument("--skip-list", action="store_true",
+        help="Also leave out the skip_list of config.yaml")
+    parser.add_argument("-m", "--metric",
+        help="Print a property by country table of this metric instead "
+        "of the totals")
+    parser.add_argument("-l", "--list", action="store_true",
+        help="List the properties and how many countries each has")
+    parser.add_argument("-o", "--output",
+        help="CSV file to write; prints to stdout if not given")
+    args = parser.parse_args()
+
+    matrix = PropertyMatrix.load(args.matrix_file)
+
+    skip_list = list(args.skip)
+    if args.skip_list:
+        skip_list += util.load_config().get("skip_list") or []
+
+    positions = matrix.select(args.site, args.account, skip_list)
+    if not positions:
+        parser.error("No properties match")
+
+    if args.list:
+        df = pd.DataFrame({
+            "property_id": [matrix.property_ids[i] for i in positions],
+            "countries": np.diff(matrix.indptr)[positions],
+        }, index=pd.Index(
+            [matrix.properties[i] for i in positions], name="property"
+        ))
+    elif args.metric:
+        if args.metric not in matrix.metrics:
+            parser.error(
+                f"Unknown metric {args.metric}, choose from "
+                + ", ".join(matrix.metrics)
+            )
+        df = matrix.by_property(args.metric, positions)
+    else:
+        df = matrix.total(positions)
+
+    if args.output:
+        df.to_csv(args.output)
+    else:
+        print(df.to_csv(), end="")
+
+
+if __name__ == "__main__":
+    main()
@@ -2,13 +2,18 @@
 
 from datetime import datetime
 import argparse
+import columnar
+import country_ref
 import fiscalyear as fy
+import json
+import numpy as np
 import os
 import pandas as pd
 import plotly.graph_objects as go
-import pycountry
 import re
 import sys
+import util
+from history import DEFAULT_HISTORY_FILE
 
 
 def convert_date(date_str):
@@ -38,7 +43,15 @@ def get_date_range(file):
     raise ValueError("Can't extract date range from {file}")
 
 
-def plot_interactive(metric, csv_file, html_file):
+TITLES = {
+    "pageviews": "Views",
+    "sessions": "Sessions",
+    "users": "Users",
+    "activeUsers": "Active Users",
+}
+
+
+def plot_interactive(metric, csv_file, html_file, history=None):
     date_range = get_date_range(csv_file)
 
     if not html_file:
@@ -50,59 +63,102 @@ def plot_interactive(metric, csv_file, html_file):
     pd.set_option("display.max_rows", None)
     pd.set_option("display.width", 0)
 
-    sessions = pd.read_csv(csv_file, index_col="iso3")
+    sessions = columnar.read_results(csv_file, [metric], history)
 
-    countries_list = [
-        [country.alpha_3, country.name] for country in pycountry.countries
-    ]
-    countries = pd.DataFrame(countries_list, columns=["iso3", "name"])
-    countries = countries.set_index("iso3")
-
-    df = sessions.join(countries, how="outer")
+    df = sessions.join(country_ref.names(), how="outer")
 
     df = df.fillna(0)
 
     df = df.sort_values(by=[metric], ascending=False)
 
-    title = {
-        "pageviews": "Views",
-        "sessions": "Sessions",
-        "users": "Users",
-    }
+    base_metric, comparison = util.split_change_metric(metric)
+    if comparison:
+        title = util.titlecase(
+            f"change in {TITLES[base_metric]} from "
+            f"{util.COMPARISONS[comparison]}"
+        )
+        # Diverging scale centred on no change.
+        color_kwds = {"colorscale": "RdBu", "zmid": 0}
+    else:
+        title = TITLES[metric]
+        color_kwds = {"colorscale": "Reds"}
+
+    fig = choropleth_figure(
+        df.index,
+        df[metric],
+        df["name"],
+        title,
+        f"{title} by Country for {date_range}",
+        color_kwds,
+    )
+
+    if html_file:
+        fig.write_html(html_file)
+
+    if sys.stdout.isatty() and "DISPLAY" in os.environ:
+        fig.show()
+
+
+def top_positions(values, n=10):
+    """Return the positions of the n largest values, largest first.
+
+    Only values above zero are ranked, so fewer than n positions come
+    back when fewer countries have any, as early in a live run.
+    """
+    values = np.asarray(values)
+    order = np.argsort(-values, kind="stable")
+    return order[values[order] > 0][:n]
+
+
+def top_ten(names, values):
+    """Return the labels of the ten largest values, None for the rest."""
+    top = set(top_positions(values))
+    return [name if i in top else None for i, name in enumerate(names)]
+
+
+def top_ten_text(title, labels, values):
+    order = top_positions(values)
+    if not len(order):
+        return f"No countries with {title} yet"
+    count = "ten" if len(order) == 10 else len(order)
+    text = f"Top {count} countries for {title}:<br>"
+    for i, pos in enumerate(order):
+        text += f"<br>{i+1}. {labels[pos]}"
+    return text
+
+
+def choropleth_figure(locations, values, names, title, title_text,
+                      color_kwds):
+    """Return the country map of values, with the top ten labelled."""
+    labels = top_ten(names, values)
 
     fig = go.Figure(
         data=go.Choropleth(
-            locations=df.index,
-            z=df[metric],
-            text=df["name"],
+            locations=locations,
+            z=values,
+            text=names,
             hovertemplate="<b>%{text}</b><br>%{z}<extra></extra>",
-            colorscale="Reds",
             autocolorscale=False,
             reversescale=False,
             marker_line_color="darkgray",
             marker_line_width=0.5,
             colorbar_tickprefix="",
-            colorbar_title=title[metric],
+            colorbar_title=title,
+            **color_kwds,
         )
     )
 
-    labels = [name if i < 10 else None for i, name in enumerate(df["name"])]
-
     fig.add_trace(
         go.Scattergeo(
-            locations=df.index,
+            locations=locations,
             text=labels,
             mode="text",
             hoverinfo="skip",
         )
     )
 
-    annotation_text = f"Top ten countries for {title[metric]}:<br>"
-    for i in range(0, 10):
-        annotation_text += f"<br>{i+1}. {labels[i]}"
-
     fig.update_layout(
-        title_text=f"{title[metric]} by Country for {date_range}",
+        title_text=title_text,
         geo=dict(
             showframe=True,
             showcoastlines=True,
@@ -118,11 +174,92 @@ def plot_interactive(metric, csv_file, html_file):
                 font=dict(
                     size=14,
                 ),
-                text=annotation_text,
+                text=top_ten_text(title, labels, values),
                 showarrow=False,
             )
         ],
     )
+    return fig
+
+
+def grid_bins(cities, metric, cell_deg=1.0):
+    """Sum metric over a grid of cell_deg degree cells.
+
+    Returns a frame with a row per non-empty cell: its centre, the
+    summed metric, the number of cities and the biggest city.
+    """
+    cities = cities.dropna(subset=["latitude", "longitude"])
+    cities = cities[cities[metric] > 0]
+    cols = int(round(360 / cell_deg))
+    col = np.floor((cities["longitude"].to_numpy() + 180) / cell_deg)
+    row = np.floor((cities["latitude"].to_numpy() + 90) / cell_deg)
+    cities = cities.assign(cell=(row * cols + col).astype(np.int64))
+    # Sorted so that the first city of a cell is its biggest.
+    cities = cities.sort_values(metric, ascending=False, kind="stable")
+    bins = cities.groupby("cell").agg(
+        value=(metric, "sum"),
+        cities=(metric, "size"),
+        top=("city", "first"),
+    )
+    cells = bins.index.to_numpy()
+    bins["longitude"] = (cells % cols + 0.5) * cell_deg - 180
+    bins["latitude"] = (cells // cols + 0.5) * cell_deg - 90
+    return bins.reset_index(drop=True)
+
+
+def plot_interactive_cities(metric, csv_file, html_file, cell_deg=1.0):
+    """Plot the city report in csv_file as a grid of cell_deg cells.
+
+    The cells are drawn as one trace of square markers colored by the
+    log of their summed metric, rather than a trace per city.
+    """
+    try:
+        date_range = get_date_range(csv_file.replace(".city", ""))
+    except ValueError:
+        date_range = ""
+
+    cities = pd.read_csv(
+        csv_file, usecols=["city", "latitude", "longitude", metric]
+    )
+    bins = grid_bins(cities, metric, cell_deg)
+    title = f"{TITLES[metric]} by City"
+    if date_range:
+        title += f" for {date_range}"
+
+    ticks = [10 ** n for n in range(int(np.log10(bins["value"].max())) + 1)]
+    fig = go.Figure(
+        go.Scattergeo(
+            lon=bins["longitude"],
+            lat=bins["latitude"],
+            mode="markers",
+            marker=dict(
+                symbol="square",
+                size=max(3, 900 * cell_deg / 360),
+                color=np.log10(bins["value"]),
+                colorscale="Reds",
+                colorbar=dict(
+                    title=TITLES[metric],
+                    tickvals=np.log10(ticks),
+                    ticktext=[f"{tick:,}" for tick in ticks],
+                ),
+                line_width=0,
+            ),
+            customdata=np.stack(
+                [bins["value"], bins["cities"], bins["top"]], axis=-1
+            ),
+            hovertemplate="<b>%{customdata[2]}</b> and "
+            "%{customdata[1]} cities<br>%{customdata[0]:,}<extra></extra>",
+        )
+    )
+    fig.update_layout(
+        title_text=title,
+        geo=dict(
+            showframe=True,
+            showcoastlines=True,
+            showcountries=True,
+            projection_type="equirectangular",
+        ),
+    )
 
     if html_file:
         fig.write_html(html_file)
@@ -131,6 +268,106 @@ def plot_interactive(metric, csv_file, html_file):
         fig.show()
 
 
+# Loads the latest update written by LiveMap every refresh_ms by adding
+# a script tag, which unlike fetch() also works for pages opened from
+# disk, and applies it with restyle rather than redrawing the figure.
+LIVE_SCRIPT = """
+(function() {
+    var gd = document.getElementById("{plot_id}");
+    var seq = -1;
+    window.liveMapUpdate = function(update) {
+        if (update.seq === seq) {
+            return;
+        }
+        seq = update.seq;
+        Plotly.restyle(gd, {z: [update.z]}, [0]);
+        Plotly.restyle(gd, {text: [update.labels]}, [1]);
+        Plotly.relayout(gd, {
+            "annotations[0].text": update.annotation,
+            "title.text": update.title
+        });
+    };
+    function poll() {
+        var script = document.createElement("script");
+        script.src = "UPDATE_FILE?" + Date.now();
+        script.onload = script.onerror = function() {
+            script.remove();
+        };
+        document.head.appendChild(script);
+    }
+    setInterval(poll, REFRESH_MS);
+    poll();
+})();
+"""
+
+
+class LiveMap:
+    """
+    Interactive map that is written once and then kept up to date.
+
+    The HTML page loads <html_file less .html>.js, which update()
+    rewrites with the new values, so the figure is patched in the
+    browser instead of being rebuilt and reloaded.
+
+    Args:
+        html_file (str): Page to write.
+        metric (str): Metric shown, a key of TITLES.
+        refresh_ms (int): How often the page looks for updates.
+    """
+
+    def __init__(self, html_file, metric="activeUsers", refresh_ms=5000):
+        self.html_file = html_file
+        self.update_file = os.path.splitext(html_file)[0] + ".js"
+        self.title = TITLES[metric]
+        names = country_ref.names()
+        self.locations = list(names.index)
+        self.names = list(names)
+        self._positions = {code: i for i, code in enumerate(self.locations)}
+        self._values = np.zeros(len(self.locations), dtype=np.int64)
+        self.seq = 0
+
+        fig = choropleth_figure(
+            self.locations,
+            self._values,
+            self.names,
+            self.title,
+            self._title_text(),
+            {"colorscale": "Reds"},
+        )
+        script = LIVE_SCRIPT.replace(
+            "UPDATE_FILE", os.path.basename(self.update_file)
+        ).replace("REFRESH_MS", str(refresh_ms))
+        fig.write_html(html_file, post_script=script)
+
+    def _title_text(self, when=None):
+        text = f"{self.title} by Country Right Now"
+        if when is not None:
+            text += f" ({when.strftime('%H:%M:%S')})"
+        return text
+
+    def update(self, changes, when=None):
+        """Set the values of the countries in changes, a dict of
+        alpha-3 code to value, and write the update for the page.
+        """
+        for code, value in changes.items():
+            if code in self._positions:
+                self._values[self._positions[code]] = value
+        self.seq += 1
+        values = self._values.tolist()
+        labels = top_ten(self.names, values)
+        update = {
+            "seq": self.seq,
+            "z": values,
+            "labels": labels,
+            "annotation": top_ten_text(self.title, labels, values),
+            "title": self._title_text(when or datetime.now()),
+        }
+        tmp_file = f"{self.update_file}.tmp"
+        with open(tmp_file, "w") as f:
+            f.write(f"window.liveMapUpdate({json.dumps(update)});\n")
+        os.replace(tmp_file, self.update_file)
+
+
 def main():
     parser = argparse.ArgumentParser(
         formatter_class=argparse.ArgumentDefaultsHelpFormatter,
@@ -139,11 +376,21 @@ def main():
     parser.add_argument("html_file", nargs="?",
         help="Output HTML file")
     parser.add_argument("--metric", "-m", default="pageviews",
-        choices=["sessions", "users" , "pageviews"],
+        choices=util.metric_choices(),
         help="GA metric to be displayed")
+    parser.add_argument("--history", nargs="?", const=DEFAULT_HISTORY_FILE,
+        help="Read the period named by csv_file from this history store "
+        "instead of the file")
+    parser.add_argument("--city", action="store_true",
+        help="csv_file is a city report; plot it as grid cells")
     args = parser.parse_args()
 
-    plot_interactive(args.metric, args.csv_file, args.html_file)
+    if args.city:
+        plot_interactive_cities(args.metric, args.csv_file, args.html_file)
+    else:
+        plot_interactive(
+            args.metric, args.csv_file, args.html_file, args.history
+        )
 
 
 if __name__ == '__main__':
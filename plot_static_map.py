@@ -3,14 +3,25 @@
 # from mpl_toolkits.axes_grid1 import make_axes_locatable
 from slugify import slugify
 import argparse
-import geopandas as gpd
+import columnar
 import matplotlib.pyplot as plt
+import numpy as np
 import os
 import pandas as pd
 import re
 import sys
 import util
-
+from geometry_cache import (
+    DEFAULT_DPI,
+    DEFAULT_FIGSIZE,
+    PROJECTION,
+    pixel_size,
+    read_map_units,
+)
+from history import DEFAULT_HISTORY_FILE
+from matplotlib.colors import LogNorm
+from pyproj import Transformer
+from typing import Optional
 
 def human_format(num):
     num = float("{:.3g}".format(num))
@@ -24,29 +35,36 @@ def human_format(num):
     )
 
 
-def plot_static(metric: str, csv_file: str, img_file: str) -> None:
+def plot_static(
+    metric: str,
+    csv_file: str,
+    img_file: str,
+    history: Optional[str] = None,
+    width: float = DEFAULT_FIGSIZE[0],
+    dpi: int = DEFAULT_DPI,
+    full_detail: bool = False,
+) -> None:
+    """Plot metric by country from csv_file.
+
+    The image is width inches across at dpi, and the country shapes
+    only as detailed as that size needs unless full_detail is set;
+    see geometry_cache.py.
+    """
     try:
         date_range = util.get_date_range(csv_file)
     except ValueError as e:
         print("Can't get date range filename: {csv_file}")
         date_range = ""
 
-    shapefile = os.path.join(
-        os.path.expanduser("~"),
-        "Downloads",
-        "ne_10m_admin_0_map_units",
-        "ne_10m_admin_0_map_units.shp",
-    )
-
     color_steps = 9
     color_map = "OrRd"
     # figure in inches (width, height)
-    figsize = (16, 10)
+    figsize = (width, width * DEFAULT_FIGSIZE[1] / DEFAULT_FIGSIZE[0])
     color_water = "lightskyblue"
     description = "Description"
 
     plt.rcParams["figure.dpi"] = 100
-    plt.rcParams["savefig.dpi"] = 150
+    plt.rcParams["savefig.dpi"] = dpi
 
     f, ax = plt.subplots(figsize=figsize, edgecolor="black")
     # ax.set_aspect('equal')
@@ -55,21 +73,29 @@ def plot_static(metric: str, csv_file: str, img_file: str) -> None:
     # cax = divider.append_axes("right", size="5%", pad=0.1)
 
     # Create a GeoDataFrame from the Admin 0 - Countries shapefile
-    # available from Natural Earth Data and show a sample of 5 records.
-    # We only read the ADM0_A3 and geometry columns, which contain the
-    # 3-letter country codes defined in ISO 3166-1 alpha-3 and the
-    # country shapes as polygons respectively.
-    ne_cols = ["ISO_A3", "NAME", "NAME_LONG", "geometry"]
-    ne_data = gpd.read_file(shapefile)
-    ne_data = ne_data[ne_cols]
-    ne_data = ne_data.to_crs("+proj=robin")
+    # available from Natural Earth Data, projected and with each
+    # shape's label point and area worked out ahead; see
+    # geometry_cache.py.  We only read the columns needed: the
+    # 3-letter country codes defined in ISO 3166-1 alpha-3, the names
+    # and the country shapes as polygons.
+    ne_data = read_map_units(
+        ["iso3", "NAME", "label_x", "label_y", "area"],
+        pixel=None if full_detail else pixel_size(figsize, dpi),
+    )
 
     # ne_data = gpd.read_file(gpd.datasets.get_path("naturalearth_lowres"))
     # ne.data = ne_data[list(map(str.lower, ne_cols))]
 
     # ne_data.plot(ax=ax, color='white', edgecolor=None, linewidth=1)
 
-    title = util.titlecase(f"{metric} by country")
+    base_metric, comparison = util.split_change_metric(metric)
+    if comparison:
+        title = util.titlecase(
+            f"change in {base_metric} from "
+            f"{util.COMPARISONS[comparison]} by country"
+        )
+    else:
+        title = util.titlecase(f"{metric} by country")
     if date_range:
         title += " " + date_range
 
@@ -77,13 +103,14 @@ def plot_static(metric: str, csv_file: str, img_file: str) -> None:
         img_file = "{slugify(title)}.jpg"
 
     # Read google analytics data into dataframe
-    ga_data = pd.read_csv(csv_file)
+    ga_data = columnar.read_results(csv_file, [metric], history)
+    ga_data = ga_data.reset_index()
     # print(ga_data.sample(5))
 
     # Next we merge the data frames on the columns containing the
     # 3-letter country codes and show summary statistics as returned
     # from the describe method.
-    df = ne_data.merge(ga_data, left_on="ISO_A3", right_on="iso3", how="left")
+    df = ne_data.merge(ga_data, on="iso3", how="left")
 
     # The merge operation above returned a GeoDataFrame. From this data
     # structure it is very easy to create a choropleth map by invoking the
@@ -91,40 +118,63 @@ def plot_static(metric: str, csv_file: str, img_file: str) -> None:
     # don't want a continuous color scale we set scheme to equal_interval
     # and the number of classes k to 9. We also set the size of the figure
     # and show a legend in the plot.
-    df.plot(
-        ax=ax,
-        # cax=cax,
-        figsize=figsize,
-        column=metric,
-        cmap=color_map,
-        edgecolor="black",
-        linewidth=0.1,
-        scheme="equal_interval",
-        # scheme="percentiles",
-        # scheme="quantiles",
-        k=color_steps,
-        legend=True,
-        legend_kwds={
-            "loc": "lower left",
-            "fmt": "{:.0f}",
-            "title": f"{metric.title()}",
-            "frameon": False,
-        },
-        missing_kwds={
+    plot_kwds = {
+        "ax": ax,
+        # "cax": cax,
+        "figsize": figsize,
+        "column": metric,
+        "edgecolor": "black",
+        "linewidth": 0.1,
+        "legend": True,
+        "missing_kwds": {
             "color": "lightgrey",
             "edgecolor": "red",
             "hatch": "///",
             "label": "No values recorded",
         },
-    )
+    }
+
+    if comparison:
+        # Diverging map centred on no change so gains and losses
+        # get the same color intensity for the same magnitude.
+        limit = df[metric].abs().max()
+        plot_kwds.update(
+            cmap="RdBu",
+            vmin=-limit,
+            vmax=limit,
+            legend_kwds={
+                "label": f"Change in {base_metric.title()}",
+                "orientation": "horizontal",
+                "shrink": 0.5,
+                "pad": 0.02,
+            },
+        )
+    else:
+        plot_kwds.update(
+            cmap=color_map,
+            scheme="equal_interval",
+            # scheme="percentiles",
+            # scheme="quantiles",
+            k=color_steps,
+            legend_kwds={
+                "loc": "lower left",
+                "fmt": "{:.0f}",
+                "title": f"{metric.title()}",
+                "frameon": False,
+            },
+        )
+
+    df.plot(**plot_kwds)
 
     legend = ax.get_legend()
-    legend_texts = legend.get_texts()
-    for i, label_text in enumerate(legend_texts[:-1]):
-        lower, upper = re.split(r"\s*,\s*", label_text.get_text().strip())
-        lower = human_format(float(lower))
-        upper = human_format(float(upper))
-        label_text.set_text(f"{lower} - {upper}")
+    # None if df.plot() drew no legend.
+    if not comparison and legend is not None:
+        legend_texts = legend.get_texts()
+        for i, label_text in enumerate(legend_texts[:-1]):
+            lower, upper = re.split(r"\s*,\s*", label_text.get_text().strip())
+            lower = human_format(float(lower))
+            upper = human_format(float(upper))
+            label_text.set_text(f"{lower} - {upper}")
 
     ax.set_facecolor(color_water)
     ax.tick_params(bottom=False, labelbottom=False, left=False, labelleft=False)
@@ -142,16 +192,17 @@ def plot_static(metric: str, csv_file: str, img_file: str) -> None:
     #     wrap=True,
     # )
 
-    df["coords"] = df["geometry"].apply(
-        lambda x: x.representative_point().coords[0]
-    )
-    df["area"] = df["geometry"].area
+    df["coords"] = list(zip(df["label_x"], df["label_y"]))
 
     df = df.sort_values(by="area", ascending=False)
 
+    sign = "+" if comparison else ""
+
     df.head(25).apply(
         lambda x: ax.annotate(
-            text=f"{x['NAME']}\n{human_format(x['pageviews'])}",
+            text=f"{x['NAME']}\n"
+            + (sign if x[metric] > 0 else "")
+            + human_format(x[metric]),
             xy=x.coords,
             horizontalalignment="center",
             verticalalignment="center",
@@ -166,6 +217,92 @@ def plot_static(metric: str, csv_file: str, img_file: str) -> None:
         plt.show()
 
 
+def plot_static_cities(
+    metric: str,
+    csv_file: str,
+    img_file: str,
+    gridsize: int = 200,
+    width: float = DEFAULT_FIGSIZE[0],
+    dpi: int = DEFAULT_DPI,
+    full_detail: bool = False,
+) -> None:
+    """Plot the city report in csv_file as hexagonal bins.
+
+    Each bin is colored by the summed metric of the cities in it, on a
+    log scale, so hundreds of thousands of cities take no longer to
+    draw than a few.  width, dpi and full_detail are as for
+    plot_static().
+    """
+    try:
+        date_range = util.get_date_range(csv_file.replace(".city", ""))
+    except ValueError:
+        date_range = ""
+    title = util.titlecase(f"{metric} by city")
+    if date_range:
+        title += " " + date_range
+
+    cities = pd.read_csv(csv_file, usecols=["latitude", "longitude", "city",
+                                            metric])
+    cities = cities.dropna(subset=["latitude", "longitude"])
+    cities = cities[cities[metric] > 0]
+    x, y = Transformer.from_crs(
+        "EPSG:4326", PROJECTION, always_xy=True
+    ).transform(cities["longitude"].to_numpy(), cities["latitude"].to_numpy())
+
+    figsize = (width, width * DEFAULT_FIGSIZE[1] / DEFAULT_FIGSIZE[0])
+    plt.rcParams["figure.dpi"] = 100
+    plt.rcParams["savefig.dpi"] = dpi
+    f, ax = plt.subplots(figsize=figsize, edgecolor="black")
+    ax.set_facecolor("lightskyblue")
+
+    ne_data = read_map_units(
+        [], pixel=None if full_detail else pixel_size(figsize, dpi)
+    )
+    ne_data.plot(ax=ax, color="white", edgecolor="black", linewidth=0.1)
+    xmin, ymin, xmax, ymax = ne_data.total_bounds
+
+    bins = ax.hexbin(
+        x,
+        y,
+        C=cities[metric].to_numpy(),
+        reduce_C_function=np.sum,
+        gridsize=gridsize,
+        extent=(xmin, xmax, ymin, ymax),
+        norm=LogNorm(),
+        mincnt=1,
+        cmap="OrRd",
+        linewidths=0,
+        zorder=2,
+    )
+    colorbar = f.colorbar(bins, ax=ax, orientation="horizontal",
+                          shrink=0.5, pad=0.02)
+    colorbar.set_label(metric.title())
+
+    top = np.argsort(-cities[metric].to_numpy(), kind="stable")[:10]
+    for i in top:
+        ax.annotate(
+            text=f"{cities['city'].iloc[i]}\n"
+            + human_format(cities[metric].iloc[i]),
+            xy=(x[i], y[i]),
+            horizontalalignment="center",
+            verticalalignment="bottom",
+            fontsize=8,
+            zorder=3,
+        )
+
+    ax.set_xlim(xmin, xmax)
+    ax.set_ylim(ymin, ymax)
+    ax.tick_params(bottom=False, labelbottom=False, left=False, labelleft=False)
+    ax.set_title(title, fontdict={"fontsize": 20}, loc="center", pad=12)
+
+    if img_file:
+        plt.savefig(img_file)
+
+    if sys.stdout.isatty() and "DISPLAY" in os.environ:
+        plt.show()
+    plt.close(f)
+
+
 def main():
     pd.set_option("display.max_columns", None)
     pd.set_option("display.max_rows", None)
@@ -178,11 +315,40 @@ def main():
     parser.add_argument("img_file", nargs="?",
         help="Output image file")
     parser.add_argument("--metric", "-m", default="pageviews",
-        choices=["sessions", "users" , "pageviews"],
+        choices=util.metric_choices(),
         help="GA metric to be displayed")
+    parser.add_argument("--history", nargs="?", const=DEFAULT_HISTORY_FILE,
+        help="Read the period named by csv_file from this history store "
+        "instead of the file")
+    parser.add_argument("--city", action="store_true",
+        help="csv_file is a city report; plot it as hexagonal bins")
+    parser.add_argument("--width", type=float, default=DEFAULT_FIGSIZE[0],
+        help="Image width in inches")
+    parser.add_argument("--dpi", type=int, default=DEFAULT_DPI,
+        help="Image dots per inch")
+    parser.add_argument("--full-detail", action="store_true",
+        help="Draw the country shapes in full detail whatever the size")
     args = parser.parse_args()
 
-    plot_static(args.metric, args.csv_file, args.img_file)
+    if args.city:
+        plot_static_cities(
+            args.metric,
+            args.csv_file,
+            args.img_file,
+            width=args.width,
+            dpi=args.dpi,
+            full_detail=args.full_detail,
+        )
+    else:
+        plot_static(
+            args.metric,
+            args.csv_file,
+            args.img_file,
+            args.history,
+            args.width,
+            args.dpi,
+            args.full_detail,
+        )
 
 
 if __name__ == '__main__':
@@ -0,0 +1,93 @@
+"""
+property_cache.py — Cached GA4 property discovery.
+
+Listing account summaries through the Admin API and normalising the
+property names is repeated on every run even though properties rarely
+change.  PropertyCache keeps the normalised "account:site" to property
+map in a JSON file and reports it as stale after a TTL, at which point
+the caller rediscovers and the differences are logged.
+"""
+
+import json
+import logging
+import os
+import time
+from typing import Any, Dict, Optional, cast
+
+from report_cache import DEFAULT_CACHE_DIR
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_TTL_HOURS = 24
+
+
+def log_changes(old: Dict[str, str], new: Dict[str, str]) -> None:
+    """Log properties added, removed or renamed between two maps."""
+    old_names = {prop: name for name, prop in old.items()}
+    new_names = {prop: name for name, prop in new.items()}
+    for prop, name in sorted(new_names.items(), key=lambda x: x[1]):
+        if prop not in old_names:
+            logger.info(f"Property added: {name} ({prop})")
+        elif old_names[prop] != name:
+            logger.info(
+                f"Property renamed: {old_names[prop]} -> {name} ({prop})"
+            )
+    for prop, name in sorted(old_names.items(), key=lambda x: x[1]):
+        if prop not in new_names:
+            logger.info(f"Property removed: {name} ({prop})")
+
+
+class PropertyCache:
+    """
+    JSON file cache of the discovered property map.
+
+    Args:
+        cache_dir (str): Directory holding properties.json.
+        ttl_hours (float): Age after which the map is rediscovered.
+    """
+
+    def __init__(
+        self,
+        cache_dir: str = DEFAULT_CACHE_DIR,
+        ttl_hours: float = DEFAULT_TTL_HOURS,
+    ) -> None:
+        self.path = os.path.join(cache_dir, "properties.json")
+        self.ttl = ttl_hours * 3600
+
+    def _read(self) -> Optional[Dict[str, Any]]:
+        try:
+            with open(self.path) as f:
+                return cast(Dict[str, Any], json.load(f))
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning(f"Ignoring unreadable {self.path}: {e}")
+            return None
+
+    def load(self) -> Optional[Dict[str, str]]:
+        """Return the cached map, or None if missing or stale."""
+        data = self._read()
+        if data is None:
+            return None
+        age = time.time() - data["fetched_at"]
+        if age > self.ttl:
+            logger.debug(f"Property cache is stale ({age / 3600:.1f}h old)")
+            return None
+        logger.debug(f"Using property cache ({age / 3600:.1f}h old)")
+        return dict(data["properties"])
+
+    def save(self, properties: Dict[str, str]) -> None:
+        """Store a freshly discovered map, logging what changed."""
+        data = self._read()
+        if data is not None:
+            log_changes(data["properties"], properties)
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(
+                {"fetched_at": time.time(), "properties": properties},
+                f,
+                indent=2,
+                sort_keys=True,
+            )
+        os.replace(tmp_path, self.path)
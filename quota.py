@@ -0,0 +1,200 @@
+"""
+quota.py — Per-run accounting of GA4 Data API quota.
+
+Requests are sent with return_property_quota so each response carries
+the tokens it consumed and what is left of the property's hourly and
+daily allowance.  QuotaLog collects that, along with how long each call
+took, and summarises the run as JSON and a one-line log message.
+"""
+
+import json
+import logging
+import threading
+import time
+from collections import defaultdict
+from typing import Any, Dict, List, Optional
+
+logger = logging.getLogger(__name__)
+
+# PropertyQuota fields reported in the summary.
+QUOTA_FIELDS = [
+    "tokens_per_day",
+    "tokens_per_hour",
+    "tokens_per_project_per_hour",
+    "concurrent_requests",
+    "server_errors_per_project_per_hour",
+    "potentially_thresholded_requests_per_hour",
+]
+
+# PropertyQuota fields whose consumption adds up over a batch.
+TOKEN_FIELDS = [
+    "tokens_per_day",
+    "tokens_per_hour",
+    "tokens_per_project_per_hour",
+]
+
+SLOWEST_COUNT = 10
+
+
+def _min_field(entries: List[Dict[str, Any]], field: str) -> Optional[int]:
+    return min((e[field] for e in entries if field in e), default=None)
+
+
+def batch_property_quota(reports: Any) -> Any:
+    """Return one PropertyQuota for the reports of a batch call.
+
+    Tokens consumed are summed over the reports and the other fields
+    are taken from the last report that returned a quota.
+    """
+    merged = None
+    for report in reports:
+        if "property_quota" not in report:
+            continue
+        property_quota = report.property_quota
+        if merged is None:
+            merged = type(property_quota)(property_quota)
+            continue
+        consumed = {
+            field: getattr(merged, field).consumed
+            + getattr(property_quota, field).consumed
+            for field in TOKEN_FIELDS
+            if field in merged or field in property_quota
+        }
+        merged = type(property_quota)(property_quota)
+        for field, value in consumed.items():
+            getattr(merged, field).consumed = value
+    return merged
+
+
+class _RecordingClient:
+    """Data API client wrapper that records each run_report call."""
+
+    def __init__(self, client: Any, quota_log: "QuotaLog") -> None:
+        self._client = client
+        self._quota_log = quota_log
+
+    def run_report(self, request: Any, **kwargs: Any) -> Any:
+        begin = time.perf_counter()
+        response = self._client.run_report(request, **kwargs)
+        elapsed = time.perf_counter() - begin
+        property_quota = None
+        if "property_quota" in response:
+            property_quota = response.property_quota
+        self._quota_log.record(request.property, property_quota, elapsed)
+        return response
+
+    def batch_run_reports(self, request: Any, **kwargs: Any) -> Any:
+        begin = time.perf_counter()
+        response = self._client.batch_run_reports(request, **kwargs)
+        elapsed = time.perf_counter() - begin
+        self._quota_log.record(
+            request.property, batch_property_quota(response.reports), elapsed
+        )
+        return response
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._client, name)
+
+
+class QuotaLog:
+    """Thread safe record of quota and latency for every GA4 call."""
+
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self.calls: List[Dict[str, Any]] = []
+
+    def wrap(self, client: Any) -> _RecordingClient:
+        """Return client with its run_report calls recorded here."""
+        return _RecordingClient(client, self)
+
+    def record(
+        self, prop: str, property_quota: Any, elapsed: float
+    ) -> None:
+        """Record one call; property_quota may be None if not returned."""
+        call: Dict[str, Any] = {"property": prop, "elapsed": elapsed}
+        for field in QUOTA_FIELDS:
+            if property_quota is not None and field in property_quota:
+                status = getattr(property_quota, field)
+                call[field] = {
+                    "consumed": status.consumed,
+                    "remaining": status.remaining,
+                }
+        with self._lock:
+            self.calls.append(call)
+
+    def extend(self, calls: List[Dict[str, Any]]) -> None:
+        """Add calls recorded by another QuotaLog, e.g. a worker's."""
+        with self._lock:
+            self.calls.extend(calls)
+
+    def summary(
+        self, names: Optional[Dict[str, str]] = None
+    ) -> Dict[str, Any]:
+        """Return the per-property and run totals as a dict.
+
+        names maps property resource names to display names.
+        """
+        names = names or {}
+        with self._lock:
+            calls = list(self.calls)
+
+        props: Dict[str, Dict[str, Any]] = defaultdict(
+            lambda: {"calls": 0, "tokens": 0, "elapsed": 0.0}
+        )
+        for call in calls:
+            entry = props[call["property"]]
+            entry["calls"] += 1
+            if "tokens_per_day" in call:
+                entry["tokens"] += call["tokens_per_day"]["consumed"]
+            entry["elapsed"] += call["elapsed"]
+            # Calls are appended as they finish, so the last seen
+            # remaining values are the most recent.
+            for field in QUOTA_FIELDS:
+                if field in call:
+                    entry[f"{field}_remaining"] = call[field]["remaining"]
+
+        properties = []
+        for prop, entry in sorted(props.items()):
+            entry = {"property": prop, "name": names.get(prop, ""), **entry}
+            entry["elapsed"] = round(entry["elapsed"], 3)
+            properties.append(entry)
+
+        slowest = sorted(properties, key=lambda e: e["elapsed"], reverse=True)
+        return {
+            "generated_at": time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+            "calls": len(calls),
+            "tokens": sum(e["tokens"] for e in properties),
+            "elapsed": round(sum(c["elapsed"] for c in calls), 3),
+            "min_tokens_per_hour_remaining": _min_field(
+                properties, "tokens_per_hour_remaining"
+            ),
+            "min_tokens_per_day_remaining": _min_field(
+                properties, "tokens_per_day_remaining"
+            ),
+            "slowest": [
+                {key: e[key] for key in ("property", "name", "elapsed")}
+                for e in slowest[:SLOWEST_COUNT]
+            ],
+            "properties": properties,
+        }
+
+    def write(
+        self, path: str, names: Optional[Dict[str, str]] = None
+    ) -> None:
+        """Write the summary as JSON and log a one-line digest."""
+        summary = self.summary(names)
+        with open(path, "w") as f:
+            json.dump(summary, f, indent=2)
+        message = (
+            f"GA4 quota: {summary['calls']} call(s), "
+            f"{summary['tokens']} token(s), min remaining "
+            f"hourly {summary['min_tokens_per_hour_remaining']} "
+            f"daily {summary['min_tokens_per_day_remaining']}"
+        )
+        if summary["slowest"]:
+            slowest = summary["slowest"][0]
+            message += (
+                f", slowest {slowest['name'] or slowest['property']} "
+                f"{slowest['elapsed']:.2f}s"
+            )
+        logger.info(f"{message} (details in {path})")
@@ -0,0 +1,210 @@
+"""
+realtime.py — Live map of where visitors are right now.
+
+For events and exhibitions, analytics-by-location-v4.py --realtime
+polls runRealtimeReport for active users by country in every property
+every --interval seconds.  Each property's latest answer is kept, and
+only the countries whose count changed since its previous answer are
+merged into the running totals.  Those countries are then patched into
+the interactive map written by plot_interactive_map.LiveMap, which the
+open page picks up without reloading.
+
+Users active on several properties are counted once for each, as the
+location report does.  Properties that fail to answer keep their
+previous counts until they do.
+
+The time from the start of a poll to its update being written is
+tracked as the poll to map latency, logged after every poll and
+summarised at the end.
+"""
+
+import logging
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime
+from typing import Any, Deque, Dict, Optional
+
+from google.analytics.data_v1beta.types import (
+    Dimension,
+    Metric,
+    RunRealtimeReportRequest,
+)
+from google.api_core.exceptions import GoogleAPICallError
+
+import country_ref
+from plot_interactive_map import LiveMap
+from retry import BudgetExceeded
+
+logger = logging.getLogger(__name__)
+
+REALTIME_METRIC = "activeUsers"
+DEFAULT_INTERVAL = 60
+
+# Latencies kept for the summary percentiles.
+LATENCY_WINDOW = 1000
+
+
+def realtime_request(prop: str) -> RunRealtimeReportRequest:
+    return RunRealtimeReportRequest(
+        property=prop,
+        dimensions=[Dimension(name="countryId")],
+        metrics=[Metric(name=REALTIME_METRIC)],
+    )
+
+
+def response_to_counts(response: Any) -> Dict[str, int]:
+    """Return a realtime response's active users by alpha-2 country."""
+    counts: Dict[str, int] = {}
+    for row in response.rows:
+        code = row.dimension_values[0].value
+        if code == "(not set)":
+            code = "ZZ"
+        counts[code] = counts.get(code, 0) + int(row.metric_values[0].value)
+    return counts
+
+
+class RealtimeTotals:
+    """Active users by country summed over properties' latest answers."""
+
+    def __init__(self) -> None:
+        self.totals: Dict[str, int] = {}
+        self._latest: Dict[str, Dict[str, int]] = {}
+        self._lock = threading.Lock()
+
+    def merge(self, prop: str, counts: Dict[str, int]) -> Dict[str, int]:
+        """Replace prop's counts; return the countries whose totals
+        changed, with their new totals.
+        """
+        changed = {}
+        with self._lock:
+            previous = self._latest.get(prop, {})
+            for code in previous.keys() | counts.keys():
+                delta = counts.get(code, 0) - previous.get(code, 0)
+                if delta:
+                    total = self.totals.get(code, 0) + delta
+                    self.totals[code] = total
+                    changed[code] = total
+            self._latest[prop] = counts
+        return changed
+
+
+class LatencyTracker:
+    """Recent poll to map latencies and their percentiles."""
+
+    def __init__(self) -> None:
+        self.latencies: Deque[float] = deque(maxlen=LATENCY_WINDOW)
+
+    def add(self, latency: float) -> None:
+        self.latencies.append(latency)
+
+    def percentile(self, fraction: float) -> float:
+        latencies = sorted(self.latencies)
+        return latencies[int(fraction * (len(latencies) - 1))]
+
+    def summary(self) -> str:
+        if not self.latencies:
+            return "no polls"
+        return (
+            f"p50 {self.percentile(0.5):.3f}s, "
+            f"p95 {self.percentile(0.95):.3f}s, "
+            f"max {max(self.latencies):.3f}s over "
+            f"{len(self.latencies)} poll(s)"
+        )
+
+
+def poll(
+    client: Any,
+    properties: Dict[str, str],
+    totals: RealtimeTotals,
+    executor: Optional[ThreadPoolExecutor] = None,
+) -> Dict[str, int]:
+    """Poll every property once; return the changed alpha-2 totals.
+
+    Each answer is merged as soon as it arrives.
+    """
+
+    def fetch(long_name: str, prop: str) -> Optional[Dict[str, int]]:
+        try:
+            response = client.run_realtime_report(realtime_request(prop))
+        except (GoogleAPICallError, BudgetExceeded) as e:
+            logger.warning(f"Couldn't poll {long_name}: {e}")
+            return None
+        return response_to_counts(response)
+
+    if executor is None:
+        answers = (
+            (prop, fetch(long_name, prop))
+            for long_name, prop in properties.items()
+        )
+    else:
+        futures = {
+            executor.submit(fetch, long_name, prop): prop
+            for long_name, prop in properties.items()
+        }
+        answers = (
+            (futures[future], future.result())
+            for future in as_completed(futures)
+        )
+    changed: Dict[str, int] = {}
+    for prop, counts in answers:
+        if counts is not None:
+            changed.update(totals.merge(prop, counts))
+    return changed
+
+
+def run(
+    clients: Any,
+    properties: Dict[str, str],
+    html_file: str,
+    interval: float = DEFAULT_INTERVAL,
+    jobs: int = 1,
+    retry: Any = None,
+    polls: Optional[int] = None,
+) -> LatencyTracker:
+    """Poll properties every interval seconds and keep html_file's map
+    up to date, until interrupted or after polls polls.
+
+    Returns the poll to map latencies.
+    """
+    client = clients.data
+    if retry is not None:
+        client = retry.wrap(client)
+    live_map = LiveMap(
+        html_file, REALTIME_METRIC, refresh_ms=int(min(interval, 5) * 1000)
+    )
+    logger.info(
+        f"Polling {len(properties)} properties every {interval}s, "
+        f"map in {html_file}"
+    )
+    totals = RealtimeTotals()
+    latency = LatencyTracker()
+    executor = ThreadPoolExecutor(max_workers=jobs) if jobs > 1 else None
+    count = 0
+    try:
+        while polls is None or count < polls:
+            count += 1
+            begin = time.monotonic()
+            when = datetime.now()
+            changed = poll(client, properties, totals, executor)
+            if changed or count == 1:
+                codes = country_ref.iso2_to_iso3(list(changed))
+                live_map.update(dict(zip(codes, changed.values())), when)
+            elapsed = time.monotonic() - begin
+            latency.add(elapsed)
+            logger.info(
+                f"Poll {count}: {len(changed)} countries changed, "
+                f"{sum(totals.totals.values())} active users, "
+                f"poll to map {elapsed:.3f}s"
+            )
+            if polls is not None and count >= polls:
+                break
+            time.sleep(max(0.0, interval - elapsed))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if executor is not None:
+            executor.shutdown(wait=False, cancel_futures=True)
+        logger.info(f"Poll to map latency: {latency.summary()}")
+    return latency
@@ -0,0 +1,156 @@
+"""
+report_cache.py — On-disk cache of GA4 runReport responses.
+
+GA4 data for a period stops changing a few days after the period ends,
+so responses for date ranges that ended before the settle window are
+stored in SQLite and reused by later runs.  Entries are keyed on the
+whole request (property, dimensions, metrics, date ranges and page), so
+adding a property or changing the skip list only fetches what is
+missing.  Requests that touch an unsettled day always go to the API.
+"""
+
+import hashlib
+import logging
+import os
+import sqlite3
+import threading
+import time
+from datetime import date, datetime, timedelta
+from typing import Any, Optional, cast
+
+from google.analytics.data_v1beta.types import (
+    RunReportRequest,
+    RunReportResponse,
+)
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_CACHE_DIR = os.path.join(
+    os.path.expanduser("~"), ".analytics", "cache"
+)
+
+# GA4 can take up to 72 hours to finish processing a day's data.
+DEFAULT_SETTLE_DAYS = 3
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS report (
+    key         TEXT PRIMARY KEY,
+    property    TEXT NOT NULL,
+    request     TEXT NOT NULL,
+    response    BLOB NOT NULL,
+    fetched_at  REAL NOT NULL
+)
+"""
+
+
+def request_key(request: RunReportRequest) -> str:
+    """Return a stable key for a request."""
+    text = RunReportRequest.to_json(request, sort_keys=True, indent=None)
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class ReportCache:
+    """
+    SQLite backed cache of runReport responses.
+
+    Args:
+        cache_dir (str): Directory holding reports.sqlite.
+        settle_days (int): Days after which a date is treated as final.
+        refresh (bool): Refetch settled requests and overwrite the
+            stored responses instead of reading them.
+    """
+
+    def __init__(
+        self,
+        cache_dir: str = DEFAULT_CACHE_DIR,
+        settle_days: int = DEFAULT_SETTLE_DAYS,
+        refresh: bool = False,
+    ) -> None:
+        os.makedirs(cache_dir, exist_ok=True)
+        self.path = os.path.join(cache_dir, "reports.sqlite")
+        self.settle_days = settle_days
+        self.refresh = refresh
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(self.path, check_same_thread=False)
+        with self._conn:
+            self._conn.execute(SCHEMA)
+
+    def is_settled(self, request: RunReportRequest) -> bool:
+        """Return True if every date range ended before the settle window."""
+        cutoff = date.today() - timedelta(days=self.settle_days)
+        for date_range in request.date_ranges:
+            try:
+                end = datetime.strptime(
+                    date_range.end_date, "%Y-%m-%d"
+                ).date()
+            except ValueError:
+                # Relative dates such as "yesterday" or "7daysAgo".
+                return False
+            if end >= cutoff:
+                return False
+        return len(request.date_ranges) > 0
+
+    def get(self, request: RunReportRequest) -> Optional[RunReportResponse]:
+        """Return the stored response for request, if any."""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT response FROM report WHERE key = ?",
+                (request_key(request),),
+            ).fetchone()
+        if row is None:
+            return None
+        return cast(RunReportResponse, RunReportResponse.deserialize(row[0]))
+
+    def put(
+        self, request: RunReportRequest, response: RunReportResponse
+    ) -> None:
+        """Store the response for request."""
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO report VALUES (?, ?, ?, ?, ?)",
+                (
+                    request_key(request),
+                    request.property,
+                    RunReportRequest.to_json(request, indent=None),
+                    RunReportResponse.serialize(response),
+                    time.time(),
+                ),
+            )
+
+    def lookup(
+        self, request: RunReportRequest
+    ) -> Optional[RunReportResponse]:
+        """Return a usable stored response for request, counting the
+        hit or miss."""
+        if self.is_settled(request) and not self.refresh:
+            response = self.get(request)
+            if response is not None:
+                with self._lock:
+                    self.hits += 1
+                logger.debug(f"Cache hit for {request.property}")
+                return response
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def store(
+        self, request: RunReportRequest, response: RunReportResponse
+    ) -> None:
+        """Store a fetched response if its date ranges have settled."""
+        if self.is_settled(request):
+            self.put(request, response)
+
+    def run_report(
+        self, client: Any, request: RunReportRequest
+    ) -> RunReportResponse:
+        """Answer request from the cache or with client.run_report()."""
+        response = self.lookup(request)
+        if response is None:
+            response = client.run_report(request)
+            self.store(request, response)
+        return response
+
+    def close(self) -> None:
+        self._conn.close()
@@ -0,0 +1,261 @@
+"""
+reports.py — Configured GA4 reports and the plan for fetching them.
+
+Reports are declared under "reports" in config.yaml, e.g.
+
+    reports:
+      - name: device
+        dimensions: [deviceCategory]
+        metrics: [sessions, screenPageViews]
+        dimension_filter:
+          filter:
+            field_name: countryId
+            string_filter:
+              value: US
+        date_ranges: [current]
+
+dimension_filter is a GA4 FilterExpression in its JSON form.
+date_ranges either names the run's periods ("current", "prev" and
+"yoy") or gives name, start_date and end_date mappings.  The
+defaults are no filter and all of the run's periods.  Metrics are
+summed across properties, so they should be counts.  The country
+report behind the CSV and maps is always run; an entry named
+"country" replaces its definition.
+
+The country report also asks GA4 for each property's totals in the
+same call, which are the site totals saved for analytics-reporter.rb;
+see site_totals.py.
+
+plan() turns one property's reports into as few API calls as it
+can.  Reports with the same dimensions, filter and date ranges share
+one request carrying the union of their metrics, up to the API's
+metric limit.  A metric such as totalUsers can't be summed over a
+dimension, so reports with different dimensions get requests of
+their own.  Those requests are then sent together in batchRunReports
+calls of up to five.
+"""
+
+import json
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from google.analytics.data_v1beta.types import (
+    DateRange,
+    Dimension,
+    FilterExpression,
+    Metric,
+    MetricAggregation,
+    RunReportRequest,
+)
+
+# Per request limits of the GA4 Data API.
+MAX_DIMENSIONS = 9
+MAX_METRICS = 10
+MAX_BATCH_REQUESTS = 5
+
+COUNTRY_REPORT = "country"
+CITY_REPORT = "city"
+
+# (name, start_date, end_date) as returned by get_date_ranges().
+DateRangeTuple = Tuple[str, str, str]
+
+
+class Report:
+    """
+    One report to run against every property.
+
+    Args:
+        name (str): Report name, used in the output file name.
+        dimensions (list): GA4 dimension names.
+        metrics (list): GA4 metric names.
+        dimension_filter (dict): Optional FilterExpression as JSON.
+        date_ranges (list): Optional run period names or
+            {name, start_date, end_date} mappings.
+        totals (bool): Also fetch the property's totals of the metrics.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        dimensions: Sequence[str],
+        metrics: Sequence[str],
+        dimension_filter: Optional[Dict[str, Any]] = None,
+        date_ranges: Optional[Sequence[Any]] = None,
+        totals: bool = False,
+    ) -> None:
+        if not dimensions:
+            raise ValueError(f"Report {name} has no dimensions")
+        if not metrics:
+            raise ValueError(f"Report {name} has no metrics")
+        if len(dimensions) > MAX_DIMENSIONS:
+            raise ValueError(
+                f"Report {name} has more than {MAX_DIMENSIONS} dimensions"
+            )
+        if len(metrics) > MAX_METRICS:
+            raise ValueError(
+                f"Report {name} has more than {MAX_METRICS} metrics"
+            )
+        self.name = name
+        self.dimensions = list(dimensions)
+        self.metrics = list(metrics)
+        self.dimension_filter = dimension_filter
+        self.date_ranges = date_ranges
+        self.totals = totals
+
+    @classmethod
+    def from_config(cls, entry: Dict[str, Any]) -> "Report":
+        return cls(
+            entry["name"],
+            entry["dimensions"],
+            entry["metrics"],
+            entry.get("dimension_filter"),
+            entry.get("date_ranges"),
+            totals=entry["name"] == COUNTRY_REPORT,
+        )
+
+    def to_config(self) -> Dict[str, Any]:
+        """Return the config.yaml entry from_config() reads back."""
+        entry: Dict[str, Any] = {
+            "name": self.name,
+            "dimensions": self.dimensions,
+            "metrics": self.metrics,
+        }
+        if self.dimension_filter:
+            entry["dimension_filter"] = self.dimension_filter
+        if self.date_ranges:
+            entry["date_ranges"] = list(self.date_ranges)
+        return entry
+
+    def resolve_date_ranges(
+        self, run_ranges: List[DateRangeTuple]
+    ) -> List[DateRangeTuple]:
+        """Return this report's date ranges for a run's periods."""
+        if not self.date_ranges:
+            return list(run_ranges)
+        by_name = {name: (name, start, end) for name, start, end in run_ranges}
+        resolved = []
+        for entry in self.date_ranges:
+            if isinstance(entry, str):
+                # Comparison periods are absent from --no-compare runs.
+                if entry in by_name:
+                    resolved.append(by_name[entry])
+            else:
+                resolved.append(
+                    (entry["name"], entry["start_date"], entry["end_date"])
+                )
+        if not resolved:
+            raise ValueError(f"Report {self.name} has no date ranges")
+        return resolved
+
+    def __repr__(self) -> str:
+        return (
+            f"Report({self.name!r}, {self.dimensions!r}, {self.metrics!r})"
+        )
+
+
+DEFAULT_REPORTS = [
+    Report(COUNTRY_REPORT, ["countryId"], [
+        "sessions",
+        "totalUsers",
+        "screenPageViews",
+    ], totals=True),
+]
+
+
+# Run with --city.  GA4's cityId is keyed on by CityAccumulator, with
+# the name and country to place the city on the map.
+CITY = Report(CITY_REPORT, ["cityId", "city", "countryId"], [
+    "sessions",
+    "totalUsers",
+    "screenPageViews",
+], date_ranges=["current"])
+
+
+def load_reports(entries: Optional[List[Dict[str, Any]]]) -> List[Report]:
+    """Return the reports for the "reports" entries of config.yaml."""
+    reports = {report.name: report for report in DEFAULT_REPORTS}
+    for entry in entries or []:
+        report = Report.from_config(entry)
+        reports[report.name] = report
+    return list(reports.values())
+
+
+class Query:
+    """One runReport request and the reports answered by it."""
+
+    def __init__(
+        self,
+        dimensions: List[str],
+        dimension_filter: Optional[Dict[str, Any]],
+        date_ranges: List[DateRangeTuple],
+    ) -> None:
+        self.dimensions = dimensions
+        self.dimension_filter = dimension_filter
+        self.date_ranges = date_ranges
+        self.metrics: List[str] = []
+        self.reports: List[Report] = []
+        self.totals = False
+
+    def fits(self, report: Report) -> bool:
+        """Return True if report's metrics fit in this request."""
+        metrics = set(self.metrics) | set(report.metrics)
+        return len(metrics) <= MAX_METRICS
+
+    def add(self, report: Report) -> None:
+        self.reports.append(report)
+        self.totals = self.totals or report.totals
+        for metric in report.metrics:
+            if metric not in self.metrics:
+                self.metrics.append(metric)
+
+    def request(self, prop: str) -> RunReportRequest:
+        request = RunReportRequest(
+            property=prop,
+            dimensions=[Dimension(name=name) for name in self.dimensions],
+            metrics=[Metric(name=name) for name in self.metrics],
+            date_ranges=[
+                DateRange(start_date=start, end_date=end, name=name)
+                for name, start, end in self.date_ranges
+            ],
+            return_property_quota=True,
+        )
+        if self.dimension_filter:
+            request.dimension_filter = FilterExpression(self.dimension_filter)
+        if self.totals:
+            request.metric_aggregations = [
+                MetricAggregation(MetricAggregation.TOTAL)
+            ]
+        return request
+
+
+def plan(
+    reports: List[Report], run_ranges: List[DateRangeTuple]
+) -> List[List[Query]]:
+    """Group reports into queries, and queries into batches of calls.
+
+    Each inner list is sent as one batchRunReports call, or as a plain
+    runReport call when it holds a single query.
+    """
+    queries: List[Query] = []
+    by_key: Dict[Tuple[Any, ...], List[Query]] = {}
+    for report in reports:
+        date_ranges = report.resolve_date_ranges(run_ranges)
+        key = (
+            tuple(report.dimensions),
+            json.dumps(report.dimension_filter, sort_keys=True),
+            tuple(date_ranges),
+        )
+        candidates = by_key.setdefault(key, [])
+        for query in candidates:
+            if query.fits(report):
+                break
+        else:
+            query = Query(
+                report.dimensions, report.dimension_filter, date_ranges
+            )
+            candidates.append(query)
+            queries.append(query)
+        query.add(report)
+    return [
+        queries[i:i + MAX_BATCH_REQUESTS]
+        for i in range(0, len(queries), MAX_BATCH_REQUESTS)
+    ]
@@ -0,0 +1,307 @@
+"""
+retry.py — Deadlines, retries and hedging for GA4 Data API calls.
+
+A GA4 call that hangs or fails used to stall or end the whole run.
+RetryPolicy wraps the Data API client so that every call
+
+    - is sent with a deadline, cut short so it never outlives the
+      run's time budget,
+    - is retried with jittered exponential backoff when it fails with
+      a retryable gRPC code, as long as attempts and budget remain,
+    - optionally gets a duplicate sent once it has taken longer than
+      the 95th percentile of recent calls, keeping whichever answer
+      comes back first.
+
+Given a RequestScheduler, each attempt first waits for it, for no
+longer than the call's deadline, and the call is timed from when it is
+sent, so quota waits don't count as latency.  No duplicate is sent
+while the scheduler is holding requests for the property back.
+
+Hedging trades quota for tail latency, since a hedged call is paid
+for twice, so it is off unless asked for.
+"""
+
+import logging
+import random
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Callable, Deque, Optional
+
+from google.api_core import exceptions
+
+from scheduler import RequestScheduler, response_quota
+
+logger = logging.getLogger(__name__)
+
+RETRYABLE = (
+    exceptions.DeadlineExceeded,
+    exceptions.ServiceUnavailable,
+    exceptions.InternalServerError,
+    exceptions.Aborted,
+    exceptions.ResourceExhausted,
+)
+
+DEFAULT_DEADLINE = 60.0
+DEFAULT_ATTEMPTS = 5
+INITIAL_BACKOFF = 1.0
+MAX_BACKOFF = 30.0
+BACKOFF_MULTIPLIER = 2.0
+
+# Latencies kept for the hedging percentile, and how many are needed
+# before hedging starts.
+LATENCY_WINDOW = 200
+MIN_HEDGE_SAMPLES = 20
+HEDGE_PERCENTILE = 0.95
+HEDGE_WORKERS = 32
+
+
+class BudgetExceeded(Exception):
+    """The run's time budget ran out before a call could finish."""
+
+
+class _RetryingClient:
+    """Data API client wrapper that applies a RetryPolicy."""
+
+    def __init__(
+        self,
+        client: Any,
+        policy: "RetryPolicy",
+        scheduler: Optional[RequestScheduler] = None,
+    ) -> None:
+        self._client = client
+        self._policy = policy
+        self._scheduler = scheduler
+
+    def run_report(self, request: Any) -> Any:
+        return self._policy.call(
+            self._client.run_report, request, self._scheduler
+        )
+
+    def batch_run_reports(self, request: Any) -> Any:
+        return self._policy.call(
+            self._client.batch_run_reports, request, self._scheduler
+        )
+
+    def run_realtime_report(self, request: Any) -> Any:
+        return self._policy.call(self._client.run_realtime_report, request)
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._client, name)
+
+
+class RetryPolicy:
+    """
+    Per-call deadline, retry and hedging settings.
+
+    Args:
+        deadline (float): Seconds allowed for each attempt.
+        attempts (int): Attempts per call, including the first.
+        hedge (bool): Send a duplicate of calls slower than the 95th
+            percentile of recent calls.
+        run_deadline (float): time.monotonic() by which the run must
+            finish, or None for no budget.
+    """
+
+    def __init__(
+        self,
+        deadline: float = DEFAULT_DEADLINE,
+        attempts: int = DEFAULT_ATTEMPTS,
+        hedge: bool = False,
+        run_deadline: Optional[float] = None,
+    ) -> None:
+        self.deadline = deadline
+        self.attempts = attempts
+        self.hedge = hedge
+        self.run_deadline = run_deadline
+        self.retries = 0
+        self.hedged = 0
+        self._latencies: Deque[float] = deque(maxlen=LATENCY_WINDOW)
+        self._lock = threading.Lock()
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    def with_budget(self, budget: Optional[float]) -> "RetryPolicy":
+        """Return a policy for a run that must end budget seconds from now.
+
+        The copy shares latency history and the hedging threads with
+        this policy but counts its own retries and hedges.
+        """
+        policy = RetryPolicy(self.deadline, self.attempts, self.hedge)
+        if budget is not None:
+            policy.run_deadline = time.monotonic() + budget
+        policy._latencies = self._latencies
+        policy._lock = self._lock
+        policy._executor = self._hedge_executor() if self.hedge else None
+        return policy
+
+    def wrap(
+        self, client: Any, scheduler: Optional[RequestScheduler] = None
+    ) -> _RetryingClient:
+        """Return client with its calls retried and hedged here, and
+        paced by scheduler in each attempt; client should not be
+        wrapped by scheduler itself.
+        """
+        return _RetryingClient(client, self, scheduler)
+
+    def remaining(self) -> Optional[float]:
+        """Return seconds left in the run's budget, if it has one."""
+        if self.run_deadline is None:
+            return None
+        return self.run_deadline - time.monotonic()
+
+    def _timeout(self) -> float:
+        remaining = self.remaining()
+        if remaining is None:
+            return self.deadline
+        if remaining <= 0:
+            raise BudgetExceeded("GA4 run time budget exceeded")
+        return min(self.deadline, remaining)
+
+    def _hedge_executor(self) -> ThreadPoolExecutor:
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=HEDGE_WORKERS, thread_name_prefix="hedge"
+                )
+            return self._executor
+
+    def hedge_delay(self) -> Optional[float]:
+        """Return the latency after which to hedge, once enough are known."""
+        with self._lock:
+            if len(self._latencies) < MIN_HEDGE_SAMPLES:
+                return None
+            latencies = sorted(self._latencies)
+        return latencies[int(HEDGE_PERCENTILE * (len(latencies) - 1))]
+
+    def _acquire(self, scheduler: RequestScheduler, request: Any) -> float:
+        timeout = self._timeout()
+        cost = scheduler.try_acquire(request.property, timeout)
+        if cost is None:
+            remaining = self.remaining()
+            if remaining is not None and remaining <= 0:
+                raise BudgetExceeded(
+                    "GA4 run time budget exceeded waiting for quota"
+                )
+            raise exceptions.DeadlineExceeded(
+                f"Waited {timeout:.1f}s for GA4 quota"
+            )
+        return cost
+
+    def _attempt(
+        self,
+        func: Callable[..., Any],
+        request: Any,
+        scheduler: Optional[RequestScheduler] = None,
+        sent: Optional[threading.Event] = None,
+    ) -> Any:
+        if scheduler is None:
+            if sent is not None:
+                sent.set()
+            return self._send(func, request)
+        try:
+            cost = self._acquire(scheduler, request)
+        finally:
+            if sent is not None:
+                sent.set()
+        # Only an acquired request is released.
+        response = None
+        try:
+            response = self._send(func, request)
+        finally:
+            scheduler.release(request.property, cost, response_quota(response))
+        return response
+
+    def _send(self, func: Callable[..., Any], request: Any) -> Any:
+        timeout = self._timeout()
+        begin = time.monotonic()
+        response = func(request, timeout=timeout)
+        with self._lock:
+            self._latencies.append(time.monotonic() - begin)
+        return response
+
+    def _hedged_attempt(
+        self,
+        func: Callable[..., Any],
+        request: Any,
+        scheduler: Optional[RequestScheduler] = None,
+    ) -> Any:
+        delay = self.hedge_delay()
+        if delay is None:
+            return self._attempt(func, request, scheduler)
+        executor = self._hedge_executor()
+        sent = threading.Event()
+        pending = {
+            executor.submit(self._attempt, func, request, scheduler, sent)
+        }
+        # Time the call from when it is sent, not from its wait for quota.
+        sent.wait()
+        done, pending = wait(pending, timeout=delay)
+        if not done:
+            if scheduler is not None and scheduler.throttled(request.property):
+                logger.debug(
+                    f"{request.property}: not hedging while throttled"
+                )
+            else:
+                with self._lock:
+                    self.hedged += 1
+                logger.debug(
+                    f"{request.property}: hedging after {delay:.2f}s"
+                )
+                pending.add(
+                    executor.submit(self._attempt, func, request, scheduler)
+                )
+        error: Optional[BaseException] = None
+        try:
+            while True:
+                for future in done:
+                    if future.exception() is None:
+                        return future.result()
+                    error = future.exception()
+                if not pending:
+                    assert error is not None
+                    raise error
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+        finally:
+            # The loser can't be stopped once sent, but one still waiting
+            # for a hedging thread needn't be.
+            for future in pending:
+                future.cancel()
+
+    def call(
+        self,
+        func: Callable[..., Any],
+        request: Any,
+        scheduler: Optional[RequestScheduler] = None,
+    ) -> Any:
+        """Call func(request, timeout=...) under this policy, paced by
+        scheduler if given.
+        """
+        attempt = 0
+        while True:
+            attempt += 1
+            try:
+                if self.hedge:
+                    return self._hedged_attempt(func, request, scheduler)
+                return self._attempt(func, request, scheduler)
+            except RETRYABLE as e:
+                if attempt >= self.attempts:
+                    raise
+                backoff = random.uniform(
+                    0,
+                    min(
+                        MAX_BACKOFF,
+                        INITIAL_BACKOFF * BACKOFF_MULTIPLIER ** (attempt - 1),
+                    ),
+                )
+                remaining = self.remaining()
+                if remaining is not None and backoff >= remaining:
+                    raise
+                with self._lock:
+                    self.retries += 1
+                logger.debug(
+                    f"{request.property}: {type(e).__name__}, retrying "
+                    f"in {backoff:.2f}s (attempt {attempt + 1} of "
+                    f"{self.attempts})"
+                )
+                time.sleep(backoff)
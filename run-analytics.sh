@@ -22,10 +22,6 @@ fi
 
 ./storage-reporter.rb "$@"
 
-sleep 5
-
-./analytics-reporter.rb "$@"
-
 # unset rvm environment
 { type -t __rvm_unload >/dev/null; } && __rvm_unload
 
@@ -34,10 +30,18 @@ unset GEM_HOME
 unset GEM_PATH
 unset RUBY_VERSION
 
-sleep 5
-
 source "$HOME/venv/analytics/bin/activate"
 
-./analytics-by-location-v4.py "$@"
+# Runs first so that analytics-reporter.rb can use the site totals it
+# saves instead of querying every property again.  The report queries
+# GA4 itself when they are missing, so a failure here must not stop it.
+./analytics-by-location-v4.py "$@" ||
+    echo "analytics-by-location-v4.py failed, continuing without site totals" >&2
 
 deactivate
+
+if [ -f "$HOME/.rvm/scripts/rvm" ]; then
+	source "$HOME/.rvm/scripts/rvm"
+fi
+
+./analytics-reporter.rb "$@"
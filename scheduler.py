@@ -0,0 +1,263 @@
+"""
+scheduler.py — Quota-aware pacing of GA4 Data API requests.
+
+Fanning requests out as fast as the thread pool allows runs into the
+GA4 concurrent request and hourly token limits, and throttled requests
+fail.  RequestScheduler sits between the fetch code and the Data API
+client and only lets a request start when
+
+    - fewer than max_in_flight requests are running overall and fewer
+      than the per-property concurrent request limit for its property,
+    - its property's hourly token bucket, and the optional project
+      bucket, hold enough tokens for the request's expected cost.
+
+Costs start at a guess and are learned from the tokens each response
+reports it consumed; bucket levels are pulled down to the remaining
+tokens the API reports.  A request that has to wait blocks only its own
+thread, so requests for other properties go ahead of it.
+
+With a RetryPolicy the wait is part of each attempt, see
+RetryPolicy.wrap(), and try_acquire() lets the run's budget bound it
+while the policy's latencies leave it out.
+"""
+
+import logging
+import threading
+import time
+from collections import defaultdict
+from typing import Any, Dict, List, Optional, Tuple
+
+from google.analytics.data_v1beta.types import BatchRunReportsResponse
+
+from quota import batch_property_quota
+
+logger = logging.getLogger(__name__)
+
+# Standard GA4 property limits.  The project per property hourly limit
+# is the tighter of the two hourly limits.
+PROPERTY_TOKENS_PER_HOUR = 14000
+PROPERTY_CONCURRENT_REQUESTS = 10
+
+DEFAULT_MAX_IN_FLIGHT = 10
+
+# Expected tokens for a request before any have been measured.
+DEFAULT_COST = 10.0
+
+# Weight of the latest measurement in the learned cost.
+COST_SMOOTHING = 0.3
+
+
+class TokenBucket:
+    """Token bucket refilled continuously at capacity per hour."""
+
+    def __init__(self, capacity: float, per_seconds: float = 3600) -> None:
+        self.capacity = capacity
+        self.rate = capacity / per_seconds
+        self.level = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now: float) -> None:
+        self.level = min(
+            self.capacity, self.level + (now - self.updated) * self.rate
+        )
+        self.updated = now
+
+    def wait_time(self, cost: float, now: float) -> float:
+        """Return seconds until cost tokens are available."""
+        self._refill(now)
+        # A request costing more than the whole bucket can still run
+        # once the bucket is full.
+        cost = min(cost, self.capacity)
+        if self.level >= cost:
+            return 0.0
+        return (cost - self.level) / self.rate
+
+    def take(self, cost: float) -> None:
+        self.level -= cost
+
+    def clamp(self, remaining: float) -> None:
+        """Lower the level to what the API says is left."""
+        self.level = min(self.level, remaining)
+
+
+def response_quota(response: Any) -> Any:
+    """Return the PropertyQuota of a run_report or batch_run_reports
+    response, or None if it has none.
+    """
+    if response is None:
+        return None
+    if isinstance(response, BatchRunReportsResponse):
+        return batch_property_quota(response.reports)
+    if "property_quota" in response:
+        return response.property_quota
+    return None
+
+
+class _ScheduledClient:
+    """Data API client wrapper that paces run_report calls."""
+
+    def __init__(self, client: Any, scheduler: "RequestScheduler") -> None:
+        self._client = client
+        self._scheduler = scheduler
+
+    def _call(self, func: Any, request: Any, **kwargs: Any) -> Any:
+        prop = request.property
+        cost = self._scheduler.acquire(prop)
+        response = None
+        try:
+            response = func(request, **kwargs)
+        finally:
+            self._scheduler.release(prop, cost, response_quota(response))
+        return response
+
+    def run_report(self, request: Any, **kwargs: Any) -> Any:
+        return self._call(self._client.run_report, request, **kwargs)
+
+    def batch_run_reports(self, request: Any, **kwargs: Any) -> Any:
+        # A batch counts as one request against the concurrency limits.
+        return self._call(self._client.batch_run_reports, request, **kwargs)
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._client, name)
+
+
+class RequestScheduler:
+    """
+    Token bucket and concurrency limits for GA4 Data API calls.
+
+    Args:
+        max_in_flight (int): Requests allowed to run at once overall.
+        property_tokens_per_hour (float): Hourly tokens per property.
+        project_tokens_per_hour (float): Optional hourly tokens for all
+            properties together.
+        property_concurrency (int): Requests allowed to run at once
+            for one property.
+    """
+
+    def __init__(
+        self,
+        max_in_flight: int = DEFAULT_MAX_IN_FLIGHT,
+        property_tokens_per_hour: float = PROPERTY_TOKENS_PER_HOUR,
+        project_tokens_per_hour: Optional[float] = None,
+        property_concurrency: int = PROPERTY_CONCURRENT_REQUESTS,
+    ) -> None:
+        self.max_in_flight = max_in_flight
+        self.property_concurrency = property_concurrency
+        self.property_tokens_per_hour = property_tokens_per_hour
+        self._cond = threading.Condition()
+        self._in_flight = 0
+        self._prop_in_flight: Dict[str, int] = defaultdict(int)
+        self._buckets: Dict[str, TokenBucket] = {}
+        self._project_bucket = None
+        if project_tokens_per_hour:
+            self._project_bucket = TokenBucket(project_tokens_per_hour)
+        self._costs: Dict[str, float] = {}
+        self.waited = 0.0
+
+    def wrap(self, client: Any) -> _ScheduledClient:
+        """Return client with its run_report calls paced here."""
+        return _ScheduledClient(client, self)
+
+    def _prop_buckets(self, prop: str) -> List[TokenBucket]:
+        if prop not in self._buckets:
+            self._buckets[prop] = TokenBucket(self.property_tokens_per_hour)
+        buckets = [self._buckets[prop]]
+        if self._project_bucket is not None:
+            buckets.append(self._project_bucket)
+        return buckets
+
+    def _cost(self, prop: str) -> float:
+        if prop in self._costs:
+            return self._costs[prop]
+        # Properties tend to cost alike, so start from the average.
+        if self._costs:
+            return sum(self._costs.values()) / len(self._costs)
+        return DEFAULT_COST
+
+    def _blocked(self, prop: str, now: float) -> Tuple[bool, float]:
+        """Return whether prop is at a concurrency limit and the seconds
+        until its buckets hold a request's tokens.
+        """
+        cost = self._cost(prop)
+        wait = max(
+            bucket.wait_time(cost, now) for bucket in self._prop_buckets(prop)
+        )
+        busy = (
+            self._in_flight >= self.max_in_flight
+            or self._prop_in_flight[prop] >= self.property_concurrency
+        )
+        return busy, wait
+
+    def throttled(self, prop: str) -> bool:
+        """Return whether a request for prop would have to wait now."""
+        with self._cond:
+            busy, wait = self._blocked(prop, time.monotonic())
+        return busy or wait > 0
+
+    def acquire(self, prop: str) -> float:
+        """Block until a request for prop may start; return its cost."""
+        cost = self.try_acquire(prop)
+        assert cost is not None
+        return cost
+
+    def try_acquire(
+        self, prop: str, timeout: Optional[float] = None
+    ) -> Optional[float]:
+        """Like acquire(), but return None without starting the request
+        if it still can't start after timeout seconds.
+        """
+        begin = time.monotonic()
+        with self._cond:
+            while True:
+                now = time.monotonic()
+                busy, wait = self._blocked(prop, now)
+                if not busy and wait == 0:
+                    break
+                if timeout is not None and now - begin >= timeout:
+                    self.waited += now - begin
+                    return None
+                if wait > 1:
+                    logger.debug(f"{prop}: waiting {wait:.1f}s for tokens")
+                # Wake on a release, or when the tokens should be back.
+                sleep = wait if wait > 0 else None
+                if timeout is not None:
+                    sleep = min(sleep or timeout, begin + timeout - now)
+                self._cond.wait(sleep)
+            cost = self._cost(prop)
+            buckets = self._prop_buckets(prop)
+            for bucket in buckets:
+                bucket.take(cost)
+            self._in_flight += 1
+            self._prop_in_flight[prop] += 1
+            self.waited += time.monotonic() - begin
+        return cost
+
+    def release(
+        self, prop: str, cost: float, property_quota: Any = None
+    ) -> None:
+        """Finish a request, learning from the quota it reported."""
+        with self._cond:
+            self._in_flight -= 1
+            self._prop_in_flight[prop] -= 1
+            if property_quota is not None:
+                self._learn(prop, cost, property_quota)
+            self._cond.notify_all()
+
+    def _learn(self, prop: str, cost: float, property_quota: Any) -> None:
+        consumed = property_quota.tokens_per_hour.consumed
+        buckets = self._prop_buckets(prop)
+        # Settle up the difference between the estimate and actual use.
+        for bucket in buckets:
+            bucket.take(consumed - cost)
+        if prop in self._costs:
+            error = consumed - self._costs[prop]
+            self._costs[prop] += COST_SMOOTHING * error
+        else:
+            self._costs[prop] = float(consumed)
+        for field in ("tokens_per_hour", "tokens_per_project_per_hour"):
+            if field in property_quota:
+                buckets[0].clamp(getattr(property_quota, field).remaining)
+        if "tokens_per_day" in property_quota:
+            remaining = property_quota.tokens_per_day.remaining
+            if remaining < self._costs[prop]:
+                logger.warning(f"{prop}: only {remaining} daily tokens left")
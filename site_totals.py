@@ -0,0 +1,151 @@
+"""
+site_totals.py — Property totals shared with the site totals report.
+
+analytics-reporter.rb used to make its own runReport calls for each
+property's sessions, users and pageviews, after which the location
+report queried every property again by country.  The country report
+now asks for metric_aggregations=[TOTAL], so the call that returns a
+property's country rows also returns its totals, and get_analytics()
+saves them for analytics-reporter.rb to read instead of calling GA4.
+
+The totals are written to totals_dir (":totals_dir:" in config.yaml,
+like the other keys, though "totals_dir:" is read too; default
+~/.analytics/totals) as site_totals_<account>_<start>_<end>.json,
+with <account> as in the CSV name, e.g.
+site_totals_all_2025-01-01_2025-03-31.json:
+
+    {
+      "version": 1,
+      "start_date": "2025-01-01",
+      "end_date": "2025-03-31",
+      "fetched_at": "2025-04-01T06:00:12.345678-04:00",
+      "date_ranges": [["current", "2025-01-01", "2025-03-31"],
+                      ["prev", "2024-10-01", "2024-12-31"],
+                      ["yoy", "2024-01-01", "2024-03-31"]],
+      "metrics": ["sessions", "totalUsers", "screenPageViews"],
+      "properties": {
+        "<account>:<site>": {
+          "property": "properties/123456789",
+          "totals": {"current": [1234, 987, 4567],
+                     "prev": [...], "yoy": [...]}
+        }
+      },
+      "missing": {"<account>:<site>": "<why it couldn't be fetched>"}
+    }
+
+Each list in "totals" holds the property's totals of "metrics", in
+that order, for the date range of that name.  totalUsers is GA4's
+count of distinct users over the whole property, as a runReport
+without dimensions would give, not a sum over countries.  Properties
+in the skip list or in "missing" are absent, and readers should
+fetch those themselves.  Totals come from the country report, so
+runs using the daily store (--daily) write none.
+"""
+
+import json
+import os
+import threading
+from typing import Any, Dict, List, Tuple
+
+DEFAULT_TOTALS_DIR = os.path.join(
+    os.path.expanduser("~"), ".analytics", "totals"
+)
+
+FORMAT_VERSION = 1
+
+# (name, start_date, end_date) as returned by get_date_ranges().
+DateRangeTuple = Tuple[str, str, str]
+
+
+def totals_path(
+    totals_dir: str, account: str, start_date: str, end_date: str
+) -> str:
+    return os.path.join(
+        totals_dir, f"site_totals_{account}_{start_date}_{end_date}.json"
+    )
+
+
+def parse_totals(
+    response: Any, date_ranges: List[DateRangeTuple]
+) -> Dict[str, Dict[str, int]]:
+    """Return a response's TOTAL rows as {date range: {metric: value}}.
+
+    date_ranges are the ranges of the request, needed to name the
+    totals when there is only one and so no dateRange dimension.
+    """
+    dimensions = [header.name for header in response.dimension_headers]
+    metrics = [header.name for header in response.metric_headers]
+    totals = {}
+    for row in response.totals:
+        if "dateRange" in dimensions:
+            name = row.dimension_values[dimensions.index("dateRange")].value
+        else:
+            name = date_ranges[0][0]
+        totals[name] = {
+            metric: int(value.value)
+            for metric, value in zip(metrics, row.metric_values)
+        }
+    return totals
+
+
+class SiteTotals:
+    """Properties' totals, added from several threads and then written."""
+
+    def __init__(self) -> None:
+        self._properties: Dict[str, Tuple[str, Dict[str, Any]]] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._properties)
+
+    def add(
+        self, long_name: str, prop: str, totals: Dict[str, Dict[str, int]]
+    ) -> None:
+        with self._lock:
+            self._properties[long_name] = (prop, totals)
+
+    def write(
+        self,
+        path: str,
+        start_date: str,
+        end_date: str,
+        date_ranges: List[DateRangeTuple],
+        metrics: List[str],
+        fetched_at: str,
+        missing: Dict[str, str],
+    ) -> None:
+        """Write the totals in the format described above.
+
+        Date ranges or metrics GA4 returned no totals for, as for a
+        property without any sessions, are written as 0.
+        """
+        with self._lock:
+            properties = dict(self._properties)
+        data = {
+            "version": FORMAT_VERSION,
+            "start_date": start_date,
+            "end_date": end_date,
+            "fetched_at": fetched_at,
+            "date_ranges": [list(date_range) for date_range in date_ranges],
+            "metrics": metrics,
+            "properties": {
+                long_name: {
+                    "property": prop,
+                    "totals": {
+                        name: [
+                            totals.get(name, {}).get(metric, 0)
+                            for metric in metrics
+                        ]
+                        for name, _, _ in date_ranges
+                    },
+                }
+                for long_name, (prop, totals) in sorted(properties.items())
+            },
+            "missing": missing,
+        }
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(data, f, indent=2)
+            f.write("\n")
+        os.replace(tmp_path, path)
@@ -1,6 +1,24 @@
 from datetime import datetime
 import fiscalyear as fy
+import os
+import pandas as pd
 import re
+import yaml
+
+CONFIG_FILE = os.path.join(
+    os.path.dirname(os.path.realpath(__file__)), "config.yaml"
+)
+
+
+def load_config(config_file=CONFIG_FILE):
+    """Return config.yaml as a dict.
+
+    The Ruby scripts read the same file with symbol keys such as
+    :skip_list:, so a leading ":" is dropped from the keys.
+    """
+    with open(config_file) as f:
+        config = yaml.safe_load(f) or {}
+    return {k.lstrip(":"): v for k, v in config.items()}
 
 
 def convert_date(date_str):
@@ -36,3 +54,51 @@ def titlecase(text, exceptions="and by the"):
         lword = word.lower()
         text[i] = word.title() if i == 0 or lword not in exceptions else lword
     return " ".join(text)
+
+
+METRICS = ["sessions", "users", "pageviews"]
+
+# Comparison periods in the location CSV, keyed by the suffix of their
+# columns, e.g. pageviews_prev and pageviews_chg_prev.
+COMPARISONS = {
+    "prev": "previous period",
+    "yoy": "same period last year",
+}
+
+
+def metric_choices():
+    return METRICS + [
+        f"{metric}_chg_{name}" for metric in METRICS for name in COMPARISONS
+    ]
+
+
+def split_change_metric(metric):
+    """Split e.g. pageviews_chg_prev into ("pageviews", "prev").
+
+    The comparison is None for plain metrics.
+    """
+    if "_chg_" in metric:
+        base, name = metric.split("_chg_", 1)
+        return base, name
+    return metric, None
+
+
+def with_change_columns(df):
+    """Return the location CSV frame for df, which holds the metrics and
+    the comparison periods' values, adding the change columns.
+
+    Comparison periods that are absent or all empty are left out.
+    """
+    metrics = sorted(METRICS)
+    columns = {metric: df[metric] for metric in metrics}
+    for name in COMPARISONS:
+        first = f"{metrics[0]}_{name}"
+        if first not in df.columns or df[first].isna().all():
+            continue
+        for metric in metrics:
+            columns[f"{metric}_{name}"] = df[f"{metric}_{name}"]
+        for metric in metrics:
+            columns[f"{metric}_chg_{name}"] = (
+                df[metric] - df[f"{metric}_{name}"]
+            )
+    return pd.DataFrame(columns, index=df.index)
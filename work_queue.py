@@ -0,0 +1,452 @@
+"""
+work_queue.py — Shared queue of properties for distributed fetches.
+
+A run over hundreds of properties is bounded by one machine's GA4
+quota and connections.  With --queue, get_analytics() becomes the
+coordinator: it adds a job per property to a WorkQueue, a SQLite file
+on storage every worker can reach, and merges the results as workers
+finish them.  Workers, started on any number of hosts with
+
+    ./analytics-by-location-v4.py --worker /shared/queue.sqlite \\
+        --credentials ~/.analytics/other-project.json
+
+lease jobs, fetch the property with their own credentials, cache and
+quota, and write the property's frames, site totals and the quota its
+calls used as JSON under the results directory, by default
+queue.sqlite.results/ next to it.
+
+A lease lasts lease_seconds and is renewed while the worker is busy,
+so a job whose worker dies is handed to another once its lease runs
+out.  A job that fails is retried after a delay that grows with its
+attempts, and is given up on, and the property reported as missing,
+after max_attempts.  Only the worker holding a job's lease can finish
+it, so a job is merged at most once however often it was leased.
+
+Everything goes through SQLite's file locks, so several workers on one
+machine, e.g. started with --local-workers, are enough to test it.
+Leave SQLite's default rollback journal on network file systems; WAL
+mode needs shared memory between the processes.
+"""
+
+import json
+import logging
+import os
+import shutil
+import socket
+import sqlite3
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    NamedTuple,
+    Optional,
+    Tuple,
+    Type,
+    cast,
+)
+
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_LEASE_SECONDS = 300.0
+DEFAULT_MAX_ATTEMPTS = 3
+RETRY_DELAY = 30.0
+POLL_INTERVAL = 1.0
+
+# Seconds to wait for another process's lock on the queue.
+BUSY_TIMEOUT = 60.0
+
+PENDING = "pending"
+LEASED = "leased"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS run (
+    run_id          TEXT PRIMARY KEY,
+    params          TEXT NOT NULL,
+    lease_seconds   REAL NOT NULL,
+    max_attempts    INTEGER NOT NULL,
+    created_at      REAL NOT NULL,
+    closed          INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS job (
+    job_id          INTEGER PRIMARY KEY,
+    run_id          TEXT NOT NULL,
+    long_name       TEXT NOT NULL,
+    property        TEXT NOT NULL,
+    state           TEXT NOT NULL,
+    attempts        INTEGER NOT NULL DEFAULT 0,
+    worker          TEXT,
+    lease_until     REAL,
+    error           TEXT,
+    UNIQUE (run_id, long_name)
+);
+CREATE INDEX IF NOT EXISTS job_state ON job (state, lease_until);
+"""
+
+
+class Job(NamedTuple):
+    job_id: int
+    run_id: str
+    long_name: str
+    prop: str
+    state: str
+    attempts: int
+    error: Optional[str]
+
+
+def default_worker_id() -> str:
+    return f"{socket.gethostname()}:{os.getpid()}"
+
+
+def encode_frames(frames: Dict[str, pd.DataFrame]) -> Dict[str, Any]:
+    """Return report frames of integer counts in a JSON friendly form."""
+    return {
+        name: {
+            "index_names": list(df.index.names),
+            "index": df.index.tolist(),
+            "columns": df.columns.tolist(),
+            "data": df.to_numpy().tolist(),
+        }
+        for name, df in frames.items()
+    }
+
+
+def decode_frames(data: Dict[str, Any]) -> Dict[str, pd.DataFrame]:
+    """Return the frames given to encode_frames()."""
+    frames = {}
+    for name, frame in data.items():
+        names = frame["index_names"]
+        if len(names) > 1:
+            index = pd.MultiIndex.from_tuples(
+                [tuple(key) for key in frame["index"]], names=names
+            )
+        else:
+            index = pd.Index(frame["index"], name=names[0])
+        frames[name] = pd.DataFrame(
+            frame["data"], index=index, columns=frame["columns"],
+            dtype="int64",
+        )
+    return frames
+
+
+class WorkQueue:
+    """
+    SQLite queue of property jobs shared by a coordinator and workers.
+
+    Args:
+        path (str): The SQLite file.
+        results_dir (str): Where workers write results; defaults to
+            path with ".results" added.
+    """
+
+    def __init__(self, path: str, results_dir: Optional[str] = None) -> None:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.path = path
+        self.results_dir = results_dir or f"{path}.results"
+        self._lock = threading.Lock()
+        # Transactions are begun explicitly, see _transaction().
+        self._conn = sqlite3.connect(
+            path,
+            timeout=BUSY_TIMEOUT,
+            isolation_level=None,
+            check_same_thread=False,
+        )
+        with self._transaction() as conn:
+            for statement in SCHEMA.split(";"):
+                if statement.strip():
+                    conn.execute(statement)
+        self._params: Dict[str, Dict[str, Any]] = {}
+
+    @contextmanager
+    def _transaction(self) -> Iterator[sqlite3.Connection]:
+        """Hold the queue's write lock, so a job is leased only once."""
+        with self._lock:
+            self._conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield self._conn
+            except BaseException:
+                self._conn.execute("ROLLBACK")
+                raise
+            self._conn.execute("COMMIT")
+
+    def _result_path(self, run_id: str, job_id: int) -> str:
+        return os.path.join(self.results_dir, run_id, f"{job_id}.json")
+
+    def submit(
+        self,
+        params: Dict[str, Any],
+        properties: List[Tuple[str, str]],
+        lease_seconds: float = DEFAULT_LEASE_SECONDS,
+        max_attempts: int = DEFAULT_MAX_ATTEMPTS,
+    ) -> str:
+        """Add a run of (long_name, property) jobs; return its id.
+
+        params is whatever the workers need to fetch a property, as
+        JSON.
+        """
+        run_id = uuid.uuid4().hex
+        with self._transaction() as conn:
+            conn.execute(
+                "INSERT INTO run (run_id, params, lease_seconds,"
+                " max_attempts, created_at) VALUES (?, ?, ?, ?, ?)",
+                (run_id, json.dumps(params), lease_seconds, max_attempts,
+                 time.time()),
+            )
+            conn.executemany(
+                "INSERT INTO job (run_id, long_name, property, state)"
+                " VALUES (?, ?, ?, ?)",
+                [(run_id, long_name, prop, PENDING)
+                 for long_name, prop in properties],
+            )
+        logger.info(
+            f"Queued {len(properties)} properties as run {run_id} "
+            f"in {self.path}"
+        )
+        return run_id
+
+    def params(self, run_id: str) -> Dict[str, Any]:
+        """Return the params a run was submitted with."""
+        if run_id not in self._params:
+            with self._lock:
+                row = self._conn.execute(
+                    "SELECT params FROM run WHERE run_id = ?", (run_id,)
+                ).fetchone()
+            self._params[run_id] = json.loads(row[0])
+        return self._params[run_id]
+
+    def lease(self, worker: str) -> Optional[Job]:
+        """Lease the next job of an open run to worker, if there is one.
+
+        Jobs whose lease ran out on their last attempt are failed first.
+        """
+        now = time.time()
+        with self._transaction() as conn:
+            conn.execute(
+                "UPDATE job SET state = ?, error = 'lease expired'"
+                " WHERE state = ? AND lease_until < ? AND attempts >="
+                " (SELECT max_attempts FROM run"
+                "  WHERE run.run_id = job.run_id)",
+                (FAILED, LEASED, now),
+            )
+            row = conn.execute(
+                "SELECT job_id, job.run_id, long_name, property, attempts,"
+                " lease_seconds FROM job JOIN run USING (run_id)"
+                " WHERE NOT closed AND state IN (?, ?)"
+                " AND (lease_until IS NULL OR lease_until < ?)"
+                " ORDER BY job_id LIMIT 1",
+                (PENDING, LEASED, now),
+            ).fetchone()
+            if row is None:
+                return None
+            job_id, run_id, long_name, prop, attempts, lease_seconds = row
+            conn.execute(
+                "UPDATE job SET state = ?, worker = ?, lease_until = ?,"
+                " attempts = attempts + 1 WHERE job_id = ?",
+                (LEASED, worker, now + lease_seconds, job_id),
+            )
+        return Job(job_id, run_id, long_name, prop, LEASED, attempts + 1,
+                   None)
+
+    def renew(self, job: Job, worker: str) -> bool:
+        """Extend worker's lease on job; return False if it was lost."""
+        with self._transaction() as conn:
+            cursor = conn.execute(
+                "UPDATE job SET lease_until = ? + (SELECT lease_seconds"
+                " FROM run WHERE run.run_id = job.run_id)"
+                " WHERE job_id = ? AND worker = ? AND state = ?",
+                (time.time(), job.job_id, worker, LEASED),
+            )
+        return cursor.rowcount == 1
+
+    @contextmanager
+    def heartbeat(self, job: Job, worker: str) -> Iterator[None]:
+        """Keep renewing worker's lease on job while in the block."""
+        lease_seconds = self._lease_seconds(job.run_id)
+        stop = threading.Event()
+
+        def renew() -> None:
+            while not stop.wait(lease_seconds / 3):
+                if not self.renew(job, worker):
+                    logger.warning(f"Lost the lease on {job.long_name}")
+                    return
+
+        thread = threading.Thread(target=renew, daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
+
+    def _lease_seconds(self, run_id: str) -> float:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT lease_seconds FROM run WHERE run_id = ?", (run_id,)
+            ).fetchone()
+        return float(row[0])
+
+    def complete(self, job: Job, worker: str, result: Dict[str, Any]) -> bool:
+        """Save job's result and mark it done.
+
+        Returns False, and the job is left to whoever holds it now, if
+        worker's lease was lost or the run was closed.
+        """
+        path = self._result_path(job.run_id, job.job_id)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(result, f)
+        with self._transaction() as conn:
+            cursor = conn.execute(
+                "UPDATE job SET state = ?, lease_until = NULL"
+                " WHERE job_id = ? AND worker = ? AND state = ?",
+                (DONE, job.job_id, worker, LEASED),
+            )
+            if cursor.rowcount == 1:
+                os.replace(tmp_path, path)
+        if cursor.rowcount != 1:
+            os.remove(tmp_path)
+            return False
+        return True
+
+    def fail(self, job: Job, worker: str, error: str) -> None:
+        """Give job back to be retried later, or fail it if that was
+        its last attempt.
+        """
+        with self._transaction() as conn:
+            conn.execute(
+                "UPDATE job SET state = CASE WHEN attempts >="
+                " (SELECT max_attempts FROM run"
+                "  WHERE run.run_id = job.run_id) THEN ? ELSE ? END,"
+                " lease_until = ? + ? * attempts, error = ?"
+                " WHERE job_id = ? AND worker = ? AND state = ?",
+                (FAILED, PENDING, time.time(), RETRY_DELAY, error,
+                 job.job_id, worker, LEASED),
+            )
+
+    def counts(self, run_id: str) -> Dict[str, int]:
+        """Return how many of a run's jobs are in each state."""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT state, COUNT(*) FROM job WHERE run_id = ?"
+                " GROUP BY state",
+                (run_id,),
+            ).fetchall()
+        return dict(rows)
+
+    def wait(
+        self,
+        run_id: str,
+        timeout: Optional[float] = None,
+        poll_interval: float = POLL_INTERVAL,
+    ) -> Iterator[Job]:
+        """Yield a run's jobs as they are done or failed, until all of
+        them are or timeout seconds have passed.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        seen = set()
+        while True:
+            # Counted first, so that jobs finishing in between are
+            # still yielded below before returning.
+            open_jobs = self._open_jobs(run_id)
+            with self._lock:
+                rows = self._conn.execute(
+                    "SELECT job_id, run_id, long_name, property, state,"
+                    " attempts, error FROM job"
+                    " WHERE run_id = ? AND state IN (?, ?) ORDER BY job_id",
+                    (run_id, DONE, FAILED),
+                ).fetchall()
+            for row in rows:
+                if row[0] not in seen:
+                    seen.add(row[0])
+                    yield Job(*row)
+            if not open_jobs:
+                return
+            if deadline is not None and time.monotonic() >= deadline:
+                logger.warning(
+                    f"Stopped waiting for {open_jobs} job(s) of run {run_id}"
+                )
+                return
+            time.sleep(poll_interval)
+
+    def _open_jobs(self, run_id: str) -> int:
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT COUNT(*) FROM job"
+                " WHERE run_id = ? AND state IN (?, ?)",
+                (run_id, PENDING, LEASED),
+            ).fetchone()
+        return int(row[0])
+
+    def read_result(self, job: Job) -> Dict[str, Any]:
+        with open(self._result_path(job.run_id, job.job_id)) as f:
+            return cast(Dict[str, Any], json.load(f))
+
+    def close(self, run_id: str) -> None:
+        """Cancel a run's unfinished jobs and remove its results."""
+        with self._transaction() as conn:
+            conn.execute(
+                "UPDATE run SET closed = 1 WHERE run_id = ?", (run_id,)
+            )
+            conn.execute(
+                "UPDATE job SET state = ?"
+                " WHERE run_id = ? AND state IN (?, ?)",
+                (CANCELLED, run_id, PENDING, LEASED),
+            )
+        shutil.rmtree(os.path.join(self.results_dir, run_id),
+                      ignore_errors=True)
+
+
+def work(
+    queue: WorkQueue,
+    fetch: Callable[[Job, Dict[str, Any]], Dict[str, Any]],
+    errors: Tuple[Type[BaseException], ...],
+    worker: Optional[str] = None,
+    idle: Optional[float] = None,
+    poll_interval: float = POLL_INTERVAL,
+    stop: Optional[threading.Event] = None,
+) -> int:
+    """Run queue's jobs with fetch until idle seconds pass without one.
+
+    fetch is given the job and its run's params and returns the result
+    to save.  Jobs it fails with one of errors are given back to be
+    retried.  Runs until stop is set if idle is None.  Returns the
+    number of jobs done.
+    """
+    if worker is None:
+        worker = default_worker_id()
+    if stop is None:
+        stop = threading.Event()
+    done = 0
+    last_job = time.monotonic()
+    while not stop.is_set():
+        job = queue.lease(worker)
+        if job is None:
+            if idle is not None and time.monotonic() - last_job >= idle:
+                break
+            stop.wait(poll_interval)
+            continue
+        try:
+            with queue.heartbeat(job, worker):
+                result = fetch(job, queue.params(job.run_id))
+        except errors as e:
+            logger.error(
+                f"Couldn't fetch {job.long_name} "
+                f"(attempt {job.attempts}): {e}"
+            )
+            queue.fail(job, worker, str(e))
+        else:
+            if queue.complete(job, worker, result):
+                done += 1
+        last_job = time.monotonic()
+    return done